@@ -1,5 +1,7 @@
 from django.contrib import admin
 
+from .forms import PostForm
+from .search import get_backend as search_backend
 from .models import Post, Group, Comment
 
 
@@ -8,12 +10,17 @@ class PostAdmin(admin.ModelAdmin):
 
     # display id, text, publication date, author and group
     list_display = ("pk", "text", "pub_date", "author", "related_group")
-    # allow search by text
+    # authors and groups of listed posts are joined instead of a query per row
+    list_select_related = ("author", "group")
+    # allow search by text, using the full-text index (see get_search_results)
     search_fields = ("text",)
     # allow filter by publication date
     list_filter = ("pub_date",)
     # replace all empty values with "-пусто-"
     empty_value_display = "-пусто-"
+    # uploaded images are processed the same way as on the site
+    form = PostForm
+    fields = ("text", "author", "group", "image")
 
     # change display text of group in Posts list view
     def related_group(self, obj):
@@ -26,6 +33,12 @@ class PostAdmin(admin.ModelAdmin):
     # set column title = "group"
     related_group.short_description = "group"
     
+    def get_search_results(self, request, queryset, search_term):
+        # search the full-text index instead of scanning text with LIKE
+        if not search_term:
+            return queryset, False
+        return search_backend().filter(queryset, search_term), False
+
     # Change display text in the Group dropdown when editing a Post 
     # Taken from https://stackoverflow.com/questions/6836740/django-admin-change-foreignkey-display-text
     def get_form(self, request, obj=None, **kwargs):
@@ -0,0 +1,229 @@
+"""Read-only JSON API over the feeds, version 1.
+
+Feeds are served as pages of posts located by the same (pub_date, id)
+cursors as HTML feeds: ?after=<cursor> continues a feed, ?limit= sets the
+page size. ?fields=id,text,author selects fields of posts, so that only
+their columns are read; authors and groups are embedded in posts and
+loaded for the whole page at once.
+
+Responses are cached and validated with the feed version counters of the
+HTML pages (see cache.py), so a client revalidating an unchanged feed
+gets 304 Not Modified without a single query for posts. The follow feed
+also depends on authors of its page, so revalidating it reads ids of the
+page's posts, but not the posts.
+"""
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import prefetch_related_objects
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.views.decorators.http import require_GET
+
+from .cache import get_or_compute, feed_version, FRAGMENT_TIMEOUT, INDEX, GROUP, AUTHOR, FOLLOWER
+from .models import Post, Group, User
+from .timeline import follow_feed, pulled_author_ids
+from .utils import keyset_slice, merged_slice, encode_cursor, decode_cursor, FEED_KEY, POSTS_PER_PAGE
+
+MAX_LIMIT = 50
+
+
+def _author(post):
+    return {'id': post.author.id, 'username': post.author.username, 'name': post.author.get_full_name()}
+
+
+def _group(post):
+    group = post.group
+    return group and {'id': group.id, 'slug': group.slug, 'title': group.title}
+
+
+def _image(post):
+    if not post.image:
+        return None
+    return {'url': post.image.url, 'width': post.image_width, 'height': post.image_height,
+            'placeholder': post.image_placeholder or None}
+
+
+def _url(post):
+    return reverse('post', args=[post.author.username, post.id])
+
+
+# field name: (function returning its value, columns it reads, relations it needs)
+FIELDS = {
+    'id': (lambda post: post.id, (), ()),
+    'text': (lambda post: post.text, ('text',), ()),
+    'pub_date': (lambda post: post.pub_date, (), ()),
+    'author': (_author, ('author',), ('author',)),
+    'group': (_group, ('group',), ('group',)),
+    'image': (_image, ('image', 'image_width', 'image_height', 'image_placeholder'), ()),
+    'comment_count': (lambda post: post.comment_count, ('comment_count',), ()),
+    'url': (_url, ('author',), ('author',)),
+}
+
+
+class BadRequest(Exception):
+    """Invalid query parameters, reported to the client with status 400"""
+
+
+def error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+def parse_fields(request):
+    """Return names of requested fields, in FIELDS order"""
+    value = request.GET.get('fields')
+    if not value:
+        return list(FIELDS)
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = names - set(FIELDS)
+    if unknown:
+        raise BadRequest('unknown fields: ' + ', '.join(sorted(unknown)))
+    return [name for name in FIELDS if name in names]
+
+
+def parse_limit(request):
+    value = request.GET.get('limit')
+    if value is None:
+        return POSTS_PER_PAGE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise BadRequest('limit must be a number')
+    if not 1 <= limit <= MAX_LIMIT:
+        raise BadRequest(f'limit must be between 1 and {MAX_LIMIT}')
+    return limit
+
+
+def parse_cursor(request):
+    token = request.GET.get('after')
+    if not token:
+        return None
+    after = decode_cursor(token)
+    if after is None:
+        raise BadRequest('malformed cursor')
+    return after
+
+
+def fetch_page(sources, fields, after, limit):
+    """Return (posts, has_next) of a page of merged (post_list, key) sources.
+
+    Only columns of the requested fields are read, and embedded objects
+    are loaded with one query per relation for the whole page.
+    """
+    # foreign keys are cheap to read, and follow feeds are versioned by authors
+    columns = set(FEED_KEY) | {'author', 'group'}
+    relations = set()
+    for name in fields:
+        columns.update(FIELDS[name][1])
+        relations.update(FIELDS[name][2])
+    sources = [(post_list.prefetch_related(None).only(*columns), key) for post_list, key in sources]
+    # fetch one extra post to find out if there is a next page
+    if len(sources) == 1:
+        post_list, key = sources[0]
+        posts = keyset_slice(post_list, after, limit=limit + 1, key=key)
+    else:
+        posts = merged_slice(sources, after, limit=limit + 1)
+    has_next, posts = len(posts) > limit, posts[:limit]
+    prefetch_related_objects(posts, *relations)
+    return posts, has_next
+
+
+def serialize(request, posts, has_next, fields):
+    """Return JSON of a page of posts"""
+    next_url = None
+    if has_next:
+        query = request.GET.copy()
+        query['after'] = encode_cursor(posts[-1])
+        next_url = request.path + '?' + query.urlencode()
+    data = {
+        'results': [{name: FIELDS[name][0](post) for name in fields} for post in posts],
+        'next': next_url,
+    }
+    return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False)
+
+
+def respond(request, version, build, user_id=None):
+    """Return a JSON response validated and cached by the feed version.
+
+    build() returns the body, it is called only if neither the client nor
+    the cache has the current version of the page. Pages of a user's own
+    feed are cached apart for every user_id.
+    """
+    etag = '"{}"'.format(version)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        # the same page can be requested with parameters in any order
+        query = sorted(request.GET.lists())
+        key = 'api:{}:{}:{}'.format(
+            user_id or '', version, hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest())
+        response = HttpResponse(
+            get_or_compute(key, build, FRAGMENT_TIMEOUT), content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def feed(request, post_list, scopes):
+    """Return a JSON page of a feed whose invalidation is tracked by scopes"""
+    try:
+        fields, limit, after = parse_fields(request), parse_limit(request), parse_cursor(request)
+    except BadRequest as e:
+        return error(str(e), 400)
+
+    def build():
+        posts, has_next = fetch_page([(post_list, FEED_KEY)], fields, after, limit)
+        return serialize(request, posts, has_next, fields)
+
+    return respond(request, feed_version(*scopes), build)
+
+
+@require_GET
+def posts(request):
+    """Latest posts of all authors"""
+    return feed(request, Post.objects.all(), [(INDEX,)])
+
+
+@require_GET
+def group_posts(request, slug):
+    """Latest posts of a group"""
+    group = Group.objects.filter(slug=slug).first()
+    if group is None:
+        return error('group not found', 404)
+    return feed(request, Post.objects.filter(group=group), [(GROUP, group.id)])
+
+
+@require_GET
+def user_posts(request, username):
+    """Latest posts of an author"""
+    author = User.objects.filter(username=username).first()
+    if author is None:
+        return error('user not found', 404)
+    return feed(request, Post.objects.filter(author=author), [(AUTHOR, author.id)])
+
+
+@require_GET
+def follow(request):
+    """Latest posts of authors followed by the user"""
+    if not request.user.is_authenticated:
+        return error('authentication required', 401)
+    try:
+        fields, limit, after = parse_fields(request), parse_limit(request), parse_cursor(request)
+    except BadRequest as e:
+        return error(str(e), 400)
+
+    # like follow.html, the page depends on authors of its posts; only their
+    # ids are read here, the posts only if the page isn't cached
+    pulled = pulled_author_ids(request.user.id)
+    _, _, sources = follow_feed(request.user, pulled)
+    posts, _ = fetch_page(sources, ['id'], after, limit)
+    author_ids = sorted(set(pulled) | {post.author_id for post in posts})
+    version = feed_version((FOLLOWER, request.user.id), *((AUTHOR, author_id) for author_id in author_ids))
+
+    def build():
+        posts, has_next = fetch_page(sources, fields, after, limit)
+        return serialize(request, posts, has_next, fields)
+
+    response = respond(request, version, build, request.user.id)
+    patch_vary_headers(response, ('Cookie',))
+    return response
@@ -0,0 +1,9 @@
+from django.urls import path
+from . import api
+
+urlpatterns = [
+    path('posts/', api.posts, name='api_posts'),
+    path('groups/<slug:slug>/posts/', api.group_posts, name='api_group_posts'),
+    path('users/<username>/posts/', api.user_posts, name='api_user_posts'),
+    path('follow/', api.follow, name='api_follow'),
+]
@@ -1,5 +1,17 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def setup_search(**kwargs):
+    """Create the search index, which is not a model table"""
+    from .search import get_backend
+    get_backend().setup()
 
 
 class PostsConfig(AppConfig):
     name = 'posts'
+
+    def ready(self):
+        # connect signal handlers which keep denormalized data up to date
+        from . import signals  # noqa
+        post_migrate.connect(setup_search, sender=self)
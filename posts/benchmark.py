@@ -0,0 +1,144 @@
+"""Helpers for generating synthetic data and timing code in benchmarks."""
+import math
+import random
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.db.backends.utils import CursorDebugWrapper
+from django.db.models import Max
+from PIL import Image, ImageDraw, ImageFilter
+
+from .models import User, Follow
+
+
+def percentile(values, q):
+    """Return q-th percentile (0..100) of values using nearest rank"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, math.ceil(q / 100 * len(values)) - 1)
+    return values[rank]
+
+
+def timed(func, *args, **kwargs):
+    """Call func and return (result, elapsed milliseconds)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def popularity_weights(count, alpha):
+    """Return Zipf-like weights: the author of rank r is followed ~ 1/r**alpha times"""
+    return [1 / rank ** alpha for rank in range(1, count + 1)]
+
+
+def create_users(count, prefix='bench'):
+    """Create count users named <prefix>_<n> and return their ids"""
+    start = (User.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+    # hashing a password for every user would take most of the time
+    password = make_password(None)
+    User.objects.bulk_create(
+        (User(username=f'{prefix}_{start + i}', password=password) for i in range(count)))
+    return list(User.objects.filter(
+        username__startswith=f'{prefix}_', id__gte=start).values_list('id', flat=True))
+
+
+def power_law_follows(user_ids, follows_per_user, alpha=1.5, rng=random):
+    """Return (user_id, author_id) pairs of a follow graph with power-law in-degrees.
+
+    A few authors get most of the followers, like in real social networks.
+    """
+    weights = popularity_weights(len(user_ids), alpha)
+    pairs = set()
+    for user_id in user_ids:
+        count = min(len(user_ids) - 1, max(1, int(rng.expovariate(1 / follows_per_user))))
+        for author_id in rng.choices(user_ids, weights, k=count):
+            if author_id != user_id:
+                pairs.add((user_id, author_id))
+    return sorted(pairs)
+
+
+def create_follows(pairs):
+    """Bulk create Follow objects for (user_id, author_id) pairs, bypassing signals"""
+    Follow.objects.bulk_create(
+        (Follow(user_id=user_id, author_id=author_id) for user_id, author_id in pairs))
+
+
+def synthetic_photo(width, height, rng, image_format='JPEG'):
+    """Return bytes of a photo-like image: smooth shapes, some noise and EXIF"""
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(width // 20, width // 4)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=colour)
+    image = image.filter(ImageFilter.GaussianBlur(width // 200 or 1))
+    noise = Image.effect_noise((width, height), 16).convert('RGB')
+    image = Image.blend(image, noise, 0.1)
+    exif = Image.Exif()
+    exif[0x010f] = 'Benchmark camera'
+    output = BytesIO()
+    image.save(output, image_format, quality=95, exif=exif.tobytes())
+    return output.getvalue()
+
+
+WORDS = ('judgment day future past machine fate war resistance time skynet '
+         'shelter desert road storm signal night city metal fire light').split()
+
+
+def synthetic_text(rng, hashtags=(), usernames=(), words=(5, 40)):
+    """Return a random post text, sometimes with a hashtag or a mention"""
+    text = [rng.choice(WORDS) for _ in range(rng.randint(*words))]
+    if hashtags and rng.random() < 0.3:
+        text.insert(rng.randrange(len(text) + 1), '#' + rng.choice(hashtags))
+    if usernames and rng.random() < 0.1:
+        text.insert(rng.randrange(len(text) + 1), '@' + rng.choice(usernames))
+    return ' '.join(text).capitalize()
+
+
+class RowCountingCursor(CursorDebugWrapper):
+    """Cursor logging queries and counting rows fetched from the database"""
+
+    def __init__(self, cursor, db, counter):
+        super().__init__(cursor, db)
+        self.counter = counter
+
+    def _count(self, rows):
+        self.counter[0] += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter[0] += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        return self._count(self.cursor.fetchmany(*args, **kwargs))
+
+    def fetchall(self):
+        return self._count(self.cursor.fetchall())
+
+    def __iter__(self):
+        for row in super().__iter__():
+            self.counter[0] += 1
+            yield row
+
+
+@contextmanager
+def count_rows():
+    """Count rows fetched by queries of the default connection.
+
+    Yields a one-item list holding the count. Queries are logged as in
+    CaptureQueriesContext, which must wrap this context.
+    """
+    counter = [0]
+    connection.make_debug_cursor = lambda cursor: RowCountingCursor(cursor, connection, counter)
+    try:
+        yield counter
+    finally:
+        del connection.make_debug_cursor
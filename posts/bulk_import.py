@@ -0,0 +1,328 @@
+"""Bulk import of groups, posts, comments and follows.
+
+Reads the NDJSON and CSV streams written by export.py: authors, groups
+and followers are referred to by usernames and slugs, which are resolved
+through in-memory maps instead of a query per row. Rows are written with
+bulk_create in batches, and a transaction is committed every few batches,
+so that neither a huge transaction nor a commit per row slows the import.
+
+Imports may go into a database which already has rows. Groups are matched
+by slug. Posts and comments keep their exported ids unless the ids are
+taken by other rows, in which case they get new ids, and comments follow
+their posts to the new ids. Rows found with the same author and text
+were imported before and are not imported again.
+
+bulk_create sends no signals, so denormalized data (counters, timelines,
+the search and tag indexes and cached feeds) is not maintained per row;
+finish() rebuilds it once at the end.
+"""
+import csv
+import json
+from contextlib import contextmanager
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import counters, tags, timeline
+from .cache import bump, INDEX, GROUP, AUTHOR, FOLLOWER
+from .models import User, Group, Post, Comment, Follow
+from .search import get_backend as search_backend
+from .utils import chunks
+
+# rows written by one bulk_create and rows written by one transaction
+BATCH_SIZE = 1000
+COMMIT_EVERY = 20000
+
+
+def read_rows(file, import_format):
+    """Yield dicts of rows of an NDJSON or CSV stream"""
+    if import_format == 'csv':
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def parse_date(value):
+    """Return an aware datetime from an exported value, or now if it is empty"""
+    if not value:
+        return timezone.now()
+    moment = parse_datetime(value)
+    if moment is None:
+        raise ValueError(f'invalid date: {value}')
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+@contextmanager
+def keep_timestamps(*fields):
+    """Write values of auto_now_add fields as they are instead of the current time"""
+    fields = [model._meta.get_field(name) for model, name in fields]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Importer:
+    """Imports rows of tables and remembers what to rebuild in finish()"""
+
+    def __init__(self, batch_size=BATCH_SIZE, commit_every=COMMIT_EVERY, create_users=False):
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.create_users = create_users
+        self.usernames = dict(User.objects.values_list('username', 'id'))
+        self.slugs = dict(Group.objects.values_list('slug', 'id'))
+        # rows referring to missing users or posts, and rows imported before
+        self.skipped = self.present = 0
+        # exported ids of imported posts: ids they were inserted under
+        self.post_ids = {}
+        # ids of each model used by this import, and the highest of them
+        self.taken, self.top = {}, {}
+        # what finish() has to rebuild
+        self.authors, self.groups, self.commented_posts = set(), set(), set()
+        self.last_follow_id = Follow.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def user_id(self, username):
+        return self.usernames.get(username)
+
+    def group_id(self, slug):
+        return self.slugs.get(slug) if slug else None
+
+    def add_users(self, usernames):
+        """Create users missing from the database, with unusable passwords"""
+        missing = {username for username in usernames if username and username not in self.usernames}
+        if not missing or not self.create_users:
+            return
+        password = make_password(None)
+        users = [User(username=username, password=password) for username in missing]
+        User.objects.bulk_create(users, batch_size=self.insert_batch_size(User, users), ignore_conflicts=True)
+        self.usernames.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+
+    def insert_batch_size(self, model, objects):
+        # django 2.2 doesn't cap batch_size to the limits of the database,
+        # e.g. on the number of rows or parameters of an SQLite statement
+        return min(self.batch_size, connection.ops.bulk_batch_size(model._meta.concrete_fields, objects))
+
+    def write(self, model, rows, build, user_columns=(), prepare=None, ignore_conflicts=False):
+        """Bulk create objects built from rows, return the number of created ones.
+
+        prepare(chunk) is called before rows of a chunk are built, and
+        build(row) returns an object or None to skip the row. Conflicting
+        rows are skipped by the database with ignore_conflicts.
+        """
+        count = 0
+        explicit_ids = False
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.commit_every))
+            if not chunk:
+                break
+            with transaction.atomic():
+                self.add_users({row[column] for row in chunk for column in user_columns})
+                if prepare is not None:
+                    prepare(chunk)
+                objects = [obj for obj in map(build, chunk) if obj is not None]
+                # the database doesn't tell how many rows it skipped
+                before = model.objects.count() if ignore_conflicts else 0
+                model.objects.bulk_create(
+                    objects, batch_size=self.insert_batch_size(model, objects), ignore_conflicts=ignore_conflicts)
+                created = model.objects.count() - before if ignore_conflicts else len(objects)
+            count += created
+            explicit_ids = explicit_ids or any(obj.pk is not None for obj in objects)
+        if explicit_ids:
+            self.reset_sequence(model)
+        return count
+
+    def reset_sequence(self, model):
+        # inserting explicit ids doesn't advance sequences, e.g. of PostgreSQL
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+
+    def existing(self, model, ids, fields):
+        """Return {id: (values of fields)} of rows of model with the given ids"""
+        found = {}
+        # e.g. SQLite limits the number of parameters of a statement
+        for chunk in chunks(ids, connection.features.max_query_params or len(ids) or 1):
+            found.update((row[0], row[1:]) for row in model.objects.filter(id__in=chunk).values_list('id', *fields))
+        return found
+
+    def identical(self, model, identities, fields):
+        """Return {values of fields: id} of rows of model with one of the given values"""
+        found = {}
+        size = max(1, (connection.features.max_query_params or len(identities)) // len(fields))
+        for chunk in chunks(identities, size):
+            wanted = set(chunk)
+            rows = model.objects.filter(**{
+                field + '__in': {identity[i] for identity in chunk} for i, field in enumerate(fields)})
+            found.update((row[1:], row[0]) for row in rows.values_list('id', *fields) if row[1:] in wanted)
+        return found
+
+    def resolve_ids(self, model, keyed, fields):
+        """Return {exported id: (id to insert the row under, whether it was imported before)}.
+
+        keyed maps exported ids of rows to their values of fields. A row
+        with the same values under its exported id, or under the id it was
+        moved to by an earlier import, was imported before. Otherwise the
+        row keeps its exported id, unless another row has it, in which
+        case it gets a new id above all ids of the table.
+        """
+        existing = self.existing(model, keyed, fields)
+        moved = {identity for exported_id, identity in keyed.items()
+                 if exported_id in existing and existing[exported_id] != identity}
+        identical = self.identical(model, moved, fields) if moved else {}
+        taken = self.taken.setdefault(model, set())
+        if model not in self.top:
+            self.top[model] = model.objects.aggregate(Max('id'))['id__max'] or 0
+        resolved = {}
+        for exported_id, identity in keyed.items():
+            if existing.get(exported_id) == identity:
+                resolved[exported_id] = exported_id, True
+            elif identity in identical:
+                resolved[exported_id] = identical[identity], True
+            else:
+                row_id = exported_id
+                if exported_id in existing or exported_id in taken:
+                    row_id = self.top[model] + 1
+                taken.add(row_id)
+                self.top[model] = max(self.top[model], row_id)
+                resolved[exported_id] = row_id, False
+        return resolved
+
+    def groups_table(self, rows):
+        slugs = set()
+
+        def build(row):
+            # exported ids aren't kept, posts refer to groups by slug
+            if row['slug'] in slugs or row['slug'] in self.slugs:
+                self.present += 1
+                slugs.add(row['slug'])
+                return None
+            slugs.add(row['slug'])
+            return Group(slug=row['slug'], title=row['title'], description=row.get('description', ''))
+
+        count = self.write(Group, rows, build)
+        self.slugs = dict(Group.objects.values_list('slug', 'id'))
+        self.groups.update(self.slugs[slug] for slug in slugs)
+        return count
+
+    def posts_table(self, rows):
+        resolved = {}
+
+        def prepare(chunk):
+            keyed = {}
+            for row in chunk:
+                author_id = self.user_id(row['author'])
+                if row.get('id') and author_id is not None:
+                    keyed[int(row['id'])] = (author_id, row['text'])
+            resolved.clear()
+            resolved.update(self.resolve_ids(Post, keyed, ('author_id', 'text')))
+
+        def build(row):
+            author_id = self.user_id(row['author'])
+            if author_id is None:
+                self.skipped += 1
+                return None
+            exported_id = int(row['id']) if row.get('id') else None
+            if exported_id in self.post_ids:
+                # a duplicate row of the file
+                self.present += 1
+                return None
+            post_id, present = resolved.get(exported_id, (None, False))
+            if exported_id is not None:
+                self.post_ids[exported_id] = post_id
+            if present:
+                self.present += 1
+                return None
+            group_id = self.group_id(row.get('group'))
+            self.authors.add(author_id)
+            self.groups.add(group_id)
+            return Post(id=post_id, author_id=author_id, group_id=group_id,
+                        pub_date=parse_date(row.get('pub_date')), text=row['text'],
+                        image=row.get('image') or None)
+
+        with keep_timestamps((Post, 'pub_date')):
+            return self.write(Post, rows, build, user_columns=('author',), prepare=prepare)
+
+    def comments_table(self, rows):
+        resolved = {}
+        seen = set()
+
+        def prepare(chunk):
+            keyed = {}
+            for row in chunk:
+                post_id, author_id = self.post_ids.get(int(row['post'])), self.user_id(row['author'])
+                if row.get('id') and post_id is not None and author_id is not None:
+                    keyed[int(row['id'])] = (post_id, author_id, row['text'])
+            resolved.clear()
+            resolved.update(self.resolve_ids(Comment, keyed, ('post_id', 'author_id', 'text')))
+
+        def build(row):
+            # comments of posts which weren't imported would belong to
+            # missing posts or to other posts under their ids
+            post_id = self.post_ids.get(int(row['post']))
+            author_id = self.user_id(row['author'])
+            if post_id is None or author_id is None:
+                self.skipped += 1
+                return None
+            exported_id = int(row['id']) if row.get('id') else None
+            comment_id, present = resolved.get(exported_id, (None, False))
+            if present or exported_id in seen:
+                self.present += 1
+                return None
+            if exported_id is not None:
+                seen.add(exported_id)
+            self.commented_posts.add(post_id)
+            return Comment(id=comment_id, post_id=post_id, author_id=author_id,
+                           created=parse_date(row.get('created')), text=row['text'])
+
+        with keep_timestamps((Comment, 'created')):
+            return self.write(Comment, rows, build, user_columns=('author',), prepare=prepare)
+
+    def follows_table(self, rows):
+        def build(row):
+            user_id, author_id = self.user_id(row['user']), self.user_id(row['author'])
+            if user_id is None or author_id is None or user_id == author_id:
+                self.skipped += 1
+                return None
+            return Follow(user_id=user_id, author_id=author_id)
+
+        # follows imported before are skipped by the unique constraint
+        return self.write(Follow, rows, build, user_columns=('user', 'author'), ignore_conflicts=True)
+
+    def load(self, table, rows):
+        """Import rows of a table, return the number of imported rows"""
+        return getattr(self, table + '_table')(rows)
+
+    def finish(self):
+        """Rebuild denormalized data once after all tables are imported"""
+        counters.recount_comments()
+        counters.recount_stats()
+        # comment counts are shown on feeds of posts' authors
+        for post_ids in chunks(self.commented_posts, self.batch_size):
+            self.authors.update(Post.objects.filter(id__in=post_ids).values_list('author_id', flat=True))
+
+        # timelines of imported follows and of followers of imported authors;
+        # entries which already exist are skipped
+        follows = [Follow.objects.filter(id__gt=self.last_follow_id)]
+        follows += [Follow.objects.filter(author_id__in=author_ids)
+                    for author_ids in chunks(self.authors, self.batch_size)]
+        followers = set()
+        for queryset in follows:
+            timeline.add_authors(queryset)
+            followers.update(queryset.values_list('user_id', flat=True).distinct())
+
+        search_backend().reindex()
+        tags.rebuild()
+        bump((INDEX,), *((GROUP, group_id) for group_id in self.groups - {None}),
+             *((AUTHOR, author_id) for author_id in self.authors),
+             *((FOLLOWER, user_id) for user_id in followers))
@@ -0,0 +1,123 @@
+"""Versioned invalidation of cached feeds.
+
+Every feed (the index, a group, an author's profile, a post page and a
+follower's timeline) has a generation counter, which is bumped by signal
+handlers whenever a Post, Comment or Follow write changes what the feed
+shows. Cache keys include the counters of all feeds a fragment depends on,
+so a fragment can be cached for hours and still is never served stale:
+after a write it is simply looked up under a new key.
+
+get_or_compute() protects expensive cached values from stampedes: when a
+value expires, only one worker recomputes it while others wait briefly or
+keep serving the stale copy, and values are recomputed a bit before they
+expire, with a probability growing as expiry comes closer.
+"""
+import math
+import random
+import time
+
+from django.core.cache import cache
+
+# how long rendered feed fragments are kept, see index.html and follow.html
+FRAGMENT_TIMEOUT = 6 * 60 * 60
+
+INDEX = 'index'
+GROUP = 'group'
+AUTHOR = 'author'
+POST = 'post'
+FOLLOWER = 'follower'
+
+
+def _version_key(scope):
+    return 'feedver:' + ':'.join(str(part) for part in scope)
+
+
+def _initial_version():
+    # counters start from the current time, so that a counter evicted from
+    # the cache never goes back to a value it already had
+    return int(time.time() * 1000)
+
+
+def get_versions(*scopes):
+    """Return current versions of feeds, e.g. get_versions((GROUP, 1), (INDEX,))"""
+    keys = [_version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    missing = {key: _initial_version() for key in keys if key not in versions}
+    if missing:
+        # add() keeps a version set concurrently by another request
+        for key, version in missing.items():
+            cache.add(key, version, None)
+        versions.update(cache.get_many(list(missing)))
+        versions.update({key: version for key, version in missing.items() if key not in versions})
+    return [versions[key] for key in keys]
+
+
+def feed_version(*scopes):
+    """Return a string identifying current versions of all given feeds"""
+    return '.'.join(str(version) for version in get_versions(*scopes))
+
+
+def bump(*scopes):
+    """Invalidate everything cached for the given feeds"""
+    for scope in scopes:
+        key = _version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_version(), None)
+
+
+# how long a worker may hold a recompute lock and how long others wait for it
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 2.0
+LOCK_POLL_INTERVAL = 0.05
+# how long an expired value is kept to be served while it is recomputed
+STALE_TIMEOUT = 60
+
+
+def _should_recompute_early(delta, expires, beta):
+    # "XFetch" (Vattani et al., Optimal Probabilistic Cache Stampede Prevention):
+    # values which take delta seconds to compute are recomputed early
+    # with exponentially growing probability as expiry approaches
+    return time.time() - delta * beta * math.log(1 - random.random()) >= expires
+
+
+def get_or_compute(key, compute, timeout, cache=cache, beta=1.0,
+                   lock_timeout=LOCK_TIMEOUT, wait=LOCK_WAIT):
+    """Return value cached under key, calling compute() on a miss.
+
+    Concurrent misses are coalesced: the first worker takes a short lock
+    in the cache and calls compute(), others serve the stale value if
+    there is one, or wait up to wait seconds for the new value.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        value, delta, expires = entry
+        if not _should_recompute_early(delta, expires, beta):
+            return value
+
+    lock_key = key + ':lock'
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            start = time.time()
+            value = compute()
+            delta = time.time() - start
+            if timeout is None:
+                cache.set(key, (value, delta, math.inf), None)
+            else:
+                cache.set(key, (value, delta, time.time() + timeout), timeout + STALE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    if entry is not None:
+        # someone is already refreshing the value, the stale one will do
+        return entry[0]
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+    # the worker holding the lock is too slow, don't keep the user waiting
+    return compute()
@@ -0,0 +1,94 @@
+"""Denormalized counters, kept up to date by signal handlers in signals.py.
+
+Counters are changed with UPDATE ... SET n = n + 1, so that concurrent
+writes never lose increments. The functions below recompute them from
+scratch in bulk to repair any drift.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import User, Post, Comment, Follow, ProfileStats
+
+
+def change_comment_count(post_id, delta):
+    """Atomically add delta to the post's comment counter"""
+    Post.objects.filter(pk=post_id).update(comment_count=F('comment_count') + delta)
+
+
+def comment_count_drift():
+    """Return number of posts whose stored comment counter is wrong"""
+    return Post.objects.annotate(actual=Count('comment_post')).exclude(
+        comment_count=F('actual')).count()
+
+
+def recount_comments():
+    """Recompute comment counters of all posts with a single UPDATE"""
+    comments = Comment.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(
+        count=Count('id')).values('count')
+    return Post.objects.update(
+        comment_count=Coalesce(Subquery(comments, output_field=IntegerField()), 0))
+
+
+def change_stats(user_id, create=True, **deltas):
+    """Atomically add deltas to user's profile stats, e.g. change_stats(1, posts=1)
+
+    Stats missing for users created in bulk are counted from scratch,
+    unless create is False.
+    """
+    updated = ProfileStats.objects.filter(user_id=user_id).update(
+        **{name: F(name) + delta for name, delta in deltas.items()})
+    if not updated and create:
+        create_stats(user_id)
+
+
+def create_stats(user_id):
+    """Create profile stats of the user from scratch, return them"""
+    try:
+        with transaction.atomic():
+            return ProfileStats.objects.create(user_id=user_id, **count_stats(user_id))
+    except IntegrityError:
+        # stats were created concurrently
+        return ProfileStats.objects.get(user_id=user_id)
+
+
+def count_stats(user_id):
+    """Return actual values of user's profile stats"""
+    return {
+        'posts': Post.objects.filter(author_id=user_id).count(),
+        'followers': Follow.objects.filter(author_id=user_id).count(),
+        'following': Follow.objects.filter(user_id=user_id).count(),
+    }
+
+
+def _stats_subqueries(ref):
+    """Return subqueries counting profile stats of the user whose id is OuterRef(ref)"""
+    def count(queryset, field):
+        return Coalesce(Subquery(
+            queryset.filter(**{field: OuterRef(ref)}).order_by().values(field).annotate(
+                count=Count('id')).values('count'),
+            output_field=IntegerField()), 0)
+
+    return {
+        'posts': count(Post.objects, 'author'),
+        'followers': count(Follow.objects, 'author'),
+        'following': count(Follow.objects, 'user'),
+    }
+
+
+def stats_drift():
+    """Return number of users whose profile stats are wrong or missing"""
+    actual = {'actual_' + name: query for name, query in _stats_subqueries('pk').items()}
+    return User.objects.annotate(**actual).exclude(
+        Q(stats__posts=F('actual_posts'))
+        & Q(stats__followers=F('actual_followers'))
+        & Q(stats__following=F('actual_following'))).count()
+
+
+def recount_stats():
+    """Recompute profile stats of all users with a single UPDATE"""
+    ProfileStats.objects.bulk_create(
+        (ProfileStats(user_id=user_id) for user_id in User.objects.filter(
+            stats__isnull=True).values_list('id', flat=True).iterator()),
+        ignore_conflicts=True)
+    return ProfileStats.objects.update(**_stats_subqueries('user_id'))
@@ -0,0 +1,74 @@
+"""Streaming export of the dataset as NDJSON or CSV.
+
+Rows are read with iterator(chunk_size), so the database driver fetches
+them in chunks and no more than a chunk is held in memory, whatever the
+size of a table. Rows are exported in id order and authors, posts'
+groups and followers are referred to by usernames and slugs, so that
+dumps can be loaded into another database.
+
+Ids only grow, so the last exported id is a watermark: an export with
+since=<watermark> continues from the next row, e.g. after an interrupted
+export or to fetch rows added since the previous one.
+"""
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Group, Post, Comment, Follow
+
+FORMATS = ('ndjson', 'csv')
+CHUNK_SIZE = 2000
+
+# table: (model, [(column, lookup)])
+TABLES = {
+    'groups': (Group, [
+        ('id', 'id'), ('slug', 'slug'), ('title', 'title'), ('description', 'description')]),
+    'posts': (Post, [
+        ('id', 'id'), ('author', 'author__username'), ('group', 'group__slug'),
+        ('pub_date', 'pub_date'), ('text', 'text'), ('image', 'image')]),
+    'comments': (Comment, [
+        ('id', 'id'), ('post', 'post_id'), ('author', 'author__username'),
+        ('created', 'created'), ('text', 'text')]),
+    'follows': (Follow, [
+        ('id', 'id'), ('user', 'user__username'), ('author', 'author__username')]),
+}
+
+
+def columns(table):
+    return [column for column, _ in TABLES[table][1]]
+
+
+def rows(table, since=None, chunk_size=CHUNK_SIZE):
+    """Yield tuples of the table's columns in id order, after id since"""
+    model, fields = TABLES[table]
+    queryset = model.objects.order_by('id')
+    if since is not None:
+        queryset = queryset.filter(id__gt=since)
+    return queryset.values_list(*(lookup for _, lookup in fields)).iterator(chunk_size=chunk_size)
+
+
+class Echo:
+    """File-like object returning what is written, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(table, rows):
+    names = columns(table)
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def csv_lines(table, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns(table))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def lines(table, export_format, since=None, chunk_size=CHUNK_SIZE):
+    """Yield lines of the table exported in export_format, see FORMATS"""
+    encode = ndjson_lines if export_format == 'ndjson' else csv_lines
+    return encode(table, rows(table, since, chunk_size))
@@ -1,5 +1,7 @@
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
 from posts.models import Post, Comment
+from posts import images
 
 
 class PostForm(forms.ModelForm):
@@ -11,6 +13,16 @@ class PostForm(forms.ModelForm):
         labels = {'text': 'Текст записи', 'group':'Сообщество', 'image': 'Картинка'}
         widgets = {'text': forms.Textarea()}
 
+    def clean_image(self):
+        """ store new uploads downsized and without metadata """
+        image = self.cleaned_data.get('image')
+        post = self.instance
+        if isinstance(image, UploadedFile):
+            image, (post.image_width, post.image_height, post.image_placeholder) = images.ingest(image)
+        elif not image:
+            post.image_width, post.image_height, post.image_placeholder = None, None, ''
+        return image
+
 
 class CommentForm(forms.ModelForm):
     """ form for adding a comment to a post """
@@ -0,0 +1,88 @@
+"""Ingest of uploaded post images.
+
+Originals are stored downsized to settings.POST_IMAGE_MAX_SIZE and without
+metadata (EXIF with camera data and GPS coordinates, comments and so on).
+JPEGs are decoded straight at a reduced scale (Image.draft), so memory
+stays bounded even for huge uploads. Feed pages show WebP thumbnails of
+several widths generated from the stored original, see thumbnails.py.
+
+Dimensions of the image and a tiny preview, shown blurred while the
+thumbnail loads, are stored on the post, so feeds never open image files.
+"""
+import os
+from base64 import b64encode
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image, ImageOps
+
+# formats which are stored as they are, others are converted to PNG
+KEPT_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}
+JPEG_QUALITY = 85
+# width and height limit of image previews, in pixels
+PLACEHOLDER_SIZE = 16
+
+
+def describe(image):
+    """Return (width, height, placeholder) of a PIL image, shrinking it in place.
+
+    placeholder is a data URI of a tiny PNG preview of the image.
+    """
+    width, height = image.size
+    image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    output = BytesIO()
+    image.convert('RGB').save(output, 'PNG', optimize=True)
+    return width, height, 'data:image/png;base64,' + b64encode(output.getvalue()).decode()
+
+
+def describe_file(file):
+    """Return (width, height, placeholder) of an image file, see describe()"""
+    with Image.open(file) as image:
+        # size in EXIF orientation, as the image is displayed
+        transposed = image.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+        width, height, placeholder = describe(image)
+    return (height, width, placeholder) if transposed else (width, height, placeholder)
+
+
+def ingest(upload):
+    """Return a downsized copy of the uploaded image without metadata.
+
+    Return (upload, (width, height, placeholder)) of the stored image.
+    """
+    upload.seek(0)
+    image = Image.open(upload)
+    if getattr(image, 'is_animated', False):
+        # animations would be flattened to their first frame
+        details = describe(image)
+        upload.seek(0)
+        return upload, details
+
+    image_format = image.format if image.format in KEPT_FORMATS else 'PNG'
+    max_size = settings.POST_IMAGE_MAX_SIZE
+    # thumbnail() decodes JPEGs at 1/2, 1/4 or 1/8 scale if that is enough,
+    # and shrinks other images by reduce() before resampling
+    image.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=3.0)
+    image = ImageOps.exif_transpose(image)
+
+    options = {}
+    if 'icc_profile' in image.info:
+        # colour profile is not metadata, images look wrong without it
+        options['icc_profile'] = image.info['icc_profile']
+    # some encoders write EXIF, XMP or comments found in image.info
+    image.info = {key: value for key, value in image.info.items() if key == 'transparency'}
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        options.update(quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif image_format == 'WEBP':
+        options.update(quality=JPEG_QUALITY, method=4)
+    elif image_format == 'PNG':
+        options.update(optimize=True)
+
+    output = BytesIO()
+    image.save(output, image_format, **options)
+    name = os.path.splitext(upload.name)[0] + EXTENSIONS[image_format]
+    details = describe(image)
+    return SimpleUploadedFile(name, output.getvalue(), Image.MIME[image_format]), details
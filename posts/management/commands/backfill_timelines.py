@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from posts import timeline
+from posts.models import Follow
+
+
+class Command(BaseCommand):
+    help = "Fill follow feed timelines from the existing follow graph"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="only backfill timeline of this username")
+
+    def handle(self, *args, **options):
+        follows = Follow.objects.order_by('id')
+        if options['user']:
+            follows = follows.filter(user__username=options['user'])
+        count = 0
+        for user_id, author_id in follows.values_list('user_id', 'author_id').iterator():
+            # existing entries are skipped, so the command can be rerun safely
+            timeline.add_author(user_id, author_id)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {count} followings"))
@@ -0,0 +1,76 @@
+import random
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from posts import api, views
+from posts.benchmark import percentile, create_users
+from posts.models import Group, Post
+from posts.utils import encode_cursor, decode_cursor, FEED_KEY, POSTS_PER_PAGE
+
+# rendering is measured, so nothing is served from the cache
+DUMMY_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+class Command(BaseCommand):
+    help = ("Compare the cost of serving feed pages as HTML and as JSON: CPU time, "
+            "queries and bytes per page. All data is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--posts', type=int, default=2000)
+        parser.add_argument('--pages', type=int, default=50, help="feed pages read per format")
+        parser.add_argument('--fields', default='id,text,pub_date,author',
+                            help="fields of the sparse JSON variant")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            user_ids = create_users(options['users'])
+            groups = [Group.objects.create(title=f'Bench {i}', slug=f'bench-{i}', description='')
+                      for i in range(5)]
+            Post.objects.bulk_create(
+                Post(author_id=rng.choice(user_ids), group=rng.choice(groups + [None]),
+                     text=' '.join(f'word{rng.randrange(1000)}' for _ in range(rng.randrange(5, 60))))
+                for _ in range(options['posts']))
+
+            variants = [
+                ('html', views.index, {}),
+                ('json', api.posts, {}),
+                ('json sparse', api.posts, {'fields': options['fields']}),
+            ]
+            self.stdout.write(f"{'format':<12}{'CPU ms p50/p95':>18}{'queries':>9}{'KB/page':>9}")
+            with override_settings(CACHES=DUMMY_CACHE):
+                for name, view, params in variants:
+                    self.stdout.write(self.run_variant(name, view, params, options['pages']))
+            transaction.set_rollback(True)
+
+    def run_variant(self, name, view, params, pages):
+        """Read pages of the index one after another, return a line of the report"""
+        factory = RequestFactory()
+        cpu, queries, sizes = [], [], []
+        # all formats read the same pages, located by cursors of the index
+        cursors = [None]
+        for _ in range(pages - 1):
+            posts, has_next = api.fetch_page(
+                [(Post.objects.all(), FEED_KEY)], ['id'], decode_cursor(cursors[-1] or ''), POSTS_PER_PAGE)
+            if not has_next:
+                break
+            cursors.append(encode_cursor(posts[-1]))
+        for cursor in cursors:
+            query = dict(params, after=cursor) if cursor else params
+            request = factory.get('/', query)
+            request.user = AnonymousUser()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.process_time()
+                response = view(request)
+                cpu.append((time.process_time() - start) * 1000)
+            queries.append(len(captured))
+            sizes.append(len(response.content) / 1024)
+        return (f"{name:<12}{percentile(cpu, 50):>9.2f}/{percentile(cpu, 95):<8.2f}"
+                f"{sum(queries) / len(queries):>9.1f}{sum(sizes) / len(sizes):>9.1f}")
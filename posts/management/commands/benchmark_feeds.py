@@ -0,0 +1,83 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from posts import timeline
+from posts.benchmark import (
+    percentile, timed, popularity_weights, create_users, power_law_follows, create_follows)
+from posts.models import User, Post, Follow, TimelineEntry
+from posts.utils import paginate
+
+
+class Command(BaseCommand):
+    help = ("Compare pull, push and hybrid follow feed delivery on a synthetic "
+            "power-law follow graph. All data is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--follows', type=int, default=50, help="mean followings per user")
+        parser.add_argument('--alpha', type=float, default=1.5, help="power-law exponent of popularity")
+        parser.add_argument('--posts', type=int, default=5, help="posts per user")
+        parser.add_argument('--threshold', type=int, default=200, help="hybrid mode fan-out threshold")
+        parser.add_argument('--writes', type=int, default=100, help="posts published per mode")
+        parser.add_argument('--reads', type=int, default=100, help="follow feeds read per mode")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            user_ids = create_users(options['users'])
+            Post.objects.bulk_create(
+                (Post(author_id=user_id, text=f'post {i} of {user_id}')
+                 for i in range(options['posts']) for user_id in user_ids))
+            create_follows(power_law_follows(user_ids, options['follows'], options['alpha'], rng))
+            self.stdout.write(
+                f"{len(user_ids)} users, {Follow.objects.count()} follows, {Post.objects.count()} posts")
+
+            # authors write and readers read in proportion to their popularity
+            weights = popularity_weights(len(user_ids), options['alpha'])
+            authors = rng.choices(user_ids, weights, k=options['writes'])
+            readers = rng.choices(user_ids, weights, k=options['reads'])
+
+            self.stdout.write("mode      backfill ms  write ms p50/p95  rows/post  "
+                              "read ms p50/p95  cursor read ms p50/p95")
+            for mode in (timeline.PULL, timeline.PUSH, timeline.HYBRID):
+                with override_settings(FEED_DELIVERY=mode, FEED_FANOUT_THRESHOLD=options['threshold']):
+                    with transaction.atomic():
+                        self.stdout.write(self.run_mode(mode, authors, readers))
+                        transaction.set_rollback(True)
+            transaction.set_rollback(True)
+
+    def run_mode(self, mode, authors, readers):
+        """Publish posts and read feeds, return a line of the report"""
+        TimelineEntry.objects.all().delete()
+        _, backfill = timed(lambda: [
+            timeline.add_author(user_id, author_id)
+            for user_id, author_id in Follow.objects.values_list('user_id', 'author_id')])
+
+        entries = TimelineEntry.objects.count()
+        writes = [timed(Post.objects.create, author_id=author_id, text='new post')[1]
+                  for author_id in authors]
+        rows_per_post = (TimelineEntry.objects.count() - entries) / len(authors)
+
+        factory = RequestFactory()
+        reads, cursor_reads = [], []
+        for user in User.objects.filter(id__in=readers):
+            (page, _), elapsed = timed(self.read_feed, factory.get('/follow/'), user)
+            reads.append(elapsed)
+            if page.next_cursor:
+                request = factory.get('/follow/', {'after': page.next_cursor})
+                cursor_reads.append(timed(self.read_feed, request, user)[1])
+
+        return (f"{mode:<8}  {backfill:>11.0f}  {percentile(writes, 50):>7.2f}/{percentile(writes, 95):<7.2f}  "
+                f"{rows_per_post:>9.1f}  {percentile(reads, 50):>6.2f}/{percentile(reads, 95):<7.2f}  "
+                f"{percentile(cursor_reads, 50):>12.2f}/{percentile(cursor_reads, 95):.2f}")
+
+    def read_feed(self, request, user):
+        post_list, key, sources = timeline.follow_feed(user)
+        page, paginator = paginate(request, post_list, key=key, sources=sources)
+        # pages are fetched lazily, the timed read must fetch the posts
+        list(page.object_list)
+        return page, paginator
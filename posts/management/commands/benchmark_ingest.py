@@ -0,0 +1,71 @@
+import os
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from posts import images
+from posts.benchmark import percentile, synthetic_photo
+from posts.thumbnails import QueuedThumbnailBackend
+
+
+class Command(BaseCommand):
+    help = ("Measure bytes and CPU time of ingesting uploaded photos and of their "
+            "thumbnails, compared to storing originals and serving one JPEG thumbnail")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uploads', type=int, default=10)
+        parser.add_argument('--width', type=int, default=4000)
+        parser.add_argument('--height', type=int, default=3000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        report = {name: [] for name in (
+            'upload KB', 'stored KB', 'ingest CPU ms', 'legacy thumbnail CPU ms',
+            'thumbnails CPU ms', 'legacy feed KB', 'feed KB (webp 960w)', 'feed KB (webp 480w)')}
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp()):
+            for i in range(options['uploads']):
+                photo = synthetic_photo(options['width'], options['height'], rng)
+                self.measure(report, f'photo{i}.jpg', photo)
+
+        self.stdout.write(f"{'':<26}{'mean':>10}{'p50':>10}{'p95':>10}")
+        for name, values in report.items():
+            self.stdout.write(f"{name:<26}{sum(values) / len(values):>10.1f}"
+                              f"{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}")
+
+    def measure(self, report, name, photo):
+        backend = QueuedThumbnailBackend()
+        report['upload KB'].append(len(photo) / 1024)
+
+        # before: the original is stored as is and thumbnailed to a JPEG
+        original = default_storage.save('originals/' + name, SimpleUploadedFile(name, photo))
+        geometry, options = settings.POST_THUMBNAILS[0]
+        start = time.process_time()
+        with override_settings(POST_THUMBNAILS=[(geometry, options)]):
+            backend.create_thumbnails(original)
+        report['legacy thumbnail CPU ms'].append((time.process_time() - start) * 1000)
+        report['legacy feed KB'].append(self.thumbnail_size(original, geometry, options))
+
+        # after: the upload is ingested and thumbnailed to all geometries
+        start = time.process_time()
+        ingested, _ = images.ingest(SimpleUploadedFile(name, photo, 'image/jpeg'))
+        report['ingest CPU ms'].append((time.process_time() - start) * 1000)
+        stored = default_storage.save('posts/' + ingested.name, ingested)
+        report['stored KB'].append(default_storage.size(stored) / 1024)
+        start = time.process_time()
+        backend.create_thumbnails(stored)
+        report['thumbnails CPU ms'].append((time.process_time() - start) * 1000)
+        for geometry, options in settings.POST_THUMBNAILS[1:]:
+            width = geometry.split('x')[0]
+            if options.get('format') == 'WEBP' and f'feed KB (webp {width}w)' in report:
+                report[f'feed KB (webp {width}w)'].append(self.thumbnail_size(stored, geometry, options))
+
+    def thumbnail_size(self, name, geometry, options):
+        _, thumbnail = QueuedThumbnailBackend()._get_files(name, geometry, dict(options))
+        return os.path.getsize(default_storage.path(thumbnail.name)) / 1024
@@ -0,0 +1,148 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from posts.benchmark import percentile, count_rows
+from posts.models import Group, Post, ProfileStats, User
+
+# views which write are measured in transactions which are rolled back
+WRITES = {'add_comment', 'new_post'}
+# metrics of the report; latency is compared with a baseline within a tolerance,
+# counts exactly
+LATENCY = ('p50_ms', 'p95_ms', 'p99_ms')
+COUNTS = ('queries', 'rows')
+
+DUMMY_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+class Command(BaseCommand):
+    help = ("Request every page of the site on the current database (see seed_data) and "
+            "report latency percentiles, SQL queries and rows fetched per URL name as JSON, "
+            "optionally compared with a baseline report.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="measured requests per view")
+        parser.add_argument('--warmup', type=int, default=3, help="unmeasured requests per view")
+        parser.add_argument('--no-cache', action='store_true', help="measure with caching disabled")
+        parser.add_argument('--views', help="comma separated URL names to measure, all by default")
+        parser.add_argument('--output', default='benchmark.json', help="file to write the report to")
+        parser.add_argument('--baseline', help="report to compare with")
+        parser.add_argument('--tolerance', type=float, default=20,
+                            help="allowed p95 latency growth over the baseline, in percent")
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        requests = self.requests()
+        if options['views']:
+            names = options['views'].split(',')
+            unknown = set(names) - set(requests)
+            if unknown:
+                raise CommandError(f"Unknown views: {', '.join(sorted(unknown))}")
+            requests = {name: requests[name] for name in names}
+
+        overrides = {'CACHES': DUMMY_CACHE} if options['no_cache'] else {}
+        with override_settings(**overrides):
+            results = {name: self.measure(name, *request, options) for name, request in requests.items()}
+
+        report = {
+            'dataset': {
+                'users': User.objects.count(),
+                'posts': Post.objects.count(),
+                'groups': Group.objects.count(),
+            },
+            'requests': options['requests'],
+            'cache': not options['no_cache'],
+            'views': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+        self.stdout.write(f"{'view':<14}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'rows':>9}")
+        for name, result in results.items():
+            self.stdout.write(f"{name:<14}" + ''.join(
+                f"{result[metric]:>9.2f}" for metric in LATENCY) + ''.join(
+                f"{result[metric]:>9}" for metric in COUNTS))
+        self.stdout.write(f"Report written to {options['output']}")
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = self.compare(json.load(baseline)['views'], results, options['tolerance'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"{regressions} regressions against {options['baseline']}")
+
+    def requests(self):
+        """Return {url name: (method, url, data, user)} of pages to request"""
+        stats = ProfileStats.objects.select_related('user')
+        author = stats.order_by('-posts').first()
+        reader = stats.order_by('-following').first()
+        group = Group.objects.annotate(posts=Count('post_group')).order_by('-posts').first()
+        if author is None or reader is None or group is None:
+            raise CommandError("The database has no data to measure, run seed_data first")
+        post = Post.objects.filter(author=author.user).order_by('-comment_count').first()
+        post_args = [author.user.username, post.id]
+        return {
+            'index': ('get', reverse('index'), None, None),
+            'group': ('get', reverse('group', args=[group.slug]), None, None),
+            'profile': ('get', reverse('profile', args=[author.user.username]), None, None),
+            'post': ('get', reverse('post', args=post_args), None, None),
+            'follow_index': ('get', reverse('follow_index'), None, reader.user),
+            'add_comment': ('post', reverse('add_comment', args=post_args), {'text': 'Benchmark'}, reader.user),
+            'new_post': ('post', reverse('new_post'), {'text': 'Benchmark'}, reader.user),
+        }
+
+    def measure(self, name, method, url, data, user, options):
+        """Request the page repeatedly, return its metrics"""
+        client = Client()
+        if user is not None:
+            client.force_login(user)
+        latencies, queries, rows = [], [], []
+        for i in range(options['warmup'] + options['requests']):
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as captured, count_rows() as fetched:
+                    start = time.perf_counter()
+                    response = getattr(client, method)(url, data)
+                    elapsed = (time.perf_counter() - start) * 1000
+                if name in WRITES:
+                    transaction.set_rollback(True)
+            if response.status_code >= 400:
+                raise CommandError(f"{name}: {url} answered {response.status_code}")
+            if i >= options['warmup']:
+                latencies.append(elapsed)
+                queries.append(len(captured))
+                rows.append(fetched[0])
+        return {
+            'url': url,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'queries': percentile(queries, 50),
+            'rows': percentile(rows, 50),
+        }
+
+    def compare(self, baseline, results, tolerance):
+        """Print changes against baseline metrics, return the number of regressions"""
+        regressions = 0
+        self.stdout.write(f"Compared with the baseline (p95 tolerance {tolerance:g}%):")
+        for name, result in results.items():
+            if name not in baseline:
+                self.stdout.write(f"{name:<14}not in the baseline")
+                continue
+            old = baseline[name]
+            changes = []
+            growth = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0
+            regressed = growth > tolerance
+            changes.append(f"p95 {old['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms ({growth:+.0f}%)")
+            for metric in COUNTS:
+                if result[metric] != old[metric]:
+                    changes.append(f"{metric} {old[metric]} -> {result[metric]}")
+                    regressed = regressed or result[metric] > old[metric]
+            regressions += regressed
+            line = f"{name:<14}{'; '.join(changes)}"
+            self.stdout.write(self.style.ERROR(line + "  REGRESSION") if regressed else line)
+        return regressions
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import timeline
+from posts.models import User
+
+
+class Command(BaseCommand):
+    help = "Check that follow feed timelines match the follow graph"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="only check timeline of this username")
+        parser.add_argument(
+            '--repair', action='store_true', help="add missing and delete extra timeline entries")
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['user']:
+            users = users.filter(username=options['user'])
+
+        inconsistent = 0
+        for user_id, username in users.values_list('id', 'username').iterator():
+            missing, extra = timeline.check(user_id, repair=options['repair'])
+            if missing or extra:
+                inconsistent += 1
+                self.stdout.write(f"{username}: {len(missing)} missing, {len(extra)} extra")
+
+        if not inconsistent:
+            self.stdout.write(self.style.SUCCESS("All timelines are consistent"))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f"Repaired {inconsistent} timelines"))
+        else:
+            raise CommandError(f"{inconsistent} timelines are inconsistent, rerun with --repair")
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from posts import export
+
+
+class Command(BaseCommand):
+    help = ("Stream a table (groups, posts, comments or follows) as NDJSON or CSV. "
+            "Prints the watermark to pass as --since to continue the export later.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=list(export.TABLES))
+        parser.add_argument('--format', choices=export.FORMATS, default='ndjson')
+        parser.add_argument('--since', type=int, help="export rows with ids above this watermark")
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+        parser.add_argument('--output', help="file to write to instead of standard output")
+
+    def handle(self, *args, **options):
+        table = options['table']
+        self.watermark, self.count = options['since'], 0
+        rows = self.track(export.rows(table, options['since'], options['chunk_size']))
+        encode = export.ndjson_lines if options['format'] == 'ndjson' else export.csv_lines
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(encode(table, rows))
+        else:
+            for line in encode(table, rows):
+                self.stdout.write(line, ending='')
+        self.stderr.write(self.style.SUCCESS(
+            f"Exported {self.count} {table}, watermark: {self.watermark or 0}"))
+
+    def track(self, rows):
+        """Yield rows, remembering the id of the last one"""
+        for row in rows:
+            self.watermark = row[0]
+            self.count += 1
+            yield row
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from posts import images
+from posts.cache import bump
+from posts.models import Post
+from posts.signals import post_feeds
+
+
+class Command(BaseCommand):
+    help = "Store image dimensions and previews of posts uploaded before they were kept"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        # posts whose image can't be read are skipped, filled ones are not
+        # selected again, so the command can be rerun safely
+        posts = Post.objects.exclude(image='').filter(image_width=None).only(
+            'id', 'image', 'author', 'group').order_by('id')
+        filled = failed = 0
+        last_id = 0
+        while True:
+            batch = list(posts.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            updated = []
+            for post in batch:
+                try:
+                    with post.image.open() as file:
+                        post.image_width, post.image_height, post.image_placeholder = images.describe_file(file)
+                except (OSError, ValueError) as error:
+                    self.stderr.write(f"Post {post.id}: can't read {post.image.name}: {error}")
+                    failed += 1
+                    continue
+                updated.append(post)
+            Post.objects.bulk_update(updated, ['image_width', 'image_height', 'image_placeholder'])
+            # bulk_update() sends no signals, cached feeds are invalidated here
+            bump(*{scope for post in updated for scope in post_feeds(post)})
+            filled += len(updated)
+        self.stdout.write(self.style.SUCCESS(f"Filled image fields of {filled} posts, {failed} failed"))
@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from posts import thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = "Generate missing thumbnails of all post images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.THUMBNAIL_WORKERS,
+                            help="number of threads, 0 generates thumbnails in the main thread")
+
+    def handle(self, *args, **options):
+        names = Post.objects.exclude(image='').order_by('id').values_list('image', flat=True)
+        count = 0
+        if options['workers']:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                # existing thumbnails are only looked up, so the command can be rerun safely
+                for _ in executor.map(thumbnails.generate_in_thread, names.iterator()):
+                    count += 1
+        else:
+            for name in names.iterator():
+                thumbnails.generate(name)
+                count += 1
+        self.stdout.write(self.style.SUCCESS(f"Generated thumbnails of {count} images"))
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from posts import bulk_import, export
+
+
+class Command(BaseCommand):
+    help = ("Bulk import NDJSON or CSV files written by export_data. Tables are imported "
+            "in the order groups, posts, comments, follows; counters, timelines and "
+            "indexes are rebuilt once at the end.")
+
+    def add_arguments(self, parser):
+        for table in export.TABLES:
+            parser.add_argument(f'--{table}', metavar='FILE', help=f"file with {table} to import")
+        parser.add_argument('--format', choices=export.FORMATS, default='ndjson')
+        parser.add_argument('--batch-size', type=int, default=bulk_import.BATCH_SIZE,
+                            help="rows written by one INSERT")
+        parser.add_argument('--commit-every', type=int, default=bulk_import.COMMIT_EVERY,
+                            help="rows written by one transaction")
+        parser.add_argument('--create-users', action='store_true',
+                            help="create missing authors instead of skipping their rows")
+
+    def handle(self, *args, **options):
+        importer = bulk_import.Importer(
+            options['batch_size'], options['commit_every'], options['create_users'])
+        for table in export.TABLES:
+            if not options[table]:
+                continue
+            start = time.perf_counter()
+            with open(options[table], encoding='utf-8', newline='') as file:
+                count = importer.load(table, bulk_import.read_rows(file, options['format']))
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f"Imported {count} {table} in {elapsed:.1f} s, {count / max(elapsed, 0.001):.0f} rows/s")
+
+        start = time.perf_counter()
+        importer.finish()
+        self.stdout.write(f"Rebuilt counters, timelines and indexes in {time.perf_counter() - start:.1f} s")
+        if importer.skipped:
+            self.stdout.write(self.style.WARNING(
+                f"Skipped {importer.skipped} rows referring to missing users or posts, "
+                f"or following themselves"))
+        if importer.present:
+            self.stdout.write(f"Skipped {importer.present} rows imported before")
+        self.stdout.write(self.style.SUCCESS("Import finished"))
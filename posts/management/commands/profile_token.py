@@ -0,0 +1,13 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from posts import profiling
+
+
+class Command(BaseCommand):
+    help = "Print a token which enables profiling of requests sent with it in the X-Profile header"
+
+    def handle(self, *args, **options):
+        self.stdout.write(profiling.make_token())
+        self.stderr.write(f"Valid for {settings.PROFILE_TOKEN_MAX_AGE} seconds, profiles are stored in "
+                          f"{settings.PROFILE_DIR}")
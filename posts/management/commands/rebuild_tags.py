@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from posts import tags
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hashtag and mention index and trending counters from texts of all posts"
+
+    def handle(self, *args, **options):
+        count = tags.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Indexed tags of {count} posts"))
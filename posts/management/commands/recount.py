@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import counters
+
+
+class Command(BaseCommand):
+    help = "Repair denormalized counters by recomputing them from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true', help="only report drift, do not repair it")
+
+    def handle(self, *args, **options):
+        comment_drift = counters.comment_count_drift()
+        stats_drift = counters.stats_drift()
+        self.stdout.write(f"Posts with wrong comment count: {comment_drift}")
+        self.stdout.write(f"Users with wrong or missing profile stats: {stats_drift}")
+        if options['check']:
+            if comment_drift or stats_drift:
+                raise CommandError("Counters have drifted, rerun without --check")
+            return
+        updated = counters.recount_comments()
+        self.stdout.write(self.style.SUCCESS(f"Recounted comments of {updated} posts"))
+        updated = counters.recount_stats()
+        self.stdout.write(self.style.SUCCESS(f"Recounted profile stats of {updated} users"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from posts.search import get_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of posts"
+
+    def handle(self, *args, **options):
+        count = get_backend().reindex()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} posts"))
@@ -0,0 +1,111 @@
+import random
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+
+from posts import bulk_import, images, thumbnails
+from posts.benchmark import (
+    create_users, popularity_weights, power_law_follows, synthetic_photo, synthetic_text)
+from posts.models import User, Post
+
+
+class Command(BaseCommand):
+    help = ("Fill the database with a synthetic dataset for benchmarks: users, a power-law "
+            "follow graph, groups, posts with hashtags, mentions and images, and comments. "
+            "Rows are written through the bulk importer, see import_data.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--follows', type=int, default=30, help="mean followings per user")
+        parser.add_argument('--alpha', type=float, default=1.5, help="power-law exponent of popularity")
+        parser.add_argument('--groups', type=int, default=20)
+        parser.add_argument('--posts-per-group', type=int, default=200)
+        parser.add_argument('--ungrouped-posts', type=int, default=2000)
+        parser.add_argument('--comments', type=float, default=3, help="mean comments per post")
+        parser.add_argument('--images', type=float, default=0.2, help="share of posts with an image")
+        parser.add_argument('--distinct-images', type=int, default=10,
+                            help="number of image files shared by posts with images")
+        parser.add_argument('--days', type=int, default=365, help="posts are spread over this many days")
+        parser.add_argument('--prefix', default='seed', help="prefix of usernames and group slugs")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        prefix = options['prefix']
+        user_ids = create_users(options['users'], prefix)
+        usernames = dict(User.objects.filter(id__in=user_ids).values_list('id', 'username'))
+        importer = bulk_import.Importer()
+        names = [usernames[user_id] for user_id in user_ids]
+        # authors post, and are commented and followed, in proportion to their popularity
+        weights = popularity_weights(len(names), options['alpha'])
+        self.stdout.write(f"Created {len(names)} users")
+
+        slugs = [f'{prefix}-group-{n}' for n in range(options['groups'])]
+        importer.load('groups', (
+            {'slug': slug, 'title': slug.replace('-', ' ').capitalize(), 'description': ''}
+            for slug in slugs))
+
+        image_names = self.create_images(rng, options['distinct_images']) if options['images'] else []
+        hashtags = [f'topic{n}' for n in range(50)]
+        now = timezone.now()
+        first_id = (Post.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+        post_groups = [slug for slug in slugs for _ in range(options['posts_per_group'])]
+        post_groups += [None] * options['ungrouped_posts']
+        rng.shuffle(post_groups)
+        post_ids = range(first_id, first_id + len(post_groups))
+        pub_dates = {}
+
+        def posts():
+            for post_id, slug in zip(post_ids, post_groups):
+                pub_dates[post_id] = now - timedelta(seconds=rng.randrange(options['days'] * 86400))
+                yield {
+                    'id': post_id,
+                    'author': rng.choices(names, weights)[0],
+                    'group': slug,
+                    'pub_date': pub_dates[post_id].isoformat(),
+                    'text': synthetic_text(rng, hashtags, names),
+                    'image': rng.choice(image_names) if image_names and rng.random() < options['images'] else '',
+                }
+
+        count = importer.load('posts', posts())
+        self.stdout.write(f"Created {count} posts")
+
+        def comments():
+            for post_id in post_ids:
+                for _ in range(int(rng.expovariate(1 / options['comments'])) if options['comments'] else 0):
+                    age = (now - pub_dates[post_id]).total_seconds()
+                    yield {
+                        'post': post_id,
+                        'author': rng.choices(names, weights)[0],
+                        'created': (pub_dates[post_id] + timedelta(seconds=rng.uniform(0, age))).isoformat(),
+                        'text': synthetic_text(rng, words=(2, 15)),
+                    }
+
+        count = importer.load('comments', comments())
+        self.stdout.write(f"Created {count} comments")
+
+        pairs = power_law_follows(user_ids, options['follows'], options['alpha'], rng)
+        count = importer.load('follows', (
+            {'user': usernames[user_id], 'author': usernames[author_id]} for user_id, author_id in pairs))
+        self.stdout.write(f"Created {count} follows")
+
+        importer.finish()
+        if image_names:
+            call_command('fill_image_fields', stdout=self.stdout, stderr=self.stderr)
+        self.stdout.write(self.style.SUCCESS("Seeded the database"))
+
+    def create_images(self, rng, count):
+        """Store ingested synthetic photos with their thumbnails, return their names"""
+        names = []
+        for n in range(count):
+            photo = synthetic_photo(1600, 1200, rng)
+            upload, _ = images.ingest(SimpleUploadedFile(f'seed{n}.jpg', photo, 'image/jpeg'))
+            name = default_storage.save('posts/' + upload.name, upload)
+            thumbnails.generate(name)
+            names.append(name)
+        return names
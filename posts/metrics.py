@@ -0,0 +1,280 @@
+"""Runtime metrics in the Prometheus text format.
+
+MetricsMiddleware records the latency, response size and SQL queries of
+every request, labelled by the URL name of its view and the status code.
+The {% cache %} tag counts hits and misses of feed fragments, and
+thumbnail workers the time spent generating thumbnails.
+
+Each thread writes its observations into its own shard, a dict no other
+thread writes to, so recording takes no locks; the shards are summed when
+metrics are scraped. With settings.METRICS_DIR set, every process also
+dumps its totals into a file there at most every METRICS_FLUSH_INTERVAL
+seconds, and the endpoint merges the files of all processes, so that any
+worker of a multi-process server reports metrics of the whole server.
+Files are named by process ids, so the directory mustn't be shared by
+servers on different hosts. A process removes its file when it exits,
+and files of processes which died without doing so are removed by the
+endpoint; their counters restart, which Prometheus treats as a reset.
+
+The endpoint only answers clients from settings.METRICS_ALLOWED_IPS.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponse
+
+COUNTER, HISTOGRAM = 'counter', 'histogram'
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Metric:
+    def __init__(self, name, kind, help_text, labels, buckets=()):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+
+    def size(self):
+        # histograms keep a count per bucket, then the sum and the count
+        return len(self.buckets) + 2 if self.kind == HISTOGRAM else 1
+
+
+REQUEST_DURATION = Metric('yatube_request_duration_seconds', HISTOGRAM, 'Time to respond to requests.',
+                          ('view', 'status'), TIME_BUCKETS)
+RESPONSE_SIZE = Metric('yatube_response_size_bytes', HISTOGRAM, 'Size of response bodies.',
+                       ('view', 'status'), SIZE_BUCKETS)
+DB_QUERIES = Metric('yatube_db_queries_total', COUNTER, 'SQL queries run by requests.',
+                    ('view', 'status'))
+DB_TIME = Metric('yatube_db_query_seconds_total', COUNTER, 'Time spent in SQL queries by requests.',
+                 ('view', 'status'))
+FRAGMENT_CACHE = Metric('yatube_fragment_cache_total', COUNTER,
+                        'Lookups of cached template fragments by result, hit or miss.',
+                        ('view', 'fragment', 'result'))
+THUMBNAIL_DURATION = Metric('yatube_thumbnail_generation_seconds', HISTOGRAM,
+                            'Time to generate all thumbnails of an image.', ('status',), TIME_BUCKETS)
+METRICS = {metric.name: metric for metric in (
+    REQUEST_DURATION, RESPONSE_SIZE, DB_QUERIES, DB_TIME, FRAGMENT_CACHE, THUMBNAIL_DURATION)}
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flushed = 0
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        # taken once per thread
+        with _shards_lock:
+            shard = _local.shard = {}
+            _shards.append(shard)
+    return shard
+
+
+def _values(metric, labels):
+    shard = _shard()
+    key = (metric.name, tuple(str(label) for label in labels))
+    values = shard.get(key)
+    if values is None:
+        values = shard[key] = [0] * metric.size()
+    return values
+
+
+def inc(metric, labels, amount=1):
+    """Add amount to a counter"""
+    _values(metric, labels)[0] += amount
+
+
+def observe(metric, labels, value):
+    """Record a value in a histogram"""
+    values = _values(metric, labels)
+    for i, bound in enumerate(metric.buckets):
+        if value <= bound:
+            values[i] += 1
+            break
+    # values over the last bound are only in the count
+    values[-2] += value
+    values[-1] += 1
+
+
+def _merge(totals, items):
+    for key, values in items:
+        total = totals.setdefault(key, [0] * len(values))
+        for i, value in enumerate(values):
+            total[i] += value
+
+
+def snapshot():
+    """Return {(metric name, label values): values} of this process"""
+    with _shards_lock:
+        shards = list(_shards)
+    totals = {}
+    for shard in shards:
+        # dict.copy() doesn't see a dict changing under it, unlike iteration
+        _merge(totals, shard.copy().items())
+    return totals
+
+
+def _process_file(pid):
+    return os.path.join(settings.METRICS_DIR, f'{pid}.json')
+
+
+def _is_alive(pid):
+    if os.name != 'posix':
+        # os.kill() terminates processes on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@atexit.register
+def _remove_own_file():
+    if _flushed and settings.METRICS_DIR:
+        _remove(_process_file(os.getpid()))
+
+
+def flush(force=False):
+    """Dump totals of this process into settings.METRICS_DIR, if it's set"""
+    global _flushed
+    if not settings.METRICS_DIR:
+        return
+    if not force and time.monotonic() - _flushed < settings.METRICS_FLUSH_INTERVAL:
+        return
+    # another thread is already flushing
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _flushed = time.monotonic()
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = _process_file(os.getpid())
+        with open(path + '.tmp', 'w') as output:
+            json.dump([[name, labels, values] for (name, labels), values in snapshot().items()], output)
+        os.replace(path + '.tmp', path)
+    finally:
+        _flush_lock.release()
+
+
+def collect():
+    """Return totals of this process, merged with other processes' files"""
+    totals = snapshot()
+    if settings.METRICS_DIR:
+        own = _process_file(os.getpid())
+        for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+            if path == own:
+                continue
+            pid = os.path.splitext(os.path.basename(path))[0]
+            if pid.isdigit() and not _is_alive(int(pid)):
+                _remove(path)
+                continue
+            try:
+                with open(path) as file:
+                    items = json.load(file)
+            except (OSError, ValueError):
+                continue
+            _merge(totals, (((name, tuple(labels)), values) for name, labels, values in items))
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def render(totals):
+    """Return totals in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS.values():
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for (name, labels), values in sorted(totals.items()):
+            if name != metric.name:
+                continue
+            labels = _labels(metric.labels, labels)
+            if metric.kind == COUNTER:
+                lines.append(f'{name}{{{labels}}} {values[0]!r}')
+                continue
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(metric.buckets, values):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}{separator}le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {values[-1]}')
+            lines.append(f'{name}_sum{{{labels}}} {values[-2]!r}')
+            lines.append(f'{name}_count{{{labels}}} {values[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def view_name(request):
+    """Return the label of the view of a request, bounded for unresolved URLs"""
+    match = getattr(request, 'resolver_match', None)
+    return (match.url_name or 'unnamed') if match is not None else 'unresolved'
+
+
+class QueryTimer:
+    """connection.execute_wrapper() hook counting and timing SQL queries"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.count += 1
+
+
+class MetricsMiddleware:
+    """Record metrics of every request, see the module docstring"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        labels = (view_name(request), response.status_code)
+        observe(REQUEST_DURATION, labels, time.perf_counter() - start)
+        # the size of streamed responses is unknown before they are sent
+        if not response.streaming:
+            observe(RESPONSE_SIZE, labels, len(response.content))
+        inc(DB_QUERIES, labels, queries.count)
+        inc(DB_TIME, labels, queries.time)
+        flush()
+        return response
+
+
+def metrics(request):
+    """Serve metrics to Prometheus"""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    return HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
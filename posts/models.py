@@ -26,7 +26,40 @@ class Post(models.Model):
         Group, on_delete=models.SET_NULL, related_name="post_group", 
         blank=True, null=True)
     image = models.ImageField(upload_to='posts/', blank=True, null=True)
-    
+    # dimensions and a tiny preview of the image, stored at upload time
+    # so that feeds never open image files (see images.py)
+    image_width = models.PositiveIntegerField(null=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, editable=False)
+    image_placeholder = models.TextField(blank=True, editable=False)
+    # number of comments, maintained by signals (see signals.py)
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        # feeds are sorted by (pub_date, id), optionally filtered by group or author
+        indexes = [
+            models.Index(fields=["pub_date", "id"]),
+            models.Index(fields=["group", "pub_date", "id"]),
+            models.Index(fields=["author", "pub_date", "id"]),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the group post was loaded with, to invalidate its feed
+        # when post is moved to another group
+        instance._loaded_group_id = instance.__dict__.get('group_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # comment_count is only changed with atomic UPDATEs (see counters.py),
+        # saving an edited post mustn't write back the value it was loaded with
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.attname for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'comment_count' and field.attname not in deferred]
+        super().save(*args, **kwargs)
+
     def __str__(self):
        return self.text
 
@@ -40,8 +73,79 @@ class Comment(models.Model):
     text = models.TextField()
     created = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # comments are listed per post by creation date
+        indexes = [models.Index(fields=["post", "created"])]
+
 
 class Follow(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="follower")
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="following")
-    
\ No newline at end of file
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "author"], name="unique_follow"),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """ post delivered to a follower's feed (fan-out on write) """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="timeline")
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="timeline_entries")
+    # copy of post.pub_date, so that a feed is read with a single range scan
+    # of the (user, pub_date, post) index
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("user", "post")
+        indexes = [models.Index(fields=["user", "pub_date", "post"])]
+
+
+class ProfileStats(models.Model):
+    """ counters displayed in user's profile, maintained by signals """
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="stats")
+    posts = models.PositiveIntegerField(default=0)
+    followers = models.PositiveIntegerField(default=0)
+    following = models.PositiveIntegerField(default=0)
+
+
+class Tag(models.Model):
+    """ hashtag or @mention found in texts of posts """
+    HASHTAG = "#"
+    MENTION = "@"
+    KIND_CHOICES = ((HASHTAG, "hashtag"), (MENTION, "mention"))
+
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    # hashtags are lowercase, mentions are usernames
+    name = models.CharField(max_length=150)
+
+    class Meta:
+        unique_together = ("kind", "name")
+
+    def __str__(self):
+        return self.kind + self.name
+
+
+class PostTag(models.Model):
+    """ post having a tag, the tag -> post index of tag feeds """
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name="post_tags")
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="post_tags")
+    # copy of post.pub_date, so that a tag feed is read with a single range
+    # scan of the (tag, pub_date, post) index, like a TimelineEntry
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("tag", "post")
+        indexes = [models.Index(fields=["tag", "pub_date", "post"])]
+
+
+class TagActivity(models.Model):
+    """ number of posts published with a tag during an hour, for trending tags """
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name="activity")
+    hour = models.DateTimeField()
+    posts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("tag", "hour")
+        indexes = [models.Index(fields=["hour", "tag"])]
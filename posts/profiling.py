@@ -0,0 +1,225 @@
+"""On-demand profiling of single requests.
+
+A request is profiled if it carries an X-Profile header with a token from
+make_token() (see the profile_token command), or ?profile=1 from a staff
+user. Wall time of the request is split between SQL queries, templates,
+cache calls, storage I/O and thumbnail lookups, each counted without the
+time of other sections nested in it, and the rest, which is Python code
+of the views. The breakdown is returned in a Server-Timing header, which
+browser developer tools display.
+
+Meanwhile a sampler thread records the request's Python stack every
+settings.PROFILE_SAMPLE_INTERVAL seconds. Samples are stored in
+settings.PROFILE_DIR in the folded format read by flamegraph.pl and
+speedscope, and the file name is returned in the X-Profile header.
+
+Templates, caches and storage are timed by wrappers installed once on their
+classes; they cost one thread-local lookup on requests which aren't profiled.
+"""
+import functools
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import get_storage_class
+from django.db import connection
+from django.template.base import Template
+from django.utils.module_loading import import_string
+
+SQL, TEMPLATE, CACHE, STORAGE, THUMBNAILS = 'sql', 'template', 'cache', 'storage', 'thumbnails'
+CATEGORIES = (SQL, TEMPLATE, CACHE, STORAGE, THUMBNAILS)
+TOKEN_SALT = 'posts.profiling'
+
+CACHE_METHODS = ('get', 'set', 'add', 'delete', 'get_many', 'set_many', 'delete_many',
+                 'incr', 'decr', 'touch', 'has_key')
+STORAGE_METHODS = ('open', 'save', 'exists', 'size', 'delete', 'listdir')
+
+_local = threading.local()
+_installed = False
+
+
+def make_token():
+    """Return a token which enables profiling in the X-Profile header"""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(uuid.uuid4().hex)
+
+
+def check_token(token):
+    """Return True if the token was made by make_token() and hasn't expired"""
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=settings.PROFILE_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def current():
+    """Return the Profile of the current request, or None if it isn't profiled"""
+    return getattr(_local, 'profile', None)
+
+
+class Profile:
+    """Time of a request spent in each category of sections"""
+
+    def __init__(self):
+        self.times = Counter()
+        self.counts = Counter()
+        # [category, start, time of nested sections] of open sections
+        self._stack = []
+        self.start = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def section(self, category):
+        start = time.perf_counter()
+        self._stack.append([category, start, 0.0])
+        try:
+            yield
+        finally:
+            _, _, nested = self._stack.pop()
+            elapsed = time.perf_counter() - start
+            self.times[category] += elapsed - nested
+            self.counts[category] += 1
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper() hook timing SQL queries
+        with self.section(SQL):
+            return execute(sql, params, many, context)
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header"""
+        metrics = [f'{category};dur={self.times[category] * 1000:.2f};desc="{self.counts[category]} calls"'
+                   for category in CATEGORIES if self.counts[category]]
+        app = self.total - sum(self.times.values())
+        metrics.append(f'app;dur={app * 1000:.2f}')
+        metrics.append(f'total;dur={self.total * 1000:.2f}')
+        return ', '.join(metrics)
+
+
+@contextmanager
+def section(category):
+    """Time a block of code if the request is profiled"""
+    profile = current()
+    if profile is None:
+        yield
+    else:
+        with profile.section(category):
+            yield
+
+
+def timed(category):
+    """Decorator timing calls of a function as sections of category"""
+    def decorator(func):
+        if getattr(func, 'profiled', False):
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = current()
+            if profile is None:
+                return func(*args, **kwargs)
+            with profile.section(category):
+                return func(*args, **kwargs)
+
+        wrapper.profiled = True
+        return wrapper
+    return decorator
+
+
+def _wrap_methods(cls, category, names):
+    for name in names:
+        method = getattr(cls, name, None)
+        if method is not None:
+            setattr(cls, name, timed(category)(method))
+
+
+def install():
+    """Install timing wrappers of templates, caches and storage, once"""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    # includes are rendered with Template.render() too
+    Template.render = timed(TEMPLATE)(Template.render)
+    for options in settings.CACHES.values():
+        _wrap_methods(import_string(options['BACKEND']), CACHE, CACHE_METHODS)
+    _wrap_methods(get_storage_class(), STORAGE, STORAGE_METHODS)
+
+
+class Sampler(threading.Thread):
+    """Thread counting folded Python stacks of another thread at an interval"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{frame.f_globals.get('__name__', '?')}.{code.co_name}")
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def save(stacks, name):
+    """Store folded stacks in settings.PROFILE_DIR, return the file name"""
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}.folded"
+    with open(os.path.join(settings.PROFILE_DIR, filename), 'w') as output:
+        output.writelines(f'{stack} {count}\n' for stack, count in stacks.items())
+    return filename
+
+
+class ProfilerMiddleware:
+    """Profile requests which ask for it, see the module docstring"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install()
+
+    def wanted(self, request):
+        token = request.META.get('HTTP_X_PROFILE')
+        if token:
+            return check_token(token)
+        return request.GET.get('profile') == '1' and request.user.is_staff
+
+    def __call__(self, request):
+        if not self.wanted(request):
+            return self.get_response(request)
+
+        profile = _local.profile = Profile()
+        sampler = Sampler(threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL)
+        sampler.start()
+        try:
+            with connection.execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            sampler.stop()
+            profile.finish()
+            _local.profile = None
+
+        match = request.resolver_match
+        response['Server-Timing'] = profile.server_timing()
+        response['X-Profile'] = save(sampler.stacks, match.url_name if match and match.url_name else 'request')
+        return response
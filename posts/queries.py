@@ -0,0 +1,136 @@
+"""Query budgets of views and detection of N+1 queries.
+
+QueryLog records every SQL statement run on a connection, grouped by its
+normalized shape: the statement with literals and IN lists collapsed, so
+that the same query for different rows has the same shape. A shape
+repeated settings.QUERY_REPEAT_THRESHOLD times in a request is most likely
+an N+1 query: a query per row of some list, which should be a join or a
+prefetch instead.
+
+QueryBudgetMiddleware records queries of every request and checks them
+against settings.QUERY_BUDGETS, the maximum number of queries of views by
+URL name. Depending on settings.QUERY_BUDGET_ACTION a view over its budget
+is logged or raises QueryBudgetExceeded, which makes tests fail; problems
+of views without a budget are always only logged.
+query_budget() checks the same in a block of test code.
+
+Queries run in a repeats_allowed() block count towards budgets, but are
+not reported as N+1 queries; they are repeated by design, e.g. an index
+seek per feed merged by utils.merged_slice().
+"""
+import logging
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LIST_RE = re.compile(r'\bIN \((?:%s|\?)(?:, (?:%s|\?))*\)')
+SPACE_RE = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """Return the shape of an SQL statement: literals and IN lists collapsed"""
+    sql = LITERAL_RE.sub('?', SPACE_RE.sub(' ', sql).strip())
+    return IN_LIST_RE.sub('IN (...)', sql)
+
+
+class QueryBudgetExceeded(Exception):
+    """A view ran more queries than its budget or repeated a query shape"""
+
+
+@contextmanager
+def repeats_allowed():
+    """Don't report queries run in the block as N+1 queries"""
+    depth = getattr(_local, 'repeats_allowed', 0)
+    _local.repeats_allowed = depth + 1
+    try:
+        yield
+    finally:
+        _local.repeats_allowed = depth
+
+
+class QueryLog:
+    """Context manager recording SQL statements run on a connection"""
+
+    def __init__(self, using=connection):
+        self.connection = using
+        self.statements = []
+        # statements checked for repeated shapes
+        self.checked = []
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.statements.append(sql)
+        if not getattr(_local, 'repeats_allowed', 0):
+            self.checked.append(sql)
+        return execute(sql, params, many, context)
+
+    def __len__(self):
+        return len(self.statements)
+
+    def shapes(self):
+        """Return a Counter of normalized shapes of statements checked for repeats"""
+        return Counter(normalize(sql) for sql in self.checked)
+
+    def repeated(self, threshold=None):
+        """Return {shape: count} of shapes run at least threshold times, N+1 suspects"""
+        threshold = threshold or settings.QUERY_REPEAT_THRESHOLD
+        return {shape: count for shape, count in self.shapes().items() if count >= threshold}
+
+    def problems(self, budget=None, threshold=None):
+        """Return descriptions of a budget overrun and of repeated shapes"""
+        problems = []
+        if budget is not None and len(self) > budget:
+            problems.append(f'{len(self)} queries, the budget is {budget}')
+        for shape, count in self.repeated(threshold).items():
+            problems.append(f'{count} queries of the same shape (N+1?): {shape}')
+        return problems
+
+
+class QueryBudgetMiddleware:
+    """Check queries of every request against the budget of its view"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryLog() as log:
+            response = self.get_response(request)
+        match = request.resolver_match
+        if match is None or not match.url_name:
+            return response
+        budget = settings.QUERY_BUDGETS.get(match.url_name)
+        problems = log.problems(budget)
+        if problems:
+            message = f"{match.url_name} ({request.path}): " + '; '.join(problems)
+            # views without a budget, e.g. of the admin, are only logged:
+            # raising would fail requests whose changes are already committed
+            if budget is not None and settings.QUERY_BUDGET_ACTION == 'raise':
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+
+@contextmanager
+def query_budget(budget, threshold=None):
+    """Fail if code in the block runs more than budget queries or repeats a shape"""
+    with QueryLog() as log:
+        yield log
+    problems = log.problems(budget, threshold)
+    if problems:
+        raise AssertionError('; '.join(problems) + '\n' + '\n'.join(log.statements))
@@ -0,0 +1,160 @@
+"""Full-text search over posts.
+
+Posts are indexed by a search backend, settings.SEARCH_BACKEND, when they
+are saved or deleted (see signals.py). The default backend keeps an SQLite
+FTS5 inverted index in the posts_post_fts virtual table. Other engines can
+be plugged in by subclassing SearchBackend.
+
+Results are ranked by relevance and paginated by a (rank, id) cursor.
+Ranks depend on statistics of the whole index, so pages read long after
+each other may skip or repeat a post, which is fine for search results.
+"""
+import base64
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Post
+
+# words of a query, everything else is ignored
+WORD_RE = re.compile(r'\w+')
+
+
+def encode_cursor(post):
+    """Return a cursor pointing right after the post in search results"""
+    value = f'{post.search_rank!r}|{post.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (rank, id) from a cursor or None if it is malformed"""
+    try:
+        value = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        rank, pk = value.split('|')
+        return float(rank), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class SearchBackend:
+    """Interface of search backends"""
+
+    def setup(self):
+        """Create the index if it doesn't exist"""
+
+    def index(self, post):
+        """Add the post to the index or update it"""
+        raise NotImplementedError
+
+    def remove(self, post_id):
+        """Remove the post from the index"""
+        raise NotImplementedError
+
+    def reindex(self):
+        """Rebuild the whole index, return the number of indexed posts"""
+        raise NotImplementedError
+
+    def filter(self, queryset, query):
+        """Return posts of the queryset matching the query, unordered"""
+        raise NotImplementedError
+
+    def search(self, query, group_id=None, author_id=None, after=None, limit=10):
+        """Return up to limit posts matching the query, most relevant first.
+
+        Every post has a search_rank, lower ranks are more relevant.
+        after is a (rank, id) pair from decode_cursor().
+        """
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """Search backend using an SQLite FTS5 table keyed by post id"""
+
+    table = 'posts_post_fts'
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+                f"USING fts5(text, tokenize='unicode61 remove_diacritics 2')")
+
+    def match_expression(self, query):
+        """Return an FTS5 query matching posts containing all words of the query.
+
+        Words are quoted, so users can't write FTS5 syntax, and the last one
+        matches as a prefix for search as you type.
+        """
+        words = WORD_RE.findall(query.lower())
+        if not words:
+            return None
+        return ' '.join(f'"{word}"' for word in words) + '*'
+
+    def index(self, post):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [post.pk])
+            cursor.execute(f"INSERT INTO {self.table} (rowid, text) VALUES (%s, %s)", [post.pk, post.text])
+
+    def remove(self, post_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [post_id])
+
+    def reindex(self):
+        self.setup()
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(f"INSERT INTO {self.table} (rowid, text) SELECT id, text FROM posts_post")
+            count = cursor.rowcount
+            # merge index segments written by the bulk insert
+            cursor.execute(f"INSERT INTO {self.table} ({self.table}) VALUES ('optimize')")
+        return count
+
+    def filter(self, queryset, query):
+        expression = self.match_expression(query)
+        if expression is None:
+            return queryset.none()
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s", [expression]))
+
+    def search(self, query, group_id=None, author_id=None, after=None, limit=10):
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+        table = self.table
+        sql = [f"SELECT {table}.rowid, {table}.rank FROM {table}",
+               f"JOIN posts_post p ON p.id = {table}.rowid",
+               f"WHERE {table} MATCH %s"]
+        params = [expression]
+        if group_id is not None:
+            sql.append("AND p.group_id = %s")
+            params.append(group_id)
+        if author_id is not None:
+            sql.append("AND p.author_id = %s")
+            params.append(author_id)
+        if after is not None:
+            sql.append(f"AND ({table}.rank > %s OR ({table}.rank = %s AND {table}.rowid > %s))")
+            params += [after[0], after[0], after[1]]
+        sql.append(f"ORDER BY {table}.rank, {table}.rowid LIMIT %s")
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(' '.join(sql), params)
+            ranks = dict(cursor.fetchall())
+
+        posts = Post.objects.filter(id__in=ranks).select_related('author', 'group')
+        posts = sorted(posts, key=lambda post: (ranks[post.id], post.id))
+        for post in posts:
+            post.search_rank = ranks[post.id]
+        return posts
+
+
+_backends = {}
+
+
+def get_backend():
+    """Return the configured search backend"""
+    path = settings.SEARCH_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
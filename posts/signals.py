@@ -0,0 +1,119 @@
+import threading
+
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from . import counters, tags, timeline
+from .search import get_backend as search_backend
+from .cache import bump, INDEX, GROUP, AUTHOR, POST, FOLLOWER
+from .models import User, Group, Post, Comment, Follow, ProfileStats
+
+# ids of posts being deleted by this thread; their comments, deleted by the
+# cascade first, don't need their counter and feeds updated one by one
+_deleting = threading.local()
+
+
+def deleting_posts():
+    if not hasattr(_deleting, 'post_ids'):
+        _deleting.post_ids = set()
+    return _deleting.post_ids
+
+
+def post_feeds(post):
+    """Return scopes of feeds which show the post"""
+    scopes = [(INDEX,), (AUTHOR, post.author_id), (POST, post.id)]
+    group_ids = {post.group_id, getattr(post, '_loaded_group_id', None)} - {None}
+    return scopes + [(GROUP, group_id) for group_id in group_ids]
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, **kwargs):
+    """Start counting profile stats of a new user"""
+    if created and not raw:
+        ProfileStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def group_changed(sender, instance, raw=False, **kwargs):
+    """Invalidate feeds and post pages showing group's title"""
+    if raw:
+        return
+    # posts show the title on profiles, post pages and follow feeds, too;
+    # a deleted group is looked up before its posts are detached from it
+    posts = list(Post.objects.filter(group_id=instance.id).values_list('id', 'author_id'))
+    author_ids = {author_id for _, author_id in posts}
+    bump((INDEX,), (GROUP, instance.id), *((AUTHOR, author_id) for author_id in author_ids),
+         *((POST, post_id) for post_id, _ in posts))
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, raw=False, **kwargs):
+    """Count a new post, deliver it to followers' timelines, index it and its tags and invalidate feeds"""
+    if raw:
+        return
+    search_backend().index(instance)
+    tags.update_post_tags(instance)
+    scopes = post_feeds(instance)
+    if created:
+        counters.change_stats(instance.author_id, posts=1)
+        scopes += [(FOLLOWER, user_id) for user_id in timeline.push_post(instance)]
+    bump(*scopes)
+    instance._loaded_group_id = instance.group_id
+
+
+@receiver(pre_delete, sender=Post)
+def post_deleting(sender, instance, **kwargs):
+    """Uncount tags of a post before its index entries are deleted"""
+    tags.remove_post_tags(instance)
+    deleting_posts().add(instance.pk)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    """Uncount a deleted post, remove it from search and invalidate feeds"""
+    deleting_posts().discard(instance.pk)
+    # the author may be being deleted too, so missing stats are not created
+    counters.change_stats(instance.author_id, create=False, posts=-1)
+    search_backend().remove(instance.pk)
+    bump(*post_feeds(instance))
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, raw=False, **kwargs):
+    """Count a new comment and invalidate feeds showing comment counts"""
+    if created and not raw:
+        counters.change_comment_count(instance.post_id, 1)
+        bump(*post_feeds(instance.post))
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    """Uncount a deleted comment, e.g. one deleted in admin"""
+    if instance.post_id in deleting_posts():
+        return
+    counters.change_comment_count(instance.post_id, -1)
+    post = Post.objects.filter(pk=instance.post_id).only('author', 'group').first()
+    if post is not None:
+        bump(*post_feeds(post))
+
+
+@receiver(post_save, sender=Follow)
+def follow_saved(sender, instance, created, raw=False, **kwargs):
+    """Count a new follower and fill their timeline with the author's posts"""
+    if created and not raw:
+        counters.change_stats(instance.user_id, following=1)
+        counters.change_stats(instance.author_id, followers=1)
+        pulled = timeline.followers_changed(instance.author_id, 1)
+        timeline.add_author(instance.user_id, instance.author_id, pulled)
+        bump((FOLLOWER, instance.user_id), (AUTHOR, instance.author_id), (AUTHOR, instance.user_id))
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    """Uncount a follower and remove the author's posts from their timeline"""
+    counters.change_stats(instance.user_id, create=False, following=-1)
+    counters.change_stats(instance.author_id, create=False, followers=-1)
+    timeline.remove_author(instance.user_id, instance.author_id)
+    timeline.followers_changed(instance.author_id, -1)
+    bump((FOLLOWER, instance.user_id), (AUTHOR, instance.author_id), (AUTHOR, instance.user_id))
@@ -0,0 +1,147 @@
+"""Log of slow SQL queries.
+
+SlowQueryMiddleware times every query of a request with an execute
+wrapper, unlike django's SQL logging doesn't keep queries in memory, and
+works without DEBUG. A query taking settings.SLOW_QUERY_THRESHOLD seconds
+or more is sampled with probability SLOW_QUERY_SAMPLE_RATE and logged as a
+JSON line to settings.SLOW_QUERY_LOG:
+
+    {"time": ..., "duration_ms": ..., "sql": normalized statement,
+     "params_hash": ..., "view": URL name, "frame": "posts/views.py:42 index"}
+
+frame is the innermost caller from settings.SLOW_QUERY_FRAMES, the code
+path of the application which ran the query. Lines are written by a
+background thread from a queue of at most SLOW_QUERY_QUEUE_SIZE records;
+records which don't fit are dropped and counted in the next written line.
+"""
+import hashlib
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .metrics import view_name
+from .queries import normalize
+
+logger = logging.getLogger(__name__)
+
+_queue = None
+_lock = threading.Lock()
+_dropped = 0
+
+
+def app_frame():
+    """Return 'path:line function' of the innermost application frame, or None"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename.replace('\\', '/')
+        for suffix in settings.SLOW_QUERY_FRAMES:
+            if filename.endswith(suffix):
+                return f'{suffix}:{frame.f_lineno} {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def params_hash(params):
+    """Return a short hash of query parameters, which may be private"""
+    return hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+
+
+def get_queue():
+    """Return the queue of records, starting its writer thread once"""
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = queue.Queue(settings.SLOW_QUERY_QUEUE_SIZE)
+            threading.Thread(target=_write, daemon=True, name='slowlog').start()
+        return _queue
+
+
+def _write():
+    global _dropped
+    while True:
+        items = [_queue.get()]
+        while True:
+            try:
+                items.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        with _lock:
+            dropped, _dropped = _dropped, 0
+        if dropped:
+            items[0][1]['dropped'] = dropped
+        # records are written to the log which was set when they were logged
+        logs = defaultdict(list)
+        for path, record in items:
+            logs[path].append(record)
+        try:
+            for path, records in logs.items():
+                with open(path, 'a') as output:
+                    for record in records:
+                        output.write(json.dumps(record) + '\n')
+        except OSError:
+            logger.exception('Failed to write %s slow queries', len(items))
+        finally:
+            for _ in items:
+                _queue.task_done()
+
+
+def flush():
+    """Wait until queued records are written"""
+    if _queue is not None:
+        _queue.join()
+
+
+class SlowQueryLogger:
+    """connection.execute_wrapper() hook logging slow queries of a request"""
+
+    def __init__(self, request):
+        self.request = request
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            if duration >= settings.SLOW_QUERY_THRESHOLD and random.random() < settings.SLOW_QUERY_SAMPLE_RATE:
+                self.log(sql, params, many, duration)
+
+    def log(self, sql, params, many, duration):
+        global _dropped
+        record = {
+            'time': timezone.now().isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'sql': normalize(sql),
+            'params_hash': params_hash(params),
+            'many': many,
+            'view': view_name(self.request),
+            'frame': app_frame(),
+        }
+        try:
+            get_queue().put_nowait((settings.SLOW_QUERY_LOG, record))
+        except queue.Full:
+            # requests of several threads may be dropping records at once
+            with _lock:
+                _dropped += 1
+
+
+class SlowQueryMiddleware:
+    """Log slow queries of every request, see the module docstring"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.SLOW_QUERY_LOG:
+            return self.get_response(request)
+        with connection.execute_wrapper(SlowQueryLogger(request)):
+            return self.get_response(request)
@@ -0,0 +1,150 @@
+"""Hashtags and @mentions of posts.
+
+Tags are extracted from the text when a post is saved (see signals.py) and
+stored in PostTag, the tag -> post index which tag feeds page through by
+(pub_date, post) like timelines. TagActivity counts posts published with
+each tag per hour, so trending tags are found by summing a day of hourly
+counters instead of scanning texts of posts.
+"""
+import re
+from collections import Counter
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import User, Post, Tag, PostTag, TagActivity
+from .utils import chunks
+
+# '&' is excluded, so that character references like &#39; aren't hashtags
+HASHTAG_RE = re.compile(r'(?<![\w&])#(\w{1,150})')
+MENTION_RE = re.compile(r'(?<![\w@])@([\w.@+-]{1,150})')
+# trending tags are the most used ones during this many last hours
+TRENDING_HOURS = 24
+
+
+def parse(text):
+    """Return (hashtags, mentioned usernames) found in the text"""
+    hashtags = {name.lower() for name in HASHTAG_RE.findall(text)}
+    # usernames may end with '.', which usually ends a sentence instead
+    mentioned = {name.rstrip('.') for name in MENTION_RE.findall(text)}
+    return hashtags, mentioned
+
+
+def extract(text):
+    """Return {(kind, name)} of hashtags and mentions in the text.
+
+    Only mentions of existing users count.
+    """
+    hashtags, mentioned = parse(text)
+    tags = {(Tag.HASHTAG, name) for name in hashtags}
+    if mentioned:
+        usernames = User.objects.filter(username__in=mentioned).values_list('username', flat=True)
+        tags |= {(Tag.MENTION, username) for username in usernames}
+    return tags
+
+
+def get_tag_ids(tags):
+    """Return {(kind, name): id} of the tags, creating missing ones"""
+    tag_ids = {}
+    for kind in (Tag.HASHTAG, Tag.MENTION):
+        names = [name for tag_kind, name in tags if tag_kind == kind]
+        if not names:
+            continue
+        Tag.objects.bulk_create((Tag(kind=kind, name=name) for name in names), ignore_conflicts=True)
+        tag_ids.update({
+            (kind, name): tag_id
+            for name, tag_id in Tag.objects.filter(kind=kind, name__in=names).values_list('name', 'id')})
+    return tag_ids
+
+
+def hour_of(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def change_activity(tag_ids, hour, delta):
+    """Atomically add delta to the tags' post counters of the hour"""
+    if not tag_ids:
+        return
+    updated = TagActivity.objects.filter(tag_id__in=tag_ids, hour=hour).update(posts=F('posts') + delta)
+    if updated < len(tag_ids) and delta > 0:
+        existing = set(TagActivity.objects.filter(tag_id__in=tag_ids, hour=hour).values_list('tag_id', flat=True))
+        for tag_id in set(tag_ids) - existing:
+            try:
+                with transaction.atomic():
+                    TagActivity.objects.create(tag_id=tag_id, hour=hour, posts=delta)
+            except IntegrityError:
+                # counter was created concurrently
+                TagActivity.objects.filter(tag_id=tag_id, hour=hour).update(posts=F('posts') + delta)
+
+
+def update_post_tags(post):
+    """Bring the post's tags in line with its text"""
+    tag_ids = get_tag_ids(extract(post.text))
+    wanted = set(tag_ids.values())
+    existing = set(PostTag.objects.filter(post=post).values_list('tag_id', flat=True))
+    added, removed = wanted - existing, existing - wanted
+    if removed:
+        PostTag.objects.filter(post=post, tag_id__in=removed).delete()
+    PostTag.objects.bulk_create(
+        (PostTag(tag_id=tag_id, post_id=post.pk, pub_date=post.pub_date) for tag_id in added),
+        ignore_conflicts=True)
+    hour = hour_of(post.pub_date)
+    change_activity(added, hour, 1)
+    change_activity(removed, hour, -1)
+
+
+def remove_post_tags(post):
+    """Uncount tags of a post which is being deleted"""
+    tag_ids = list(PostTag.objects.filter(post=post).values_list('tag_id', flat=True))
+    change_activity(tag_ids, hour_of(post.pub_date), -1)
+
+
+def tag_posts(tag):
+    """Return posts having the tag.
+
+    feed_date and feed_id mirror the index entry's (pub_date, post)
+    columns, which lets pagination seek on the (tag, pub_date, post) index.
+    """
+    return Post.objects.filter(post_tags__tag=tag).annotate(
+        feed_date=F('post_tags__pub_date'), feed_id=F('post_tags__post_id'))
+
+
+def trending(limit=10, hours=TRENDING_HOURS):
+    """Return hashtags used in most posts during the last hours, with their post counts"""
+    since = hour_of(timezone.now()) - timedelta(hours=hours - 1)
+    return list(Tag.objects.filter(kind=Tag.HASHTAG, activity__hour__gte=since).annotate(
+        recent_posts=Sum('activity__posts')).filter(recent_posts__gt=0).order_by(
+        '-recent_posts', 'name')[:limit])
+
+
+def rebuild(chunk_size=2000):
+    """Recompute the tag index and activity counters of all posts"""
+    PostTag.objects.all().delete()
+    TagActivity.objects.all().delete()
+    activity = Counter()
+    count = 0
+    posts = Post.objects.order_by().values_list('id', 'text', 'pub_date')
+    for chunk in chunks(posts.iterator(chunk_size=chunk_size), chunk_size):
+        parsed = {post_id: parse(text) for post_id, text, _ in chunk}
+        # one query for mentions of the whole chunk
+        usernames = set(User.objects.filter(
+            username__in=set().union(*(mentioned for _, mentioned in parsed.values()))
+        ).values_list('username', flat=True))
+        tags = {
+            post_id: {(Tag.HASHTAG, name) for name in hashtags} |
+                     {(Tag.MENTION, name) for name in mentioned & usernames}
+            for post_id, (hashtags, mentioned) in parsed.items()}
+        tag_ids = get_tag_ids(set().union(*tags.values()))
+        entries = [
+            PostTag(tag_id=tag_ids[tag], post_id=post_id, pub_date=pub_date)
+            for post_id, _, pub_date in chunk for tag in tags[post_id]]
+        PostTag.objects.bulk_create(entries)
+        activity.update((entry.tag_id, hour_of(entry.pub_date)) for entry in entries)
+        count += len(chunk)
+    TagActivity.objects.bulk_create(
+        TagActivity(tag_id=tag_id, hour=hour, posts=number)
+        for (tag_id, hour), number in activity.items())
+    return count
+
@@ -0,0 +1,52 @@
+from django import template
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.templatetags.cache import CacheNode, do_cache
+
+from posts import metrics
+from posts.cache import get_or_compute
+
+register = template.Library()
+
+
+class SingleFlightCacheNode(CacheNode):
+    """{% cache %} node which coalesces concurrent renders of a missing fragment"""
+
+    def render(self, context):
+        expire_time = self.expire_time_var.resolve(context)
+        if expire_time is not None:
+            try:
+                expire_time = int(expire_time)
+            except (ValueError, TypeError):
+                raise template.TemplateSyntaxError(
+                    '"cache" tag got a non-integer timeout value: %r' % expire_time)
+        if self.cache_name:
+            fragment_cache = caches[self.cache_name.resolve(context)]
+        else:
+            try:
+                fragment_cache = caches['template_fragments']
+            except InvalidCacheBackendError:
+                fragment_cache = caches['default']
+
+        vary_on = [var.resolve(context) for var in self.vary_on]
+        cache_key = make_template_fragment_key(self.fragment_name, vary_on)
+        rendered = []
+
+        def compute():
+            rendered.append(True)
+            return self.nodelist.render(context)
+
+        content = get_or_compute(cache_key, compute, expire_time, cache=fragment_cache)
+        request = context.get('request')
+        metrics.inc(metrics.FRAGMENT_CACHE, (
+            metrics.view_name(request) if request is not None else 'none',
+            self.fragment_name, 'miss' if rendered else 'hit'))
+        return content
+
+
+@register.tag('cache')
+def do_feed_cache(parser, token):
+    """Same as django's {% cache %}, protected from cache stampedes"""
+    node = do_cache(parser, token)
+    return SingleFlightCacheNode(
+        node.nodelist, node.expire_time_var, node.fragment_name, node.vary_on, node.cache_name)
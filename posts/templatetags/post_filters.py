@@ -1,5 +1,10 @@
 from django import template
 from django.template.defaultfilters import stringfilter
+from django.urls import reverse
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
+
+from posts.tags import HASHTAG_RE
 
 register = template.Library()
 
@@ -8,6 +13,17 @@ register = template.Library()
 def addclass(field, css):
     return field.as_widget(attrs={'class': css})
 
+@register.filter
+def tag_links(value):
+    """ escape text and link hashtags in it to their feeds """
+    parts, end = [], 0
+    for match in HASHTAG_RE.finditer(value):
+        parts.append(escape(value[end:match.start()]))
+        parts.append(format_html('<a href="{}">#{}</a>', reverse('tag', args=[match.group(1).lower()]), match.group(1)))
+        end = match.end()
+    parts.append(escape(value[end:]))
+    return mark_safe(''.join(parts))
+
 @register.filter
 def russianplural(value):
     value = int(value)
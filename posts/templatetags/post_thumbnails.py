@@ -0,0 +1,19 @@
+from django import template
+
+from posts import thumbnails
+
+register = template.Library()
+
+
+@register.simple_tag
+def prefetch_thumbnails(page):
+    """Attach thumbnails to all posts of the page, see thumbnails.prefetch()"""
+    thumbnails.prefetch(page)
+    return ''
+
+
+@register.simple_tag
+def prefetch_thumbnail(post):
+    """Attach thumbnails to a single post, like prefetch_thumbnails"""
+    thumbnails.prefetch([post])
+    return ''
@@ -1,16 +1,35 @@
-from django.test import TestCase, Client, override_settings
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
 from posts.models import *
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.core.cache import cache
 from django.core.cache.utils import make_template_fragment_key
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from posts import tags, timeline
+from posts.utils import encode_cursor, COMMENTS_PER_PAGE
+from posts.cache import feed_version, get_or_compute, INDEX
+from posts.queries import normalize, query_budget, repeats_allowed, QueryLog, QueryBudgetExceeded
+from posts.profiling import make_token
+from posts import metrics, slowlog, thumbnails
 
 # import django.utils.html.escape to account for special characters
 # which are escaped by default in template variables
 # https://code.djangoproject.com/wiki/AutoEscaping
 from django.utils.html import escape
 from PIL import Image
+from sorl.thumbnail.models import KVStore as KVStoreModel
+from io import BytesIO, StringIO
+import json
+import os
+import queue
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+from unittest import mock
 
 TEST_CACHE = {
     'default': {
@@ -18,6 +37,13 @@ TEST_CACHE = {
     }
 }
 
+LOCMEM_CACHE = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'posts-tests',
+    }
+}
+
 @override_settings(CACHES=TEST_CACHE)
 class PostsTest(TestCase):
     def _create_image(self):
@@ -226,6 +252,7 @@ class PostsTest(TestCase):
         
 class TestCache(TestCase):
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user(
             username='sarah', 
             email='connor.s@skynet.com', 
@@ -235,26 +262,1262 @@ class TestCache(TestCase):
 
     def test_index_cache_key(self):
         """ test that there is cache with key 'index_page' """
-        key = make_template_fragment_key('index_page', [1])
         self.client.get('/')
+        key = make_template_fragment_key('index_page', [1, self.user.id, feed_version((INDEX,))])
         self.assertTrue(bool(cache.get(key)), 'no data in cache under key "index_page"')
         cache.clear()
         self.assertFalse(bool(cache.get(key)), 'cache not cleared')
     
     def test_index_cache(self):
-        """ test that changes appear on index page only after cache is cleared """
+        """ test that cached index page is invalidated as soon as a post is added """
         response = self.client.get('/')
         self.client.post('/new/', {'text': 'There is no fate but what we make for ourselves.'})
         response = self.client.get('/')
-        self.assertNotContains(
+        self.assertContains(
             response, 
             'There is no fate but what we make for ourselves.', 
-            msg_prefix="index page not cached")
+            msg_prefix="new post does not appear on cached index page")
+
+    def test_index_cache_per_user(self):
+        """ test that links shown to the author are not served to others from the cache """
+        post = Post.objects.create(text='Come with me if you want to live.', author=self.user)
+        edit_url = f'/sarah/{post.id}/edit/'
+        self.assertContains(self.client.get('/'), edit_url)
+        # the phrase is also in an HTML comment of post_item.html
+        self.assertContains(self.client.get('/'), 'Добавить комментарий', count=2)
+
+        anonymous = Client()
+        response = anonymous.get('/')
+        self.assertNotContains(response, edit_url)
+        self.assertContains(response, 'Добавить комментарий', count=1)
+        self.assertContains(response, '0 комментари')
+
+        User.objects.create_user(username='reese', password='12345')
+        other = Client()
+        other.login(username='reese', password='12345')
+        response = other.get('/')
+        self.assertContains(response, 'Come with me if you want to live.')
+        self.assertNotContains(response, edit_url)
+
+    def test_cache_hit_queries(self):
+        """ test that pages served from the fragment cache don't fetch their posts """
+        author = User.objects.create_user(username='T-800', password='illbeback')
+        Follow.objects.create(user=self.user, author=author)
+        for i in range(15):
+            Post.objects.create(text=f'post {i}', author=author, group=Group.objects.create(slug=f'g{i}'))
+        after = encode_cursor(Post.objects.order_by('-pub_date', '-id')[3])
+        for url, hit_queries in (('/', 2), (f'/?after={after}', 2), ('/follow/', 4), (f'/follow/?after={after}', 4)):
+            with CaptureQueriesContext(connection) as miss:
+                self.client.get(url)
+            with CaptureQueriesContext(connection) as hit:
+                response = self.client.get(url)
+            self.assertContains(response, 'post 1')
+            # session, user, then on the follow page the pulled authors
+            # and ids of authors of the page; feeds are never counted
+            self.assertEqual(len(hit), hit_queries, url + '\n' + '\n'.join(q['sql'] for q in hit))
+            self.assertLess(len(hit), len(miss), url)
+
+    def test_follow_cache(self):
+        """ test that cached follow page belongs to its user and follows their subscriptions """
+        author = User.objects.create_user(username='T-800', password='illbeback')
+        reader = User.objects.create_user(username='reese', password='12345')
+        Follow.objects.create(user=self.user, author=author)
+        Post.objects.create(text='I need your clothes, your boots and your motorcycle.', author=author)
+        response = self.client.get('/follow/')
+        self.assertContains(response, 'I need your clothes')
+
+        self.client.login(username='reese', password='12345')
+        response = self.client.get('/follow/')
+        self.assertNotContains(response, 'I need your clothes',
+            msg_prefix="follow page of one user is served to another")
+        Follow.objects.create(user=reader, author=author)
+        response = self.client.get('/follow/')
+        self.assertContains(response, 'I need your clothes',
+            msg_prefix="follow page is not invalidated by a new subscription")
+
+        Comment.objects.create(post=Post.objects.get(), author=reader, text="I'll be back")
+        response = self.client.get('/follow/')
+        self.assertContains(response, '1 комментарий',
+            msg_prefix="follow page is not invalidated by a new comment")
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestKeysetPagination(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='sarah', email='connor.s@skynet.com', password='12345')
+        for i in range(25):
+            Post.objects.create(text=f'post {i}', author=self.user)
+
+    def test_cursor_pages(self):
+        """ test that following ?after= cursors walks the whole feed exactly once """
+        seen = []
+        response = self.client.get('/')
+        seen += [post.id for post in response.context['page']]
+        while response.context['page'].next_cursor:
+            response = self.client.get(f"/?after={response.context['page'].next_cursor}")
+            self.assertIsNone(response.context['paginator'], 'cursor pages must not count rows')
+            seen += [post.id for post in response.context['page']]
+        expected = list(Post.objects.order_by('-pub_date', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected, 'cursor pages skip or repeat posts')
+
+        # step back from the last page
+        previous = self.client.get(f"/?before={response.context['page'].previous_cursor}")
+        self.assertEqual([post.id for post in previous.context['page']], expected[10:20])
+
+    def test_page_numbers(self):
+        """ test that old ?page= links still work """
+        response = self.client.get('/sarah/?page=2')
+        self.assertEqual(response.context['page'].number, 2)
+        self.assertEqual(len(response.context['page']), 10)
+
+    def test_first_page_not_counted(self):
+        """ test that first pages of feeds don't count all posts """
+        for url in ('/', '/sarah/', '/?page=1', '/?page=garbage'):
+            with self.subTest(url=url):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                self.assertEqual(len(response.context['page']), 10)
+                self.assertContains(response, f"?after={response.context['page'].next_cursor}")
+                self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+    def test_bad_cursor(self):
+        """ test that a malformed cursor falls back to the first page """
+        response = self.client.get('/?after=garbage')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page'].number, 1)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestTimeline(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='sarah', email='connor.s@skynet.com', password='12345')
+        self.follower = User.objects.create_user(
+            username='T-800', email='terminator@skynet.com', password='illbeback')
+        self.old_post = Post.objects.create(text='Judgment day is inevitable.', author=self.user)
+        self.client.login(username='T-800', password='illbeback')
+
+    def test_fan_out(self):
+        """ test that timeline follows posts and the follow graph """
+        self.client.get('/sarah/follow')
+        self.assertTrue(
+            TimelineEntry.objects.filter(user=self.follower, post=self.old_post).exists(),
+            'posts of a followed author are not copied to the timeline')
+
+        new_post = Post.objects.create(text='No fate.', author=self.user)
+        response = self.client.get('/follow/')
+        self.assertEqual(list(response.context['page']), [new_post, self.old_post])
+
+        response = self.client.get(f'/follow/?after={encode_cursor(new_post)}')
+        self.assertEqual(list(response.context['page']), [self.old_post])
+
+        self.client.get('/sarah/unfollow')
+        self.assertFalse(
+            TimelineEntry.objects.filter(user=self.follower).exists(),
+            'posts of an unfollowed author remain in the timeline')
+
+    def test_check_timelines(self):
+        """ test that check_timelines finds and repairs inconsistent timelines """
+        Follow.objects.create(user=self.follower, author=self.user)
+        TimelineEntry.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('check_timelines', stdout=StringIO())
+        call_command('check_timelines', repair=True, stdout=StringIO())
+        call_command('check_timelines', stdout=StringIO())
+        self.assertEqual(timeline.actual_post_ids(self.follower.id), {self.old_post.id})
+
+    @override_settings(FEED_DELIVERY='hybrid', FEED_FANOUT_THRESHOLD=1)
+    def test_hybrid(self):
+        """ test that posts of popular authors are pulled and merged into the timeline """
+        reese = User.objects.create_user(username='reese', password='12345')
+        Follow.objects.create(user=self.follower, author=self.user)
+        Follow.objects.create(user=reese, author=self.user)
+        Follow.objects.create(user=self.follower, author=reese)
+
+        pulled = Post.objects.create(text='Come with me if you want to live.', author=self.user)
+        pushed = Post.objects.create(text='The future is not set.', author=reese)
+        self.assertFalse(TimelineEntry.objects.filter(post=pulled).exists(),
+            'posts of authors above the threshold must not be pushed')
+        self.assertTrue(TimelineEntry.objects.filter(user=self.follower, post=pushed).exists())
+
+        expected = [pushed, pulled, self.old_post]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/follow/')
+            self.assertEqual(list(response.context['page']), expected)
+        # the first page merges the timeline and pulled authors' feeds, too,
+        # instead of sorting posts matching either of them
+        self.assertFalse([query['sql'] for query in queries if ' OR ' in query['sql']])
+        response = self.client.get(f'/follow/?after={encode_cursor(pushed)}')
+        self.assertEqual(list(response.context['page']), expected[1:])
+
+    @override_settings(FEED_DELIVERY='hybrid', FEED_FANOUT_THRESHOLD=1)
+    def test_hybrid_threshold_crossing(self):
+        """ test that timelines are pruned and backfilled when an author crosses the threshold """
+        reese = User.objects.create_user(username='reese', password='12345')
+        Follow.objects.create(user=self.follower, author=self.user)
+        self.assertEqual(timeline.actual_post_ids(self.follower.id), {self.old_post.id})
+
+        # rising above the threshold, the author's posts are pulled
+        Follow.objects.create(user=reese, author=self.user)
+        self.assertFalse(TimelineEntry.objects.filter(post__author=self.user).exists(),
+            'pushed posts of an author above the threshold remain in timelines')
+        self.assertEqual(timeline.check(self.follower.id), (set(), set()))
+        response = self.client.get('/follow/')
+        self.assertEqual(list(response.context['page']), [self.old_post])
+
+        # dropping back to the threshold, they are pushed again
+        new_post = Post.objects.create(text='No fate.', author=self.user)
+        Follow.objects.filter(user=reese).delete()
+        self.assertEqual(timeline.actual_post_ids(self.follower.id), {self.old_post.id, new_post.id},
+            'posts of an author dropping to the threshold are missing from timelines')
+        self.assertEqual(timeline.check(self.follower.id), (set(), set()))
+        response = self.client.get('/follow/')
+        self.assertEqual(list(response.context['page']), [new_post, self.old_post])
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestCommentCount(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='sarah', email='connor.s@skynet.com', password='12345')
+        self.post = Post.objects.create(text='Judgment day is inevitable.', author=self.user)
+        self.client.login(username='sarah', password='12345')
+
+    def test_comment_count(self):
+        """ test that comment counter follows added and deleted comments """
+        for text in ('first', 'second'):
+            self.client.post(f'/sarah/{self.post.id}/comment/', {'text': text})
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 2)
+        response = self.client.get('/')
+        self.assertContains(response, '2 комментария')
+
+        Comment.objects.filter(text='first').delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+
+    def test_save_keeps_counter(self):
+        """ test that saving a post loaded before a comment doesn't reset its counter """
+        post = Post.objects.get(id=self.post.id)
+        Comment.objects.create(post=self.post, author=self.user, text='first')
+        post.text = 'Edited'
+        post.save()
+        self.client.post(f'/sarah/{self.post.id}/edit/', {'text': 'Edited again'})
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.text, self.post.comment_count), ('Edited again', 1))
+
+    def test_delete_commented_post(self):
+        """ test that comments deleted with their post don't cost queries each """
+        def delete_post(comments):
+            post = Post.objects.create(text='Deleted', author=self.user)
+            for i in range(comments):
+                Comment.objects.create(post=post, author=self.user, text=f'comment {i}')
+            with CaptureQueriesContext(connection) as queries:
+                post.delete()
+            return len(queries)
+
+        self.assertEqual(delete_post(20), delete_post(1))
+        Comment.objects.create(post=self.post, author=self.user, text='kept')
+        Comment.objects.get().delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 0)
+
+    def test_recount(self):
+        """ test that recount repairs drifted counters """
+        Comment.objects.create(post=self.post, author=self.user, text='first')
+        Post.objects.update(comment_count=5)
+        with self.assertRaises(CommandError):
+            call_command('recount', check=True, stdout=StringIO())
+        call_command('recount', stdout=StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestProfileStats(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='sarah', email='connor.s@skynet.com', password='12345')
+        self.follower = User.objects.create_user(
+            username='T-800', email='terminator@skynet.com', password='illbeback')
+
+    def test_stats(self):
+        """ test that profile stats follow posts and the follow graph """
+        post = Post.objects.create(text='No fate.', author=self.user)
+        Post.objects.create(text='Judgment day is inevitable.', author=self.user)
+        Follow.objects.create(user=self.follower, author=self.user)
+        post.delete()
+        response = self.client.get('/sarah/')
+        stats = response.context['profile'].stats
+        self.assertEqual((stats.posts, stats.followers, stats.following), (1, 1, 0))
+
+        Follow.objects.all().delete()
+        self.follower.stats.refresh_from_db()
+        self.assertEqual(self.follower.stats.following, 0)
+
+    def test_recount(self):
+        """ test that recount creates missing and repairs drifted stats """
+        Post.objects.create(text='No fate.', author=self.user)
+        Follow.objects.create(user=self.follower, author=self.user)
+        ProfileStats.objects.filter(user=self.user).update(posts=7)
+        ProfileStats.objects.filter(user=self.follower).delete()
+        with self.assertRaises(CommandError):
+            call_command('recount', check=True, stdout=StringIO())
+        call_command('recount', stdout=StringIO())
+        call_command('recount', check=True, stdout=StringIO())
+        self.assertEqual(ProfileStats.objects.get(user=self.follower).following, 1)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestQueryPlans(TestCase):
+    """ test that every query of the feeds is served by an index """
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='sarah', email='connor.s@skynet.com', password='12345')
+        self.follower = User.objects.create_user(
+            username='T-800', email='terminator@skynet.com', password='illbeback')
+        self.group = Group.objects.create(title='Resistance', slug='resistance', description='-')
+        Follow.objects.create(user=self.follower, author=self.user)
+        for i in range(15):
+            post = Post.objects.create(text=f'post {i}', author=self.user, group=self.group)
+            Comment.objects.create(post=post, author=self.follower, text=f'comment {i}')
+        self.post = post
+        self.client.login(username='T-800', password='illbeback')
+
+    def _plans(self, url):
+        """ return (query plan step, query) pairs of SELECT queries of a page """
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        plans = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                if not query['sql'].startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plans += [(row[-1], query['sql']) for row in cursor.fetchall()]
+        return plans
+
+    def test_query_plans(self):
+        """ test that no query scans a whole table or sorts in a temp B-tree """
+        cursor = encode_cursor(self.post)
+        for url in ('/', f'/?after={cursor}', '/group/resistance', f'/group/resistance?after={cursor}',
+                    '/sarah/', f'/sarah/?after={cursor}', '/follow/', f'/follow/?after={cursor}',
+                    f'/sarah/{self.post.id}/'):
+            with self.subTest(url=url):
+                bad = []
+                for detail, sql in self._plans(url):
+                    # scanning rows produced by a subquery is fine, its own plan is checked too
+                    full_scan = (detail.startswith('SCAN') and 'INDEX' not in detail
+                                 and 'subquery' not in detail)
+                    if full_scan or 'TEMP B-TREE' in detail:
+                        bad.append(f'{detail}: {sql}')
+                self.assertEqual(bad, [])
+
+    def test_feed_indexes(self):
+        """ test that feeds and comments are read from their own indexes """
+        def index_name(model, *fields):
+            return next(index.name for index in model._meta.indexes if tuple(index.fields) == fields)
+
+        feed = index_name(Post, 'pub_date', 'id')
+        group = index_name(Post, 'group', 'pub_date', 'id')
+        author = index_name(Post, 'author', 'pub_date', 'id')
+        follow = index_name(TimelineEntry, 'user', 'pub_date', 'post')
+        comments = index_name(Comment, 'post', 'created')
+        cursor = encode_cursor(self.post)
+        comment_cursor = encode_cursor(Comment.objects.earliest('created'), 'created')
+        expected = {
+            # the first page of all posts has nothing to seek, it reads the index in order
+            '/': f'SCAN posts_post USING INDEX {feed}',
+            f'/?after={cursor}': f'SEARCH posts_post USING INDEX {feed} (pub_date<?)',
+            '/group/resistance': f'SEARCH posts_post USING INDEX {group} (group_id=?)',
+            f'/group/resistance?after={cursor}':
+                f'SEARCH posts_post USING INDEX {group} (group_id=? AND pub_date<?)',
+            '/sarah/': f'SEARCH posts_post USING INDEX {author} (author_id=?)',
+            f'/sarah/?after={cursor}': f'SEARCH posts_post USING INDEX {author} (author_id=? AND pub_date<?)',
+            '/follow/': f'SEARCH posts_timelineentry USING COVERING INDEX {follow} (user_id=?)',
+            f'/follow/?after={cursor}':
+                f'SEARCH posts_timelineentry USING COVERING INDEX {follow} (user_id=? AND pub_date<?)',
+            f'/sarah/{self.post.id}/': f'SEARCH posts_comment USING INDEX {comments} (post_id=?)',
+            f'/sarah/{self.post.id}/comments/?after={comment_cursor}':
+                f'SEARCH posts_comment USING INDEX {comments} (post_id=? AND created<?)',
+        }
+        for url, step in expected.items():
+            with self.subTest(url=url):
+                self.assertIn(step, [detail for detail, sql in self._plans(url)])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TestSingleFlight(TransactionTestCase):
+    def setUp(self):
         cache.clear()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        Post.objects.create(text='No fate.', author=self.user)
+
+    def _concurrent(self, count, func):
+        """ call func from count threads at once, return results """
+        barrier = threading.Barrier(count)
+        results = []
+
+        def run():
+            barrier.wait()
+            try:
+                results.append(func())
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_misses(self):
+        """ test that concurrent misses run the query once """
+        queries = []
+
+        def compute():
+            queries.append(1)
+            time.sleep(0.2)
+            return [post.text for post in Post.objects.all()]
+
+        results = self._concurrent(8, lambda: get_or_compute('feed', compute, 60))
+        self.assertEqual(len(queries), 1, 'value was computed more than once')
+        self.assertEqual(results, [['No fate.']] * 8)
+
+    def test_stale_while_recomputing(self):
+        """ test that an expired value is served to others while one worker recomputes it """
+        cache.set('feed', ('old', 0.1, time.time() - 1), 60)
+        computed = []
+
+        def compute():
+            computed.append(1)
+            time.sleep(0.2)
+            return 'new'
+
+        results = self._concurrent(4, lambda: get_or_compute('feed', compute, 60))
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(sorted(results), ['new', 'old', 'old', 'old'])
+
+
+class TestConditionalGet(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        self.group = Group.objects.create(title='Resistance', slug='resistance')
+        self.post = Post.objects.create(text='No fate.', author=self.user, group=self.group)
+
+    def assertNotModified(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Cookie', response['Vary'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304, f'{url} is rendered although it did not change')
+        return response['ETag']
+
+    def test_not_modified(self):
+        """ test that unchanged feeds and post pages are answered with 304 """
+        for url in ('/', '/group/resistance', '/sarah/', f'/sarah/{self.post.id}/'):
+            etag = self.assertNotModified(url)
+            Comment.objects.create(post=self.post, author=self.user, text='I will be back')
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, f'{url} is not modified by a new comment')
+
+    def test_user_variants(self):
+        """ test that anonymous and authenticated users get different ETags """
+        etag = self.assertNotModified('/sarah/')
+        self.client.login(username='sarah', password='12345')
+        response = self.client.get('/sarah/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200, 'anonymous variant is served to a logged in user')
+
+    def test_csrf_variants(self):
+        """ test that pages with forms aren't reused after the csrf cookie changes """
+        self.client.login(username='sarah', password='12345')
+        etag = self.assertNotModified(f'/sarah/{self.post.id}/')
+        del self.client.cookies[settings.CSRF_COOKIE_NAME]
+        response = self.client.get(f'/sarah/{self.post.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200, 'a page with a stale csrf token is not rendered again')
+
+    def test_group_renamed(self):
+        """ test that pages showing a group's title change when it is renamed """
+        etags = {url: self.assertNotModified(url) for url in ('/sarah/', f'/sarah/{self.post.id}/')}
+        self.group.title = 'Tech-Com'
+        self.group.save()
+        for url, etag in etags.items():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, f'{url} shows the old title of a group')
+            self.assertContains(response, 'Tech-Com')
+
+    def test_missing_pages(self):
+        """ test that missing pages are not answered with 304 """
+        response = self.client.get('/group/nothing', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestThumbnails(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        # cleanups run in reverse order, workers stop before files are removed
+        self.addCleanup(thumbnails.shutdown)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        self.client.login(username='sarah', password='12345')
+
+    def _upload(self, name):
+        image = BytesIO()
+        Image.new('RGB', (1200, 800), 'white').save(image, 'PNG')
+        image = SimpleUploadedFile(name, image.getvalue(), 'image/png')
+        self.client.post('/new/', {'text': 'Judgment Day is inevitable.', 'image': image})
+        return Post.objects.latest('id')
+
+    def test_pages_do_not_generate_thumbnails(self):
+        """ test that a placeholder is shown until the thumbnail is generated in background """
+        post = self._upload('background.png')
         response = self.client.get('/')
-        self.assertContains(
-            response, 
-            'There is no fate but what we make for ourselves.', 
-            msg_prefix="post does not appear on index page after clearing cache")
+        self.assertContains(response, f'src="{post.image_placeholder}"')
+        response = self.client.get(f'/sarah/{post.id}/')
+        self.assertContains(response, f'src="{post.image_placeholder}"')
+        self.assertFalse(KVStoreModel.objects.filter(value__contains=post.image.name).exists(),
+            'thumbnail is generated while rendering the page')
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_generated_thumbnails_invalidate_pages(self):
+        """ test that cached pages showing a placeholder change once the thumbnail exists """
+        cache.clear()
+        post = self._upload('worker.png')
+        response = self.client.get('/')
+        self.assertContains(response, f'src="{post.image_placeholder}"')
+        # what a background worker does
+        thumbnails.generate(post.image.name)
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'src="' + settings.MEDIA_URL + 'cache/')
+
+    @override_settings(THUMBNAIL_WORKERS=0)
+    def test_thumbnails_generated_at_upload(self):
+        """ test that thumbnails are generated when an image is uploaded """
+        self._upload('inline.png')
+        response = self.client.get('/')
+        self.assertContains(response, 'src="' + settings.MEDIA_URL + 'cache/')
+
+    def test_generate_thumbnails_command(self):
+        """ test that the command generates thumbnails of existing images """
+        self._upload('backfill.png')
+        call_command('generate_thumbnails', workers=0, stdout=StringIO())
+        response = self.client.get('/')
+        self.assertContains(response, settings.MEDIA_URL + 'cache/')
+
+    @override_settings(THUMBNAIL_WORKERS=0, POST_IMAGE_MAX_SIZE=1000)
+    def test_image_ingest(self):
+        """ test that uploads are stored downsized, without metadata and with WebP variants """
+        exif = Image.Exif()
+        exif[0x010f] = 'Cyberdyne Systems'
+        exif[0x0112] = 6  # rotated
+        upload = BytesIO()
+        Image.new('RGB', (3000, 2000), 'white').save(upload, 'JPEG', exif=exif.tobytes())
+        self.client.post('/new/', {
+            'text': 'Judgment Day is inevitable.',
+            'image': SimpleUploadedFile('photo.jpg', upload.getvalue(), 'image/jpeg')})
+
+        post = Post.objects.get()
+        with Image.open(post.image.path) as image:
+            self.assertEqual(image.size, (667, 1000), 'image is not downsized or not rotated')
+            self.assertNotIn('exif', image.info)
+        self.assertEqual((post.image_width, post.image_height), (667, 1000))
+        self.assertTrue(post.image_placeholder.startswith('data:image/png;base64,'))
+        response = self.client.get('/')
+        self.assertContains(response, '.webp 480w')
+
+    @override_settings(THUMBNAIL_WORKERS=0)
+    def test_page_thumbnails_prefetched(self):
+        """ test that thumbnails of a page are looked up at once """
+        def count_queries():
+            # the first view registers thumbnails written by workers
+            self.client.get('/sarah/')
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/sarah/')
+            self.assertContains(response, 'src="' + settings.MEDIA_URL + 'cache/', count=len(posts))
+            return len(queries)
+
+        posts = [self._upload(f'image{i}.png') for i in range(2)]
+        few = count_queries()
+        posts += [self._upload(f'image{i}.png') for i in range(2, 6)]
+        self.assertEqual(count_queries(), few, 'thumbnails are looked up post by post')
+
+    def test_fill_image_fields_command(self):
+        """ test that the command stores dimensions of existing images """
+        post = self._upload('old.png')
+        Post.objects.update(image_width=None, image_height=None, image_placeholder='')
+        missing = Post.objects.create(text='Gone', author=self.user, image='posts/missing.png')
+        call_command('fill_image_fields', stdout=StringIO(), stderr=StringIO())
+        post.refresh_from_db()
+        self.assertEqual((post.image_width, post.image_height), (1200, 800))
+        self.assertTrue(post.image_placeholder)
+        missing.refresh_from_db()
+        self.assertIsNone(missing.image_width)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestSearch(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        self.other = User.objects.create_user(username='kyle', password='12345')
+        self.group = Group.objects.create(title='Resistance', slug='resistance')
+        self.best = Post.objects.create(text='Machines, machines everywhere', author=self.user)
+        self.post = Post.objects.create(text='The machines rose from the ashes', author=self.other, group=self.group)
+
+    def search(self, query):
+        response = self.client.get('/search/?' + query)
+        return [post.id for post in response.context['page']]
+
+    def test_search(self):
+        """ test that search finds ranked posts by words and word prefixes """
+        self.assertEqual(self.search('q=machines'), [self.best.id, self.post.id])
+        self.assertEqual(self.search('q=ash'), [self.post.id])
+        self.assertEqual(self.search('q=machines&group=resistance'), [self.post.id])
+        self.assertEqual(self.search('q=machines&author=sarah'), [self.best.id])
+        self.assertEqual(self.search('q="OR*'), [])
+
+    def test_index_updates(self):
+        """ test that edited and deleted posts are reindexed """
+        self.post.text = 'No fate'
+        self.post.save()
+        self.best.delete()
+        self.assertEqual(self.search('q=machines'), [])
+        self.assertEqual(self.search('q=fate'), [self.post.id])
+
+    def test_cursor_pages(self):
+        """ test that search result pages follow each other """
+        for i in range(15):
+            Post.objects.create(text=f'machines {i}', author=self.user)
+        response = self.client.get('/search/?q=machines')
+        seen = [post.id for post in response.context['page']]
+        response = self.client.get(f"/search/?q=machines&after={response.context['page'].next_cursor}")
+        seen += [post.id for post in response.context['page']]
+        self.assertIsNone(response.context['page'].next_cursor)
+        self.assertEqual(sorted(seen), sorted(Post.objects.values_list('id', flat=True)))
+
+    def test_reindex(self):
+        """ test that reindex rebuilds the index """
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM posts_post_fts")
+        call_command('reindex', stdout=StringIO())
+        self.assertEqual(self.search('q=ashes'), [self.post.id])
+
+    def test_admin_search(self):
+        """ test that admin search uses the index """
+        admin = User.objects.create_superuser('admin', 'admin@skynet.com', '12345')
+        self.client.force_login(admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/posts/post/?q=ashes')
+        self.assertEqual(list(response.context['cl'].result_list), [self.post])
+        self.assertFalse([query for query in queries if 'LIKE' in query['sql']])
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestTags(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        self.kyle = User.objects.create_user(username='kyle', password='12345')
+
+    def tag_feed(self, name):
+        return [post.id for post in self.client.get(f'/tag/{name}').context['page']]
+
+    def test_tag_feeds(self):
+        """ test that posts appear in feeds of their hashtags and mentions """
+        first = Post.objects.create(text='#NoFate for @kyle and @nobody', author=self.user)
+        second = Post.objects.create(text='Still #nofate &#39;', author=self.user)
+        self.assertEqual(self.tag_feed('nofate'), [second.id, first.id])
+        self.assertEqual(self.tag_feed('@kyle'), [first.id])
+        self.assertEqual(self.client.get('/tag/@nobody').status_code, 404)
+        self.assertEqual(self.client.get('/tag/39').status_code, 404)
+        self.assertContains(self.client.get('/'), '<a href="/tag/nofate">#NoFate</a>', html=True)
+
+        second.text = 'Judgment Day'
+        second.save()
+        first.delete()
+        self.assertEqual(self.tag_feed('nofate'), [])
+
+    def test_tag_feed_cursor(self):
+        """ test that tag feeds are paged through by cursor """
+        for i in range(12):
+            Post.objects.create(text=f'#skynet {i}', author=self.user)
+        response = self.client.get('/tag/skynet')
+        response = self.client.get(f"/tag/skynet?after={response.context['page'].next_cursor}")
+        self.assertEqual(len(response.context['page']), 2)
+
+    def test_trending(self):
+        """ test that trending tags are counted without scanning posts """
+        for text in ('#skynet', '#skynet #t800', '#t800 #skynet', '#resistance'):
+            Post.objects.create(text=text, author=self.user)
+        Post.objects.filter(text='#resistance').delete()
+        with CaptureQueriesContext(connection) as queries:
+            trending = tags.trending()
+        self.assertEqual([(str(tag), tag.recent_posts) for tag in trending], [('#skynet', 3), ('#t800', 2)])
+        self.assertFalse([query for query in queries if 'posts_post' in query['sql']])
+
+    def test_rebuild_tags(self):
+        """ test that the command rebuilds the index and counters """
+        Post.objects.create(text='#skynet is watching @kyle', author=self.user)
+        expected = list(PostTag.objects.values_list('tag__name', 'post_id'))
+        PostTag.objects.all().delete()
+        TagActivity.objects.all().delete()
+        call_command('rebuild_tags', stdout=StringIO())
+        self.assertCountEqual(PostTag.objects.values_list('tag__name', 'post_id'), expected)
+        self.assertEqual([tag.recent_posts for tag in tags.trending()], [1])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TestApi(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345', first_name='Sarah')
+        self.follower = User.objects.create_user(username='john', password='12345')
+        self.group = Group.objects.create(title='Resistance', slug='resistance')
+        self.posts = [
+            Post.objects.create(text=f'post {i}', author=self.user, group=self.group if i % 2 else None)
+            for i in range(15)]
+
+    def test_cursor_pagination(self):
+        """ test that feeds are paged through by cursors """
+        response = self.client.get('/api/v1/posts/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([post['id'] for post in data['results']], [post.id for post in self.posts[:4:-1]])
+        data = self.client.get(data['next']).json()
+        self.assertEqual([post['id'] for post in data['results']], [post.id for post in self.posts[4::-1]])
+        self.assertIsNone(data['next'])
+
+        data = self.client.get('/api/v1/groups/resistance/posts/', {'limit': 3}).json()
+        self.assertEqual([post['text'] for post in data['results']], ['post 13', 'post 11', 'post 9'])
+        self.assertIn('limit=3', data['next'])
+
+    def test_embedded_objects(self):
+        """ test that authors and groups are embedded without a query per post """
+        # the user, posts, their authors and their groups
+        with self.assertNumQueries(4):
+            data = self.client.get('/api/v1/users/sarah/posts/').json()
+        post = data['results'][0]
+        self.assertEqual(post['author'], {'id': self.user.id, 'username': 'sarah', 'name': 'Sarah'})
+        self.assertEqual(post['url'], f'/sarah/{self.posts[-1].id}/')
+        self.assertIsNone(post['group'])
+        self.assertEqual(
+            data['results'][1]['group'], {'id': self.group.id, 'slug': 'resistance', 'title': 'Resistance'})
+
+    def test_sparse_fields(self):
+        """ test that only requested fields are returned and unknown ones are rejected """
+        with CaptureQueriesContext(connection) as captured:
+            data = self.client.get('/api/v1/posts/', {'fields': 'id,text'}).json()
+        self.assertEqual(set(data['results'][0]), {'id', 'text'})
+        self.assertNotIn('image_placeholder', captured[-1]['sql'])
+
+        response = self.client.get('/api/v1/posts/', {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('password', response.json()['error'])
+        self.assertEqual(self.client.get('/api/v1/posts/', {'after': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/groups/nothing/posts/').status_code, 404)
+
+    def test_caching(self):
+        """ test that unchanged pages are answered with 304 or from the cache """
+        response = self.client.get('/api/v1/posts/')
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.client.get('/api/v1/posts/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(self.client.get('/api/v1/posts/').content, response.content)
+
+        Post.objects.create(text='new post', author=self.user)
+        response = self.client.get('/api/v1/posts/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['text'], 'new post')
+
+    def test_follow(self):
+        """ test that follow feed requires authentication and shows followed authors """
+        self.assertEqual(self.client.get('/api/v1/follow/').status_code, 401)
+        self.client.login(username='john', password='12345')
+        self.assertEqual(self.client.get('/api/v1/follow/').json()['results'], [])
+        Follow.objects.create(user=self.follower, author=self.user)
+        data = self.client.get('/api/v1/follow/', {'fields': 'id'}).json()
+        self.assertEqual(data['results'][0], {'id': self.posts[-1].id})
+
+    def test_follow_caching(self):
+        """ test that unchanged follow feed pages are validated without reading posts """
+        Follow.objects.create(user=self.follower, author=self.user)
+        self.client.login(username='john', password='12345')
+        response = self.client.get('/api/v1/follow/')
+        for headers in ({'HTTP_IF_NONE_MATCH': response['ETag']}, {}):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get('/api/v1/follow/', **headers).content,
+                                 b'' if headers else response.content)
+            self.assertFalse([query for query in queries if '"posts_post"."text"' in query['sql']],
+                             'posts are read although the page did not change')
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestExport(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        self.admin = User.objects.create_user(username='admin', password='12345', is_staff=True)
+        self.group = Group.objects.create(title='Resistance', slug='resistance')
+        self.posts = [Post.objects.create(text=f'post {i}', author=self.user, group=self.group)
+                      for i in range(5)]
+
+    def test_ndjson(self):
+        """ test that rows are exported as JSON lines referring to usernames and slugs """
+        out, err = StringIO(), StringIO()
+        call_command('export_data', 'posts', '--chunk-size', '2', stdout=out, stderr=err)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [post.id for post in self.posts])
+        self.assertEqual(rows[0]['author'], 'sarah')
+        self.assertEqual(rows[0]['group'], 'resistance')
+        self.assertIn(f'watermark: {self.posts[-1].id}', err.getvalue())
+
+    def test_since(self):
+        """ test that exports continue after the watermark """
+        out = StringIO()
+        call_command('export_data', 'posts', '--format', 'csv', '--since', str(self.posts[2].id),
+                     stdout=out, stderr=StringIO())
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,author,group,pub_date,text,image')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], [str(post.id) for post in self.posts[3:]])
+
+    def test_endpoint(self):
+        """ test that only staff can stream exports """
+        response = self.client.get('/export/follows.csv')
+        self.assertEqual(response.status_code, 302)
+        self.client.login(username='sarah', password='12345')
+        self.assertEqual(self.client.get('/export/follows.csv').status_code, 302)
+
+        self.client.login(username='admin', password='12345')
+        response = self.client.get('/export/posts.ndjson', {'since': self.posts[3].id})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['text'] for line in lines], ['post 4'])
+        self.assertEqual(self.client.get('/export/users.csv').status_code, 404)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestImport(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        self.follower = User.objects.create_user(username='john', password='12345')
+        self.dir = tempfile.mkdtemp()
+
+    def write(self, name, rows):
+        path = f'{self.dir}/{name}'
+        with open(path, 'w') as file:
+            file.writelines(json.dumps(row) + '\n' for row in rows)
+        return path
+
+    def test_import(self):
+        """ test that imported rows keep their dates and derived data is rebuilt """
+        groups = self.write('groups.ndjson', [{'id': 7, 'slug': 'resistance', 'title': 'Resistance'}])
+        posts = self.write('posts.ndjson', [
+            {'id': 10, 'author': 'sarah', 'group': 'resistance', 'pub_date': '1997-08-29T02:14:00+00:00',
+             'text': 'Judgment day #skynet'},
+            {'id': 11, 'author': 'kyle', 'group': None, 'pub_date': '1984-05-12T00:00:00+00:00',
+             'text': 'Come with me if you want to live'},
+            {'id': 12, 'author': 'nobody', 'text': 'skipped'},
+        ])
+        comments = self.write('comments.ndjson', [
+            {'id': 1, 'post': 10, 'author': 'john', 'created': '1997-08-30T00:00:00+00:00', 'text': 'No fate'}])
+        follows = self.write('follows.ndjson', [
+            {'user': 'john', 'author': 'sarah'}, {'user': 'john', 'author': 'john'}])
+        with self.settings(FEED_DELIVERY='push'):
+            call_command('import_data', groups=groups, posts=posts, comments=comments, follows=follows,
+                         batch_size=1, commit_every=2, stdout=StringIO())
+
+        post = Post.objects.get(id=10)
+        self.assertEqual(post.pub_date.year, 1997)
+        self.assertEqual(post.group.slug, 'resistance')
+        self.assertEqual(post.comment_count, 1)
+        self.assertEqual(Comment.objects.get().created.year, 1997)
+        self.assertFalse(Post.objects.filter(id__in=[11, 12]).exists(), 'rows of unknown users are imported')
+        self.assertEqual(ProfileStats.objects.get(user=self.user).posts, 1)
+        self.assertEqual(ProfileStats.objects.get(user=self.user).followers, 1)
+        self.assertEqual(list(timeline.timeline_posts(self.follower)), [post])
+        self.assertEqual(list(tags.tag_posts(Tag.objects.get(name='skynet'))), [post])
+        self.assertContains(self.client.get('/search/', {'q': 'judgment'}), 'Judgment day')
+
+    def test_create_users(self):
+        """ test that missing authors are created on request and imports can be rerun """
+        posts = self.write('posts.ndjson', [{'id': 11, 'author': 'kyle', 'text': 'Come with me', 'group': ''}])
+        for _ in range(2):
+            call_command('import_data', posts=posts, create_users=True, stdout=StringIO())
+        self.assertEqual(Post.objects.get(id=11).author.username, 'kyle')
+        self.assertEqual(Post.objects.filter(author__username='kyle').count(), 1)
+
+    def test_existing_rows(self):
+        """ test that imported rows don't collide with rows already in the database """
+        Group.objects.create(id=7, slug='skynet', title='Skynet')
+        taken = Post.objects.create(id=10, text='Already here', author=self.follower)
+        groups = self.write('groups.ndjson', [
+            {'id': 7, 'slug': 'resistance', 'title': 'Resistance'},
+            {'id': 8, 'slug': 'skynet', 'title': 'Skynet'}])
+        posts = self.write('posts.ndjson', [
+            {'id': 10, 'author': 'sarah', 'group': 'resistance', 'pub_date': '1997-08-29T02:14:00+00:00',
+             'text': 'Judgment day'},
+            {'id': 11, 'author': 'kyle', 'pub_date': '1984-05-12T00:00:00+00:00', 'text': 'skipped'}])
+        comments = self.write('comments.ndjson', [
+            {'id': 1, 'post': 10, 'author': 'john', 'created': '1997-08-30T00:00:00+00:00', 'text': 'No fate'},
+            {'id': 2, 'post': 11, 'author': 'john', 'created': '1984-05-13T00:00:00+00:00', 'text': 'orphan'}])
+        out = StringIO()
+        for _ in range(2):
+            call_command('import_data', groups=groups, posts=posts, comments=comments, stdout=out)
+        self.assertIn('Imported 1 groups', out.getvalue())
+        self.assertIn('Imported 0 posts', out.getvalue())
+
+        post = Post.objects.get(text='Judgment day')
+        self.assertNotEqual(post.id, taken.id)
+        self.assertEqual(post.group.slug, 'resistance')
+        self.assertEqual(Group.objects.get(slug='skynet').id, 7)
+        self.assertEqual([comment.post for comment in Comment.objects.all()], [post])
+        taken.refresh_from_db()
+        self.assertEqual(taken.comment_count, 0)
+        # new rows get ids above the imported ones
+        self.assertGreater(Post.objects.create(text='New', author=self.user).id, post.id)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestBenchmarkViews(TestCase):
+    def test_seed_and_benchmark(self):
+        """ test that a seeded database can be benchmarked against a baseline """
+        call_command('seed_data', users=30, groups=2, posts_per_group=10, ungrouped_posts=20,
+                     comments=2, images=0, stdout=StringIO())
+        self.assertEqual(Post.objects.count(), 40)
+        self.assertTrue(TimelineEntry.objects.exists())
+        # raises CommandError if timelines filled by the importer are inconsistent
+        call_command('check_timelines', stdout=StringIO())
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        report = os.path.join(directory.name, 'report.json')
+        run = os.path.join(directory.name, 'run.json')
+        call_command('benchmark_views', requests=3, warmup=1, output=report, stdout=StringIO())
+        with open(report) as file:
+            views = json.load(file)['views']
+        self.assertEqual(set(views), {
+            'index', 'group', 'profile', 'post', 'follow_index', 'add_comment', 'new_post'})
+        self.assertGreater(views['index']['queries'], 0)
+        self.assertGreater(views['post']['rows'], 0)
+        self.assertEqual(Post.objects.count(), 40, 'benchmarked writes are not rolled back')
+
+        # fewer queries than in the baseline is not a regression; latencies of a
+        # few requests are too noisy to compare, so the baseline ones are huge
+        views['index']['queries'] += 1
+        views['index']['p95_ms'] = views['post']['p95_ms'] = 1e9
+        with open(report, 'w') as file:
+            json.dump({'views': views}, file)
+        out = StringIO()
+        call_command('benchmark_views', requests=3, warmup=1, output=run,
+                     baseline=report, views='index,post', stdout=out)
+        self.assertNotIn('REGRESSION', out.getvalue())
+        views['post']['rows'] = 0
+        with open(report, 'w') as file:
+            json.dump({'views': views}, file)
+        with self.assertRaises(CommandError):
+            call_command('benchmark_views', requests=3, warmup=1, output=run,
+                         baseline=report, views='post', fail_on_regression=True, stdout=StringIO())
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestQueryBudgets(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345', is_staff=True, is_superuser=True)
+        self.groups = [Group.objects.create(title=f'Group {i}', slug=f'group-{i}') for i in range(6)]
+        self.posts = [Post.objects.create(text=f'post {i}', author=self.user, group=group)
+                      for i, group in enumerate(self.groups)]
+
+    def test_normalize(self):
+        """ test that queries for different rows have the same shape """
+        self.assertEqual(
+            normalize('SELECT * FROM t WHERE a = 1 AND b = \'x\'\n  AND c IN (%s, %s, %s)'),
+            normalize("SELECT * FROM t WHERE a = 25 AND b = 'it''s' AND c IN (%s)"))
+
+    def test_repeated_shapes(self):
+        """ test that a query per row is reported as N+1 """
+        with QueryLog() as log:
+            for post in Post.objects.all():
+                post.group.title
+        self.assertEqual(list(log.repeated().values()), [6])
+        with self.assertRaisesRegex(AssertionError, 'N\\+1'):
+            with query_budget(100):
+                for post in Post.objects.all():
+                    post.group.title
+        with QueryLog() as log, repeats_allowed():
+            for post in Post.objects.all():
+                post.group.title
+        self.assertEqual(log.repeated(), {})
+        self.assertEqual(len(log), 7)
+
+    @override_settings(QUERY_BUDGETS={'index': 1}, QUERY_BUDGET_ACTION='raise')
+    def test_middleware(self):
+        """ test that views over their budget fail """
+        with self.assertRaisesRegex(QueryBudgetExceeded, 'budget is 1'):
+            self.client.get('/')
+        with override_settings(QUERY_BUDGET_ACTION='log'), self.assertLogs('posts.queries', 'WARNING'):
+            self.assertEqual(self.client.get('/').status_code, 200)
+
+    @override_settings(QUERY_BUDGETS={}, QUERY_BUDGET_ACTION='raise', QUERY_REPEAT_THRESHOLD=1)
+    def test_views_without_budget(self):
+        """ test that repeated queries of views without a budget are only logged """
+        with self.assertLogs('posts.queries', 'WARNING'):
+            self.assertEqual(self.client.get('/').status_code, 200)
+
+    def test_admin_delete(self):
+        """ test that deleting a commented post in the admin doesn't fail """
+        self.client.login(username='sarah', password='12345')
+        for i in range(6):
+            Comment.objects.create(post=self.posts[0], author=self.user, text=f'comment {i}')
+        with override_settings(QUERY_BUDGET_ACTION='raise'):
+            response = self.client.post(f'/admin/posts/post/{self.posts[0].id}/delete/', {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Post.objects.filter(id=self.posts[0].id).exists())
+
+    def test_post_view(self):
+        """ test that the post page loads its author with the post """
+        self.client.login(username='sarah', password='12345')
+        for i in range(6):
+            Comment.objects.create(post=self.posts[0], author=self.user, text=f'comment {i}')
+        # session, user, ETag, post with author and stats, comments, follow
+        with query_budget(6):
+            self.client.get(f'/sarah/{self.posts[0].id}/')
+
+    def test_admin_changelist(self):
+        """ test that groups of listed posts are not loaded one by one """
+        self.client.login(username='sarah', password='12345')
+        # the admin counts posts twice, a query per group would be repeated 6 times
+        with query_budget(10, threshold=3):
+            self.assertContains(self.client.get('/admin/posts/post/'), 'Group 5')
+
+    @override_settings(QUERY_BUDGET_ACTION='raise')
+    def test_logged_in_feeds(self):
+        """ test that search and tag feeds of logged in users keep to their budgets """
+        self.client.login(username='sarah', password='12345')
+        Post.objects.create(text='#JudgmentDay post', author=self.user, group=self.groups[0])
+        self.assertContains(self.client.get('/search/', {'q': 'post'}), 'Group 5')
+        self.assertContains(self.client.get('/tag/judgmentday'), 'Group 0')
+
+    @override_settings(QUERY_BUDGET_ACTION='raise', FEED_DELIVERY='hybrid', FEED_FANOUT_THRESHOLD=1)
+    def test_hybrid_follow_feeds(self):
+        """ test that follow feeds merging pulled authors keep to their budgets without N+1 reports """
+        reese = User.objects.create_user(username='reese', password='12345')
+        Follow.objects.create(user=self.user, author=reese)
+        pushed = Post.objects.create(text='pushed post', author=reese)
+        for i in range(5):
+            author = User.objects.create_user(username=f'author{i}', password='12345')
+            Follow.objects.create(user=self.user, author=author)
+            Follow.objects.create(user=reese, author=author)
+            for group in self.groups[:3]:
+                Post.objects.create(text=f'pulled post {i}', author=author, group=group)
+        self.client.login(username='sarah', password='12345')
+        response = self.client.get('/follow/')
+        page = list(response.context['page'])
+        self.assertEqual(len(page), 10)
+        response = self.client.get(f'/follow/?after={encode_cursor(page[-1])}')
+        self.assertContains(response, pushed.text)
+        self.assertEqual(len(self.client.get('/api/v1/follow/').json()['results']), 10)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        Post.objects.create(text='A profiled post', author=self.user)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.settings = self.settings(PROFILE_DIR=self.dir.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def test_token(self):
+        """ test that a signed token profiles the request """
+        response = self.client.get('/', HTTP_X_PROFILE=make_token())
+        self.assertContains(response, 'A profiled post')
+        timing = response['Server-Timing']
+        for metric in ('sql;dur=', 'template;dur=', 'app;dur=', 'total;dur='):
+            self.assertIn(metric, timing)
+        with open(f"{self.dir.name}/{response['X-Profile']}") as profile:
+            for line in profile:
+                stack, count = line.rsplit(' ', 1)
+                self.assertGreater(int(count), 0)
+
+    def test_not_profiled(self):
+        """ test that only signed tokens and staff users enable profiling """
+        self.assertFalse(self.client.get('/', HTTP_X_PROFILE='forged').has_header('Server-Timing'))
+        self.client.login(username='sarah', password='12345')
+        self.assertFalse(self.client.get('/?profile=1').has_header('Server-Timing'))
+        self.user.is_staff = True
+        self.user.save()
+        self.assertTrue(self.client.get('/?profile=1').has_header('Server-Timing'))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TestMetrics(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        user = User.objects.create_user(username='sarah', password='12345')
+        Post.objects.create(text='A measured post', author=user)
+
+    def sample(self, text, line):
+        """Return the value of a line of the exposition starting with line"""
+        values = [row.rsplit(' ', 1)[1] for row in text.splitlines() if row.startswith(line)]
+        return float(values[0]) if values else 0
+
+    def test_requests(self):
+        """ test that requests are measured by view and status """
+        before = self.client.get('/metrics').content.decode()
+        self.client.get('/')
+        self.client.get('/')
+        self.client.get('/group/missing')
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('# TYPE yatube_request_duration_seconds histogram', text)
+        for line, growth in (
+                ('yatube_request_duration_seconds_count{view="index",status="200"}', 2),
+                ('yatube_request_duration_seconds_bucket{view="index",status="200",le="+Inf"}', 2),
+                ('yatube_response_size_bytes_count{view="group",status="404"}', 1),
+                ('yatube_fragment_cache_total{view="index",fragment="index_page",result="miss"}', 1),
+                ('yatube_fragment_cache_total{view="index",fragment="index_page",result="hit"}', 1)):
+            self.assertEqual(self.sample(text, line) - self.sample(before, line), growth, line)
+        self.assertGreater(self.sample(text, 'yatube_db_queries_total{view="index",status="200"}'), 0)
+
+    def test_threads_and_processes(self):
+        """ test that shards of threads and files of other processes are merged """
+        thread = threading.Thread(target=metrics.inc, args=(metrics.DB_QUERIES, ('test', 200), 3))
+        thread.start()
+        thread.join()
+        metrics.inc(metrics.DB_QUERIES, ('test', 200), 2)
+        with tempfile.TemporaryDirectory() as directory, self.settings(METRICS_DIR=directory):
+            with open(f'{directory}/1.json', 'w') as file:
+                json.dump([['yatube_db_queries_total', ['test', '200'], [10]]], file)
+            metrics.flush(force=True)
+            text = metrics.render(metrics.collect())
+        self.assertGreaterEqual(self.sample(text, 'yatube_db_queries_total{view="test",status="200"}'), 15)
+
+    def test_dead_processes(self):
+        """ test that files of processes which are gone are removed, not merged """
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        with tempfile.TemporaryDirectory() as directory, self.settings(METRICS_DIR=directory):
+            path = os.path.join(directory, f'{process.pid}.json')
+            with open(path, 'w') as file:
+                json.dump([['yatube_db_queries_total', ['dead', '200'], [10]]], file)
+            text = metrics.render(metrics.collect())
+            self.assertFalse(os.path.exists(path), 'file of a dead process is kept')
+        self.assertNotIn('view="dead"', text)
+
+    def test_local_only(self):
+        """ test that metrics are not served to remote clients """
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestSlowQueryLog(TestCase):
+    def setUp(self):
+        self.client = Client()
+        user = User.objects.create_user(username='sarah', password='12345')
+        Post.objects.create(text='A slow post', author=user)
+        self.log = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False).name
+
+    def records(self):
+        slowlog.flush()
+        with open(self.log) as file:
+            return [json.loads(line) for line in file]
+
+    def test_slow_queries(self):
+        """ test that slow queries are logged with their view and caller """
+        with self.settings(SLOW_QUERY_LOG=self.log, SLOW_QUERY_THRESHOLD=0):
+            self.client.get('/')
+        records = self.records()
+        self.assertTrue(records)
+        self.assertEqual({record['view'] for record in records}, {'index'})
+        frames = [record['frame'] for record in records if record['frame']]
+        self.assertTrue(frames)
+        self.assertTrue(all(frame.startswith(('posts/views.py:', 'posts/utils.py:')) for frame in frames), frames)
+        for record in records:
+            self.assertNotIn("'sarah'", record['sql'])
+            self.assertEqual(len(record['params_hash']), 16)
+
+    def test_threshold_and_sampling(self):
+        """ test that fast and unsampled queries are not logged """
+        with self.settings(SLOW_QUERY_LOG=self.log, SLOW_QUERY_THRESHOLD=60):
+            self.client.get('/')
+        with self.settings(SLOW_QUERY_LOG=self.log, SLOW_QUERY_THRESHOLD=0, SLOW_QUERY_SAMPLE_RATE=0):
+            self.client.get('/')
+        self.assertEqual(self.records(), [])
+
+    def test_dropped_records(self):
+        """ test that records dropped by concurrent requests are all counted """
+        full = queue.Queue(1)
+        full.put({})
+        logger = slowlog.SlowQueryLogger(RequestFactory().get('/'))
+
+        def log():
+            for _ in range(1000):
+                logger.log('SELECT 1', (), False, 1.0)
+
+        with mock.patch.object(slowlog, 'get_queue', lambda: full), mock.patch.object(slowlog, '_dropped', 0):
+            threads = [threading.Thread(target=log) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(slowlog._dropped, 4000)
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TestCommentPages(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='sarah', password='12345')
+        self.post = Post.objects.create(text='A viral post', author=self.user)
+        self.comments = [Comment.objects.create(post=self.post, author=self.user, text=f'comment {i}')
+                         for i in range(COMMENTS_PER_PAGE * 2 + 5)]
+        self.url = f'/sarah/{self.post.id}/'
+
+    def test_first_page(self):
+        """ test that the post page shows only the newest comments """
+        with query_budget(8):
+            response = self.client.get(self.url)
+        shown = list(response.context['comments'])
+        self.assertEqual(shown, self.comments[::-1][:COMMENTS_PER_PAGE])
+        self.assertNotContains(response, 'name="comment_{}"'.format(self.comments[0].id))
+        self.assertContains(response, response.context['more_comments'])
 
+    def test_following_pages(self):
+        """ test that all comments are reached by following cursors, once each """
+        url = self.client.get(self.url).context['more_comments']
+        seen = [comment.id for comment in self.client.get(self.url).context['comments']]
+        pages = 0
+        while url:
+            with query_budget(6):
+                data = self.client.get(url + '&format=json').json()
+            html = self.client.get(url)
+            self.assertEqual(html.context['more_comments'], data['next'])
+            seen += [comment['id'] for comment in data['results']]
+            url = data['next']
+            pages += 1
+        self.assertEqual(pages, 2)
+        self.assertEqual(seen, [comment.id for comment in self.comments[::-1]])
 
+    def test_missing_post(self):
+        """ test that comments of missing posts are not found """
+        self.assertEqual(self.client.get(f'/nobody/{self.post.id}/comments/').status_code, 404)
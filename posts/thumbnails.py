@@ -0,0 +1,284 @@
+"""Thumbnails of post images.
+
+Decoding, cropping and encoding a full-size image takes far too long for a
+request, so thumbnails of every geometry in settings.POST_THUMBNAILS are
+generated in a background thread pool as soon as an image is uploaded.
+QueuedThumbnailBackend, which sorl's {% thumbnail %} tag uses, never
+generates thumbnails: it returns the thumbnail if it is already in storage,
+and otherwise queues its generation and returns a placeholder. Workers
+write files and invalidate feeds showing the image's placeholder; thumbnails
+are registered in sorl's key-value store by the first request which finds
+them, in bulk for a whole feed page.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from django.conf import settings
+from django.db import connections, transaction
+from sorl.thumbnail import default
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import settings as sorl_settings, defaults as sorl_defaults
+from sorl.thumbnail.helpers import serialize, deserialize
+from sorl.thumbnail.images import ImageFile, DummyImageFile, deserialize_image_file, serialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import KVStore as CachedDbKVStore, EMPTY_VALUE
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from . import metrics, profiling
+from .cache import bump
+from .models import Post
+from .signals import post_feeds
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_lock = threading.Lock()
+# names of images waiting for their thumbnails, which are not queued twice
+_pending = set()
+
+
+class Placeholder(DummyImageFile):
+    """Inline image of the thumbnail's size shown until it is generated.
+
+    It is the post's image_placeholder if there is one, a grey box otherwise.
+    """
+
+    def __init__(self, geometry_string, url=None):
+        super().__init__(geometry_string)
+        self._url = url
+
+    @property
+    def url(self):
+        if self._url:
+            return self._url
+        svg = (f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.x}" height="{self.y}">'
+               f'<rect width="100%" height="100%" fill="#e9ecef"/></svg>')
+        return 'data:image/svg+xml,' + quote(svg)
+
+
+class QueuedThumbnailBackend(ThumbnailBackend):
+    """sorl backend which only looks thumbnails up and queues missing ones"""
+
+    @profiling.timed(profiling.THUMBNAILS)
+    def get_thumbnail(self, file_, geometry_string, **options):
+        if not file_:
+            raise ValueError('falsey file_ argument in get_thumbnail()')
+        return self.lookup(file_, geometry_string, options)
+
+    def lookup(self, file_, geometry_string, options, source_size=None, placeholder=None):
+        """Return the thumbnail, or a Placeholder with the given url if it doesn't exist.
+
+        source_size, if known, saves reading the size from the image file.
+        """
+        source, thumbnail = self._get_files(file_, geometry_string, options)
+        cached = default.kvstore.get(thumbnail)
+        if cached:
+            return cached
+        if thumbnail.exists():
+            # generated in the background, workers don't touch the database
+            if source_size:
+                source.set_size(source_size)
+            default.kvstore.get_or_set(source)
+            default.kvstore.set(thumbnail, source)
+            return thumbnail
+        queue(source.name)
+        return Placeholder(geometry_string, placeholder)
+
+    def _get_files(self, file_, geometry_string, options):
+        """Return source and thumbnail ImageFiles, complete options in place"""
+        source = ImageFile(file_)
+        # options are completed the same way ThumbnailBackend.get_thumbnail()
+        # does, so that the thumbnail gets the same name
+        if sorl_settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(sorl_settings, attr)
+            if value != getattr(sorl_defaults, attr):
+                options.setdefault(key, value)
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        return source, ImageFile(name, default.storage)
+
+    def create_thumbnails(self, name):
+        """Write missing thumbnails of all settings.POST_THUMBNAILS to storage.
+
+        Return the number of thumbnails written.
+        """
+        source_image = None
+        created = 0
+        try:
+            for geometry, options in settings.POST_THUMBNAILS:
+                options = dict(options)
+                source, thumbnail = self._get_files(name, geometry, options)
+                if thumbnail.exists():
+                    continue
+                if source_image is None:
+                    source_image = default.engine.get_image(source)
+                options['image_info'] = default.engine.get_image_info(source_image)
+                self._create_thumbnail(source_image, geometry, options, thumbnail)
+                self._create_alternative_resolutions(source_image, geometry, options, thumbnail.name)
+                created += 1
+        finally:
+            if source_image is not None:
+                default.engine.cleanup(source_image)
+        return created
+
+
+@profiling.timed(profiling.THUMBNAILS)
+def prefetch(posts):
+    """Look thumbnails of all posts' images up at once.
+
+    Thumbnails of the first settings.POST_THUMBNAILS geometry are attached
+    to posts as post.thumbnail, the rest make post.srcset; post_item.html
+    reads both. Known thumbnails take one cache get_many() and at most one
+    query for keys missing from the cache, whatever the number of posts;
+    thumbnails generated since the last request are registered in bulk.
+    """
+    backend = QueuedThumbnailBackend()
+    posts = [post for post in posts if post.image]
+    keys = {}
+    for post in posts:
+        for geometry, options in settings.POST_THUMBNAILS:
+            _, thumbnail = backend._get_files(post.image.name, geometry, dict(options))
+            keys[post.id, geometry, options.get('format')] = add_prefix(thumbnail.key)
+
+    values = {}
+    if isinstance(default.kvstore, CachedDbKVStore):
+        kv_cache = default.kvstore.cache
+        values = kv_cache.get_many(list(keys.values()))
+        missing = [key for key in keys.values() if key not in values]
+        if missing:
+            found = dict(KVStoreModel.objects.filter(key__in=missing).values_list('key', 'value'))
+            kv_cache.set_many(found, sorl_settings.THUMBNAIL_CACHE_TIMEOUT)
+            values.update(found)
+
+    generated = []
+    for post in posts:
+        thumbnails = []
+        for geometry, options in settings.POST_THUMBNAILS:
+            options = dict(options)
+            value = values.get(keys[post.id, geometry, options.get('format')])
+            if value and value != EMPTY_VALUE:
+                thumbnails.append(deserialize_image_file(value))
+                continue
+            source, thumbnail = backend._get_files(post.image.name, geometry, options)
+            if thumbnail.exists():
+                # generated in the background, registered below with others
+                if post.image_width:
+                    source.set_size((post.image_width, post.image_height))
+                thumbnail.set_size()
+                generated.append((source, thumbnail))
+                thumbnails.append(thumbnail)
+            else:
+                queue(source.name)
+                thumbnails.append(Placeholder(geometry, post.image_placeholder))
+        post.thumbnail = thumbnails[0]
+        post.srcset = ', '.join(
+            f'{thumbnail.url} {thumbnail.x}w' for thumbnail in thumbnails[1:]
+            if not isinstance(thumbnail, Placeholder))
+    if generated:
+        register(generated)
+
+
+def register(entries):
+    """Store (source, thumbnail) pairs of generated files in the key-value store.
+
+    Does what kvstore.set(thumbnail, source) does for each pair, with a
+    constant number of queries. Sizes are read from files if not set.
+    """
+    values = {}
+    thumbnail_keys = defaultdict(set)
+    for source, thumbnail in entries:
+        source.set_size()
+        thumbnail.set_size()
+        values[add_prefix(source.key)] = serialize_image_file(source)
+        values[add_prefix(thumbnail.key)] = serialize_image_file(thumbnail)
+        thumbnail_keys[add_prefix(source.key, 'thumbnails')].add(thumbnail.key)
+    # lists of thumbnails of the sources are extended, not replaced
+    for key, value in KVStoreModel.objects.filter(key__in=list(thumbnail_keys)).values_list('key', 'value'):
+        thumbnail_keys[key].update(deserialize(value))
+    values.update({key: serialize(list(keys)) for key, keys in thumbnail_keys.items()})
+
+    with transaction.atomic():
+        KVStoreModel.objects.filter(key__in=list(values)).delete()
+        # another worker may store the same keys between the two statements;
+        # its rows describe the same files, so they are kept
+        KVStoreModel.objects.bulk_create(
+            (KVStoreModel(key=key, value=value) for key, value in values.items()), ignore_conflicts=True)
+    default.kvstore.cache.set_many(values, sorl_settings.THUMBNAIL_CACHE_TIMEOUT)
+
+
+def invalidate(name):
+    """Invalidate feeds showing posts with the image stored under name"""
+    for post in Post.objects.filter(image=name).only('author', 'group'):
+        bump(*post_feeds(post))
+
+
+def generate(name):
+    """Generate all thumbnails of the image stored under name"""
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        if QueuedThumbnailBackend().create_thumbnails(name):
+            # pages cached until now show placeholders
+            invalidate(name)
+    except Exception:
+        status = 'error'
+        logger.exception('Failed to generate thumbnails of %s', name)
+    metrics.observe(metrics.THUMBNAIL_DURATION, (status,), time.perf_counter() - start)
+
+
+def generate_in_thread(name):
+    """Run generate() in a worker thread"""
+    try:
+        generate(name)
+    finally:
+        with _lock:
+            _pending.discard(name)
+        # connections of worker threads are not closed at the end of a request
+        connections.close_all()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.THUMBNAIL_WORKERS, thread_name_prefix='thumbnails')
+        return _executor
+
+
+def shutdown():
+    """Wait for queued thumbnails and stop the worker threads"""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def queue(name):
+    """Generate thumbnails of the image stored under name in the background.
+
+    With settings.THUMBNAIL_WORKERS = 0 they are generated right away.
+    """
+    if not name:
+        return
+    if not settings.THUMBNAIL_WORKERS:
+        generate(name)
+        return
+
+    def submit():
+        with _lock:
+            if name in _pending:
+                return
+            _pending.add(name)
+        get_executor().submit(generate_in_thread, name)
+
+    # the image may belong to a post which is not committed yet
+    transaction.on_commit(submit)
@@ -0,0 +1,203 @@
+"""Materialized follow feeds.
+
+Every follower gets a TimelineEntry for each post of the authors they follow.
+Entries are written when a post is published and when the follow graph
+changes, so that reading a follow feed is a single index range scan
+instead of a join over Follow and a sort of all matching posts.
+
+Writing a post of an author with a huge audience to every follower's
+timeline is too expensive, so with settings.FEED_DELIVERY = 'hybrid' posts
+of authors having more than settings.FEED_FANOUT_THRESHOLD followers are
+not pushed. They are pulled from the author's posts at read time and merged
+into the timeline instead, and timelines are pruned or backfilled when an
+author crosses the threshold. 'push' and 'pull' modes deliver all posts one way.
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+
+from .models import Post, Follow, TimelineEntry, ProfileStats
+from .utils import FEED_KEY
+
+PUSH, PULL, HYBRID = 'push', 'pull', 'hybrid'
+
+
+def is_pulled(author_id):
+    """Return True if posts of the author are pulled at read time"""
+    if settings.FEED_DELIVERY == PUSH:
+        return False
+    if settings.FEED_DELIVERY == PULL:
+        return True
+    return ProfileStats.objects.filter(
+        user_id=author_id, followers__gt=settings.FEED_FANOUT_THRESHOLD).exists()
+
+
+def pulled_author_ids(user_id):
+    """Return ids of followed authors whose posts are pulled at read time"""
+    followed = Follow.objects.filter(user_id=user_id).values('author_id')
+    if settings.FEED_DELIVERY == PUSH:
+        return []
+    if settings.FEED_DELIVERY == PULL:
+        return list(followed.values_list('author_id', flat=True))
+    return list(ProfileStats.objects.filter(
+        user_id__in=followed, followers__gt=settings.FEED_FANOUT_THRESHOLD).values_list('user_id', flat=True))
+
+
+def timeline_posts(user):
+    """Return posts in user's timeline.
+
+    feed_date and feed_id mirror the entry's (pub_date, post) columns,
+    which lets pagination seek on the timeline index.
+    """
+    return Post.objects.filter(timeline_entries__user=user).annotate(
+        feed_date=F('timeline_entries__pub_date'), feed_id=F('timeline_entries__post_id'))
+
+
+def follow_feed(user, pulled=None):
+    """Return (post_list, key, sources) describing user's follow feed.
+
+    post_list holds all posts of the feed, ordered by the key fields; it
+    is only read for numbered pages past the first one (see paginate()).
+    sources are (queryset, key) pairs of pre-sorted timeline and pulled
+    author feeds, which are merged for the first page and cursor pages.
+    pulled are ids from pulled_author_ids(), if they are already known.
+    """
+    def prepare(post_list):
+        return post_list.prefetch_related('author', 'group')
+
+    timeline_key = ('feed_date', 'feed_id')
+    if settings.FEED_DELIVERY == PULL:
+        post_list = prepare(Post.objects.filter(author__following__user=user))
+        return post_list, FEED_KEY, [(post_list, FEED_KEY)]
+
+    if pulled is None:
+        pulled = pulled_author_ids(user.id)
+    timeline = prepare(timeline_posts(user))
+    if not pulled:
+        return timeline, timeline_key, [(timeline, timeline_key)]
+
+    post_list = prepare(Post.objects.filter(
+        Q(id__in=TimelineEntry.objects.filter(user=user).values('post_id')) | Q(author_id__in=pulled)))
+    sources = [(timeline, timeline_key)]
+    sources += [(prepare(Post.objects.filter(author_id=author_id)), FEED_KEY) for author_id in pulled]
+    return post_list, FEED_KEY, sources
+
+
+def push_post(post):
+    """Deliver a new post to timelines of all its author's followers.
+
+    Return ids of users whose timelines were changed.
+    """
+    if is_pulled(post.author_id):
+        return []
+    follower_ids = list(Follow.objects.filter(author_id=post.author_id).values_list('user_id', flat=True))
+    TimelineEntry.objects.bulk_create(
+        (TimelineEntry(user_id=user_id, post_id=post.id, pub_date=post.pub_date)
+         for user_id in follower_ids),
+        ignore_conflicts=True)
+    return follower_ids
+
+
+def add_author(user_id, author_id, pulled=None):
+    """Copy all posts of a newly followed author into user's timeline.
+
+    pulled is the result of is_pulled(author_id), if it's already known.
+    """
+    if pulled is None:
+        pulled = is_pulled(author_id)
+    if pulled:
+        return
+    posts = Post.objects.filter(author_id=author_id).values_list('id', 'pub_date')
+    TimelineEntry.objects.bulk_create(
+        (TimelineEntry(user_id=user_id, post_id=post_id, pub_date=pub_date)
+         for post_id, pub_date in posts.iterator()),
+        ignore_conflicts=True)
+
+
+def add_authors(follows):
+    """Copy all posts of authors into followers' timelines for a Follow queryset.
+
+    Entries are copied by a single INSERT ... SELECT, which is much faster
+    than add_author() for every follow when timelines of many users are
+    filled at once, e.g. after a bulk import. Profile stats must be up to date.
+    """
+    if settings.FEED_DELIVERY == PULL:
+        return 0
+    follow_ids, params = follows.values('id').query.sql_with_params()
+    sql = [
+        f"INSERT INTO {TimelineEntry._meta.db_table} (user_id, post_id, pub_date)",
+        f"SELECT f.user_id, p.id, p.pub_date FROM {Follow._meta.db_table} f",
+        f"JOIN {Post._meta.db_table} p ON p.author_id = f.author_id",
+        f"WHERE f.id IN ({follow_ids})",
+        f"AND NOT EXISTS (SELECT 1 FROM {TimelineEntry._meta.db_table} e",
+        "WHERE e.user_id = f.user_id AND e.post_id = p.id)",
+    ]
+    params = list(params)
+    if settings.FEED_DELIVERY == HYBRID:
+        sql.append(f"AND NOT EXISTS (SELECT 1 FROM {ProfileStats._meta.db_table} s "
+                   f"WHERE s.user_id = f.author_id AND s.followers > %s)")
+        params.append(settings.FEED_FANOUT_THRESHOLD)
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), params)
+        return cursor.rowcount
+
+
+def remove_author(user_id, author_id):
+    """Remove all posts of an unfollowed author from user's timeline"""
+    TimelineEntry.objects.filter(user_id=user_id, post__author_id=author_id).delete()
+
+
+def followers_changed(author_id, delta):
+    """Switch author's posts between push and pull after a follow or unfollow.
+
+    In hybrid mode, an author whose follower count has just risen above
+    settings.FEED_FANOUT_THRESHOLD is pulled from now on, so their pushed
+    entries are removed from all timelines; an author who has just dropped
+    to the threshold is pushed again, so all their posts are copied into
+    followers' timelines. Either way, the feeds' contents stay the same.
+    Profile stats must already include the change.
+
+    Return True if posts of the author are pulled, like is_pulled().
+    """
+    if settings.FEED_DELIVERY != HYBRID:
+        return settings.FEED_DELIVERY == PULL
+    followers = ProfileStats.objects.filter(user_id=author_id).values_list('followers', flat=True).first()
+    threshold = settings.FEED_FANOUT_THRESHOLD
+    if delta > 0 and followers == threshold + 1:
+        TimelineEntry.objects.filter(post__author_id=author_id).delete()
+    elif delta < 0 and followers == threshold:
+        add_authors(Follow.objects.filter(author_id=author_id))
+    return followers is not None and followers > threshold
+
+
+def expected_post_ids(user_id):
+    """Return ids of posts that must be in user's timeline"""
+    if settings.FEED_DELIVERY == PULL:
+        return set()
+    return set(Post.objects.filter(author__following__user_id=user_id).exclude(
+        author_id__in=pulled_author_ids(user_id)).values_list('id', flat=True))
+
+
+def actual_post_ids(user_id):
+    """Return ids of posts that are in user's timeline"""
+    return set(TimelineEntry.objects.filter(user_id=user_id).values_list('post_id', flat=True))
+
+
+def check(user_id, repair=False):
+    """Compare user's timeline with the follow graph.
+
+    Return (missing, extra) sets of post ids. With repair=True, missing
+    entries are created and extra entries are deleted.
+    """
+    expected = expected_post_ids(user_id)
+    actual = actual_post_ids(user_id)
+    missing, extra = expected - actual, actual - expected
+    if repair and missing:
+        posts = Post.objects.filter(id__in=missing).values_list('id', 'pub_date')
+        TimelineEntry.objects.bulk_create(
+            (TimelineEntry(user_id=user_id, post_id=post_id, pub_date=pub_date)
+             for post_id, pub_date in posts.iterator()),
+            ignore_conflicts=True)
+    if repair and extra:
+        TimelineEntry.objects.filter(user_id=user_id, post_id__in=extra).delete()
+    return missing, extra
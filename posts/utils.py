@@ -1,11 +1,270 @@
+import heapq
+
 from django.shortcuts import get_object_or_404
+from .counters import create_stats
 from .models import User
-from django.db.models import Count
+from .queries import repeats_allowed
+from django.core.paginator import Paginator, Page
+from django.db.models import Q, prefetch_related_objects
+from django.utils.functional import SimpleLazyObject, cached_property
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+
+POSTS_PER_PAGE = 10
+
+# fields which order feeds and hold their cursor values
+FEED_KEY = ('pub_date', 'id')
+
+# comments of a post are listed newest first, a page at a time
+COMMENTS_PER_PAGE = 20
+COMMENT_KEY = ('created', 'id')
+
 
 def get_profile(username):
-    """Return User object with counts of all related models"""
-    return get_object_or_404(User.objects.annotate(
-        post_count=Count('post_author', distinct=True),
-        followers_count=Count('following', distinct=True),
-        following_count=Count('follower', distinct=True)),
-        username=username)
\ No newline at end of file
+    """Return User object with its profile stats (posts, followers, following)"""
+    profile = get_object_or_404(User.objects.select_related('stats'), username=username)
+    if not hasattr(profile, 'stats'):
+        # users created in bulk have no stats yet
+        profile.stats = create_stats(profile.id)
+    return profile
+
+
+def chunks(iterable, size):
+    """Yield lists of up to size items of the iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_cursor(post, date_field='pub_date'):
+    """Return an opaque token pointing at post's (pub_date, id) position in a feed"""
+    value = '{}|{}'.format(getattr(post, date_field).isoformat(), post.pk)
+    return urlsafe_base64_encode(force_bytes(value))
+
+
+def decode_cursor(token):
+    """Return (pub_date, id) encoded in token, or None if token is malformed"""
+    try:
+        pub_date, pk = force_text(urlsafe_base64_decode(token)).split('|')
+        pub_date = parse_datetime(pub_date)
+        pk = int(pk)
+    except (TypeError, ValueError):
+        return None
+    if pub_date is None:
+        return None
+    return pub_date, pk
+
+
+def keyset_slice(post_list, after=None, before=None, limit=POSTS_PER_PAGE, key=FEED_KEY):
+    """Return up to limit posts next to a (pub_date, id) cursor, newest first.
+
+    Instead of OFFSET, rows are located with an index seek on the key
+    fields, so every page costs the same no matter how deep it is.
+    """
+    date_field, id_field = key
+    if before is not None:
+        pub_date, pk = before
+        post_list = post_list.filter(
+            Q(**{date_field + '__gt': pub_date}) | Q(**{date_field: pub_date, id_field + '__gt': pk})
+        ).order_by(date_field, id_field)
+        return list(post_list[:limit])[::-1]
+    post_list = post_list.order_by('-' + date_field, '-' + id_field)
+    if after is not None:
+        pub_date, pk = after
+        post_list = post_list.filter(
+            Q(**{date_field + '__lt': pub_date}) | Q(**{date_field: pub_date, id_field + '__lt': pk}))
+    return list(post_list[:limit])
+
+
+def merged_slice(sources, after=None, before=None, limit=POSTS_PER_PAGE):
+    """Return up to limit posts next to a cursor from several feeds, newest first.
+
+    sources are (post_list, key) pairs. Each of them contributes a small
+    pre-sorted slice, and the slices are combined with a k-way merge.
+    Related objects of the sources are prefetched once, for the merged posts.
+    """
+    lookups = {lookup for post_list, key in sources for lookup in post_list._prefetch_related_lookups}
+    # a seek per source, however many sources there are
+    with repeats_allowed():
+        slices = [keyset_slice(post_list.prefetch_related(None), after, before, limit, key)
+                  for post_list, key in sources]
+    posts, seen = [], set()
+    for post in heapq.merge(*slices, key=lambda post: (post.pub_date, post.id), reverse=True):
+        # the same post may come from several sources
+        if post.id not in seen:
+            seen.add(post.id)
+            posts.append(post)
+    posts = posts[-limit:] if before is not None else posts[:limit]
+    prefetch_related_objects(posts, *lookups)
+    return posts
+
+
+class CursorPage:
+    """A page of posts located by a cursor instead of a page number.
+
+    Supports the subset of django.core.paginator.Page used by templates.
+    """
+
+    def __init__(self, object_list, number, has_next, has_previous):
+        self.object_list = object_list
+        # used to tell cached pages apart, e.g. in {% cache %} tags
+        self.number = number
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<Page {}>'.format(self.number)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        # as in django's Page; templates look page.number up as page['number'] first
+        if not isinstance(index, (int, slice)):
+            raise TypeError('Page indices must be integers or slices, not %s.' % type(index).__name__)
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _cursor_slice(sources, after, before, limit):
+    if len(sources) == 1:
+        post_list, key = sources[0]
+        return keyset_slice(post_list, after, before, limit, key)
+    return merged_slice(sources, after, before, limit)
+
+
+class FeedCursorPage(CursorPage):
+    """A CursorPage of feeds, whose posts are fetched when first used.
+
+    Without a cursor, it is the first page of the feed.
+    """
+
+    def __init__(self, sources, after=None, before=None, per_page=POSTS_PER_PAGE):
+        self.sources = sources
+        self.after, self.before = after, before
+        self.per_page = per_page
+        if before is not None:
+            self.number = 'before:{}|{}'.format(before[0].isoformat(), before[1])
+        elif after is not None:
+            self.number = 'after:{}|{}'.format(after[0].isoformat(), after[1])
+        else:
+            self.number = 1
+
+    def _slice(self, sources):
+        """Return (posts of the page, whether there are more past it)"""
+        # fetch one extra row to find out if there is anything past this page
+        posts = _cursor_slice(sources, self.after, self.before, self.per_page + 1)
+        if self.before is not None:
+            return posts[-self.per_page:], len(posts) > self.per_page
+        return posts[:self.per_page], len(posts) > self.per_page
+
+    @cached_property
+    def _page(self):
+        return self._slice(self.sources)
+
+    @property
+    def object_list(self):
+        return self._page[0]
+
+    def has_next(self):
+        return True if self.before is not None else self._page[1]
+
+    def has_previous(self):
+        return self._page[1] if self.before is not None else self.after is not None
+
+    def author_ids(self):
+        """Return ids of authors of the page's posts, without fetching the posts"""
+        if '_page' in self.__dict__:
+            return {post.author_id for post in self.object_list}
+        # merged_slice() orders posts by pub_date and id
+        sources = [(post_list.prefetch_related(None).only('id', 'author_id', 'pub_date'), key)
+                   for post_list, key in self.sources]
+        return {post.author_id for post in self._slice(sources)[0]}
+
+
+def get_cursor_page(sources, after=None, before=None, per_page=POSTS_PER_PAGE):
+    """Return a page of posts after or before the given cursor, fetched when first used."""
+    return FeedCursorPage(sources, after, before, per_page)
+
+
+def page_author_ids(page):
+    """Return ids of authors of posts of a page from paginate().
+
+    Only the ids are fetched if the posts aren't fetched yet, e.g. because
+    the page is only shown by a template fragment which may be cached.
+    """
+    if isinstance(page, FeedCursorPage):
+        return page.author_ids()
+    if isinstance(page.object_list, FeedCursorPage):
+        return page.object_list.author_ids()
+    if isinstance(page.object_list, list) or page.object_list._result_cache is not None:
+        return {post.author_id for post in page.object_list}
+    return set(page.object_list.prefetch_related(None).values_list('author_id', flat=True))
+
+
+def paginate(request, post_list, per_page=POSTS_PER_PAGE, key=FEED_KEY, sources=None):
+    """Return (page, paginator) for a feed of posts.
+
+    ?after=<cursor> and ?before=<cursor> select keyset pagination, in which
+    case paginator is None. ?page=<number> past the first page is served
+    with django's Paginator, so that existing page links keep working.
+    The first page is read like a cursor page, without counting the feed,
+    but it is a django Page of a Paginator which is never evaluated.
+    Either way, page gets next_cursor and previous_cursor tokens.
+
+    Posts of the page, and so the cursors, are only fetched when the page
+    is first used, so that pages shown by cached template fragments cost
+    no queries on cache hits.
+
+    key names the fields holding each post's (pub_date, id) values;
+    they may be annotations mirroring an indexed table, see timeline.py.
+    sources are (post_list, key) pairs merged in place of post_list
+    when the feed is read by cursor or from its first page.
+    """
+    after = decode_cursor(request.GET.get('after', ''))
+    before = None if after else decode_cursor(request.GET.get('before', ''))
+
+    sources = sources or [(post_list, key)]
+    paginator = None
+    if after or before:
+        page = get_cursor_page(sources, after, before, per_page)
+    else:
+        paginator = Paginator(post_list.order_by('-' + key[0], '-' + key[1]), per_page)
+        number = request.GET.get('page', '')
+        if number.isdigit() and int(number) > 1:
+            page = paginator.get_page(number)
+        else:
+            # counting all posts of a feed costs more than reading a page,
+            # the first page is read like a cursor page and shows no numbers
+            first = get_cursor_page(sources, per_page=per_page)
+            page = Page(first, 1, paginator)
+            page.has_next, page.has_previous = first.has_next, first.has_previous
+
+    def next_cursor():
+        posts = list(page.object_list)
+        return encode_cursor(posts[-1]) if posts and page.has_next() else None
+
+    def previous_cursor():
+        posts = list(page.object_list)
+        return encode_cursor(posts[0]) if posts and page.has_previous() else None
+
+    page.next_cursor = SimpleLazyObject(next_cursor)
+    page.previous_cursor = SimpleLazyObject(previous_cursor)
+    return page, paginator
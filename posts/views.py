@@ -1,38 +1,136 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
-from django.db.models import Count
+from django.middleware.csrf import get_token
 from django.views.decorators.cache import cache_page
-from .utils import get_profile
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_cookie
+from .counters import create_stats
+from .utils import (
+    get_profile, paginate, page_author_ids, CursorPage, POSTS_PER_PAGE, COMMENTS_PER_PAGE, COMMENT_KEY,
+    encode_cursor, decode_cursor, keyset_slice)
+from . import export as dataset_export
+from . import search as post_search
+from . import tags
+from .timeline import follow_feed, pulled_author_ids
+from .cache import feed_version, FRAGMENT_TIMEOUT, INDEX, GROUP, AUTHOR, POST, FOLLOWER
 from .forms import PostForm, CommentForm
+from . import thumbnails
 from .models import *
 
 
+def _etag(request, *scopes):
+    """Return a weak ETag of a page showing the given feeds to request.user"""
+    # pages are not byte-identical (csrf tokens are masked on every render),
+    # so the ETag is weak; it depends on the user, who sees their own variant
+    viewer = 'anon'
+    if request.user.is_authenticated:
+        # their pages have forms, whose csrf tokens are only valid with the
+        # csrf cookie they were rendered for; a page cached under an older
+        # cookie, e.g. from before logging in again, must not be reused
+        get_token(request)
+        secret = hashlib.sha1(request.META['CSRF_COOKIE'].encode()).hexdigest()[:12]
+        viewer = '{}-{}'.format(request.user.id, secret)
+    return 'W/"{}-{}"'.format(viewer, feed_version(*scopes))
+
+
+def index_etag(request):
+    return _etag(request, (INDEX,))
+
+
+def group_etag(request, slug):
+    group_id = Group.objects.filter(slug=slug).values_list('id', flat=True).first()
+    return group_id and _etag(request, (GROUP, group_id))
+
+
+def profile_etag(request, username):
+    user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+    return user_id and _etag(request, (AUTHOR, user_id))
+
+
+def post_etag(request, username, post_id):
+    user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+    return user_id and _etag(request, (AUTHOR, user_id), (POST, post_id))
+
+
+@vary_on_cookie
+@condition(etag_func=index_etag)
 def index(request):
     """Display latest posts."""
-    post_list = Post.objects.order_by("-pub_date").annotate(comment_count=Count('comment_post')).prefetch_related(
-        'author', 'group').all()
-    paginator = Paginator(post_list, 10)
-
-    page_number = request.GET.get('page')
-    page = paginator.get_page(page_number)
-    return render(request, 'index.html', {'page': page, 'paginator': paginator})
+    post_list = Post.objects.prefetch_related('author', 'group').all()
+    page, paginator = paginate(request, post_list)
+    context = {
+        'page': page,
+        'paginator': paginator,
+        'feed_version': feed_version((INDEX,)),
+        'cache_timeout': FRAGMENT_TIMEOUT,
+    }
+    return render(request, 'index.html', context)
 
 
+@vary_on_cookie
+@condition(etag_func=group_etag)
 def group_posts(request, slug):
     """Display latest posts in the group."""
 
     group = get_object_or_404(Group, slug=slug)
 
-    post_list = Post.objects.filter(group=group).annotate(comment_count=Count('comment_post')).order_by(
-        "-pub_date").prefetch_related('author', 'group').all()
-    paginator = Paginator(post_list, 10)
-    page_number = request.GET.get('page')
-    page = paginator.get_page(page_number)
+    post_list = Post.objects.filter(group=group).prefetch_related('author', 'group').all()
+    page, paginator = paginate(request, post_list)
 
     return render(request, 'group.html', {'group': group, 'page': page, 'paginator': paginator})
 
 
+def tag_posts(request, name):
+    """Display latest posts with a hashtag, or mentioning @username."""
+    if name.startswith(Tag.MENTION):
+        tag = get_object_or_404(Tag, kind=Tag.MENTION, name=name[1:])
+    else:
+        tag = get_object_or_404(Tag, kind=Tag.HASHTAG, name=name.lower())
+    post_list = tags.tag_posts(tag).prefetch_related('author', 'group')
+    page, paginator = paginate(request, post_list, key=('feed_date', 'feed_id'))
+    context = {
+        'tag': tag,
+        'page': page,
+        'paginator': paginator,
+        'trending': tags.trending(),
+    }
+    return render(request, 'tag.html', context)
+
+
+def search(request):
+    """Display posts matching a search query, most relevant first."""
+    query = request.GET.get('q', '').strip()
+    group = Group.objects.filter(slug=request.GET.get('group', '')).first()
+    author = User.objects.filter(username=request.GET.get('author', '')).first()
+    after = post_search.decode_cursor(request.GET.get('after', ''))
+
+    # fetch one extra post to find out if there is a next page
+    posts = post_search.get_backend().search(
+        query, group_id=group and group.id, author_id=author and author.id,
+        after=after, limit=POSTS_PER_PAGE + 1)
+    has_next, posts = len(posts) > POSTS_PER_PAGE, posts[:POSTS_PER_PAGE]
+    number = request.GET.get('after', '') if after else 1
+    page = CursorPage(posts, number, has_next=has_next, has_previous=after is not None)
+    page.next_cursor = post_search.encode_cursor(posts[-1]) if has_next else None
+
+    filters = {'q': query, 'group': group and group.slug, 'author': author and author.username}
+    context = {
+        'query': query,
+        'group': group,
+        'author': author,
+        'page': page,
+        # query string of the search without a cursor, for page links
+        'filters': urlencode({key: value for key, value in filters.items() if value}),
+    }
+    return render(request, 'search.html', context)
+
+
 @login_required
 def new_post(request):
     """Display a form for adding a new post to authenticated users."""
@@ -44,23 +142,22 @@ def new_post(request):
             post = form.save(commit=False)
             post.author = request.user
             post.save()
+            thumbnails.queue(post.image.name)
             return redirect('index')
         return render(request, 'new_post.html', {'form': form})
     form = PostForm()
     return render(request, 'new_post.html', {'form': form})
 
 
+@vary_on_cookie
+@condition(etag_func=profile_etag)
 def profile(request, username):
     """Display profile information and user's latest posts."""
     profile = get_profile(username)
 
-    post_list = Post.objects.filter(author=profile).annotate(
-        comment_count=Count('comment_post', distinct=True)).order_by("-pub_date").select_related(
-            'author').prefetch_related('group').all()
-
-    paginator = Paginator(post_list, 10)
-    page_number = request.GET.get('page')
-    page = paginator.get_page(page_number)
+    post_list = Post.objects.filter(author=profile).select_related(
+        'author').prefetch_related('group').all()
+    page, paginator = paginate(request, post_list)
     following = request.user.is_authenticated and Follow.objects.filter(user=request.user, author = profile).exists()
 
     context = {
@@ -72,18 +169,26 @@ def profile(request, username):
     return render(request, 'profile.html', context)
 
 
+@vary_on_cookie
+@condition(etag_func=post_etag)
 def post_view(request, username, post_id):
     """View a post."""
     # if post or author not found, or author's username is wrong, return 404.
-    profile = get_profile(username)
+    # the author's profile and stats are loaded with the post
     post_object = get_object_or_404(
-        Post.objects.select_related('author').annotate(
-            comment_count=Count('comment_post', distinct=True)),
-            id=post_id,
-            author=profile)
-
-    comments = Comment.objects.filter(post=post_object).order_by("-created").select_related('post').prefetch_related(
-        'author').all()
+        Post.objects.select_related('author__stats', 'group'), id=post_id, author__username=username)
+    profile = post_object.author
+    if not hasattr(profile, 'stats'):
+        profile.stats = create_stats(profile.id)
+
+    # only the first page of comments is shown, further ones are loaded by
+    # post_comments; their total is the post's counter
+    comments = Comment.objects.filter(post=post_object).select_related('author').order_by(
+        '-created', '-id')[:COMMENTS_PER_PAGE]
+    more_comments = None
+    if post_object.comment_count > COMMENTS_PER_PAGE and comments:
+        # the queryset is evaluated here and not again in the template
+        more_comments = _comments_url(username, post_id, list(comments)[-1])
 
     following = request.user.is_authenticated and Follow.objects.filter(user=request.user, author=profile).exists()
     form = CommentForm()
@@ -92,11 +197,46 @@ def post_view(request, username, post_id):
         'post': post_object,
         'following': following,
         'form': form,
-        'comments': comments
+        'comments': comments,
+        'more_comments': more_comments,
     }
     return render(request, "post.html", context)
 
 
+def _comments_url(username, post_id, last):
+    """Return the URL of comments of a post after the last shown one"""
+    query = urlencode({'after': encode_cursor(last, 'created')})
+    return '{}?{}'.format(reverse('post_comments', args=[username, post_id]), query)
+
+
+@vary_on_cookie
+@condition(etag_func=post_etag)
+def post_comments(request, username, post_id):
+    """A page of a post's comments after ?after=<cursor>, as HTML or ?format=json."""
+    if not Post.objects.filter(id=post_id, author__username=username).exists():
+        raise Http404
+    after = decode_cursor(request.GET.get('after', ''))
+    # one extra comment tells whether there is a next page
+    comments = keyset_slice(Comment.objects.filter(post_id=post_id).select_related('author'),
+                            after, limit=COMMENTS_PER_PAGE + 1, key=COMMENT_KEY)
+    more_comments = None
+    if len(comments) > COMMENTS_PER_PAGE:
+        comments = comments[:COMMENTS_PER_PAGE]
+        more_comments = _comments_url(username, post_id, comments[-1])
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'results': [{
+                'id': comment.id,
+                'author': comment.author.username,
+                'text': comment.text,
+                'created': comment.created.isoformat(),
+            } for comment in comments],
+            'next': more_comments,
+        })
+    return render(request, 'comment_list.html', {'items': comments, 'more_comments': more_comments})
+
+
 def post_edit(request, username, post_id):
     """Display a form for editing a post."""
     # only post author can edit post
@@ -111,7 +251,9 @@ def post_edit(request, username, post_id):
     if request.method == 'POST':
         form = PostForm(request.POST, files=request.FILES or None, instance=post_object)
         if form.is_valid():
-            form.save()
+            post = form.save()
+            if 'image' in form.changed_data:
+                thumbnails.queue(post.image.name)
             return redirect('post', username=username, post_id=post_id)
         return render(request, 'edit_post.html', {'form': form})
 
@@ -146,14 +288,21 @@ def add_comment(request, username, post_id):
 @login_required
 def follow_index(request):
     """Display all posts from authors whom active user follows."""
-    post_list = Post.objects.order_by("-pub_date").annotate(
-        comment_count=Count('comment_post', distinct=True)).prefetch_related(
-        'author', 'group', 'author__following').filter(author__following__user=request.user).all()
-    paginator = Paginator(post_list, 10)
-
-    page_number = request.GET.get('page')
-    page = paginator.get_page(page_number)
-    return render(request, 'follow.html', {'page': page, 'paginator': paginator})
+    pulled = pulled_author_ids(request.user.id)
+    post_list, key, sources = follow_feed(request.user, pulled)
+    page, paginator = paginate(request, post_list, key=key, sources=sources)
+    # cached page depends on the timeline, on pulled authors and on authors
+    # of posts shown on the page, whose edits and comments change it; only
+    # their ids are fetched here, the posts only by the fragment on cache misses
+    author_ids = sorted(set(pulled) | page_author_ids(page))
+    context = {
+        'page': page,
+        'paginator': paginator,
+        'feed_version': feed_version(
+            (FOLLOWER, request.user.id), *((AUTHOR, author_id) for author_id in author_ids)),
+        'cache_timeout': FRAGMENT_TIMEOUT,
+    }
+    return render(request, 'follow.html', context)
 
 
 @login_required
@@ -163,12 +312,9 @@ def profile_follow(request, username):
         # can't follow yourself
         return redirect('profile', username=username)
 
-    if not Follow.objects.filter(author__username=username, user= request.user).exists():
-        # prevent duplicate followings
-        author = get_object_or_404(User, username=username)
-        follow = Follow.objects.create(user=request.user, author=author)
-        follow.save()
-        
+    author = get_object_or_404(User, username=username)
+    # duplicate followings are prevented by the unique (user, author) constraint
+    Follow.objects.get_or_create(user=request.user, author=author)
     return redirect('profile', username=username)
 
 
@@ -180,6 +326,19 @@ def profile_unfollow(request, username):
     return redirect('profile', username=username)
 
 
+@staff_member_required
+def export(request, table, export_format):
+    """Stream a table of the dataset to staff users, see export.py."""
+    if table not in dataset_export.TABLES or export_format not in dataset_export.FORMATS:
+        raise Http404
+    since = request.GET.get('since', '')
+    lines = dataset_export.lines(table, export_format, int(since) if since.isdigit() else None)
+    content_type = 'application/x-ndjson' if export_format == 'ndjson' else 'text/csv'
+    response = StreamingHttpResponse(lines, content_type=content_type + '; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{table}.{export_format}"'
+    return response
+
+
 def page_not_found(request, exception):
     """Display error 404 page."""
     return render(request, "misc/404.html", {"path": request.path}, status=404)
@@ -0,0 +1,170 @@
+"""Two-tier cache backend.
+
+A small bounded in-process LRU with short timeouts sits in front of a
+shared cache backend (memcached, redis, or a file/database cache during
+development). Hot keys, such as fragments of the first feed pages, are
+served from process memory without a round trip to the shared backend.
+
+Values in the local tier may be a few seconds old, so keys which must
+always be fresh bypass it. Feed version counters (see posts/cache.py) are
+such keys: every process reads them from the shared backend, so a version
+bump invalidates fragments cached in all processes at once.
+"""
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils.functional import cached_property
+
+
+class TwoTierCache(BaseCache):
+    """Cache backend with an in-process LRU in front of a shared backend.
+
+    OPTIONS:
+        SHARED: alias of the shared cache in settings.CACHES
+        LOCAL_MAX_ENTRIES: size of the in-process LRU
+        LOCAL_TIMEOUT: maximum seconds a value is kept in the in-process LRU
+        LOCAL_BYPASS_PREFIXES: prefixes of keys which are never kept locally
+    """
+
+    def __init__(self, location, params):
+        options = params.get('OPTIONS', {})
+        super().__init__(params)
+        self._shared_alias = options.get('SHARED', 'shared')
+        self._local_max_entries = options.get('LOCAL_MAX_ENTRIES', 1000)
+        self._local_timeout = options.get('LOCAL_TIMEOUT', 5)
+        self._bypass_prefixes = tuple(options.get('LOCAL_BYPASS_PREFIXES', ()))
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    @cached_property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def get_stats(self):
+        """Return hit and miss counters of both tiers"""
+        with self._lock:
+            return {name: self._stats[name] for name in (
+                'local_hits', 'local_misses', 'shared_hits', 'shared_misses')}
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    # local tier
+
+    def _is_local(self, key):
+        return not key.startswith(self._bypass_prefixes)
+
+    def _local_get(self, key, version):
+        local_key = self.make_key(key, version)
+        with self._lock:
+            entry = self._local.get(local_key)
+            if entry is not None:
+                expires, pickled = entry
+                if expires > time.monotonic():
+                    self._local.move_to_end(local_key)
+                    self._stats['local_hits'] += 1
+                    return pickle.loads(pickled)
+                del self._local[local_key]
+            self._stats['local_misses'] += 1
+        return None
+
+    def _local_set(self, key, value, timeout, version):
+        timeout = self.get_backend_timeout(timeout)
+        local_timeout = self._local_timeout if timeout is None else min(timeout, self._local_timeout)
+        if local_timeout <= 0:
+            return self._local_delete(key, version)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        local_key = self.make_key(key, version)
+        with self._lock:
+            self._local[local_key] = (time.monotonic() + local_timeout, pickled)
+            self._local.move_to_end(local_key)
+            while len(self._local) > self._local_max_entries:
+                self._local.popitem(last=False)
+
+    def _local_delete(self, key, version):
+        with self._lock:
+            self._local.pop(self.make_key(key, version), None)
+
+    # cache API
+
+    def get(self, key, default=None, version=None):
+        if self._is_local(key):
+            value = self._local_get(key, version)
+            if value is not None:
+                return value
+        value = self.shared.get(key, version=version)
+        if value is None:
+            self._count('shared_misses')
+            return default
+        self._count('shared_hits')
+        if self._is_local(key):
+            # the shared backend doesn't tell how long the value lives,
+            # LOCAL_TIMEOUT keeps it short enough
+            self._local_set(key, value, None, version)
+        return value
+
+    def get_many(self, keys, version=None):
+        values = {}
+        for key in keys:
+            if self._is_local(key):
+                value = self._local_get(key, version)
+                if value is not None:
+                    values[key] = value
+        missing = [key for key in keys if key not in values]
+        if missing:
+            found = self.shared.get_many(missing, version=version)
+            self._count('shared_hits', len(found))
+            self._count('shared_misses', len(missing) - len(found))
+            for key, value in found.items():
+                if self._is_local(key):
+                    self._local_set(key, value, None, version)
+            values.update(found)
+        return values
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version=version)
+        if self._is_local(key):
+            self._local_set(key, value, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            if self._is_local(key):
+                self._local_set(key, value, timeout, version)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # add() is used for locks, so it must be decided by the shared backend
+        self._local_delete(key, version)
+        return self.shared.add(key, value, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self._local_delete(key, version)
+        return self.shared.incr(key, delta, version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._local_delete(key, version)
+        return self.shared.touch(key, timeout, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, version=version) is not None
+
+    def delete(self, key, version=None):
+        self._local_delete(key, version)
+        self.shared.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._local_delete(key, version)
+        self.shared.delete_many(keys, version=version)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+        self.shared.clear()
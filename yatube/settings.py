@@ -50,13 +50,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'posts.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'posts.profiling.ProfilerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'posts.queries.QueryBudgetMiddleware',
+    'posts.slowlog.SlowQueryMiddleware',
 ]
 
 ROOT_URLCONF = 'yatube.urls'
@@ -134,6 +138,26 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# uploaded images are stored downsized to fit this size (see posts/images.py)
+POST_IMAGE_MAX_SIZE = 2048
+
+# thumbnails of post images are generated in the background when an image
+# is uploaded, templates only look them up (see posts/thumbnails.py);
+# every geometry used with {% thumbnail %} for post images must be listed here.
+# The first one is the <img> fallback, the rest make the WebP srcset of feeds
+THUMBNAIL_BACKEND = 'posts.thumbnails.QueuedThumbnailBackend'
+POST_THUMBNAILS = [
+    ('960x339', {'crop': 'center', 'upscale': True}),
+    ('480x170', {'crop': 'center', 'upscale': True, 'format': 'WEBP'}),
+    ('960x339', {'crop': 'center', 'upscale': True, 'format': 'WEBP'}),
+    ('1920x678', {'crop': 'center', 'format': 'WEBP'}),
+]
+# 0 generates thumbnails synchronously
+THUMBNAIL_WORKERS = 2
+
+# full-text search of posts, see posts/search.py
+SEARCH_BACKEND = 'posts.search.SQLiteFTSBackend'
+
 LOGIN_URL = "/auth/login/"
 LOGIN_REDIRECT_URL = "index" 
 
@@ -144,8 +168,81 @@ EMAIL_FILE_PATH = os.path.join(BASE_DIR, "sent_emails")
 
 SITE_ID = 1
 
+# default cache keeps hot keys in process memory for a few seconds in front
+# of the shared cache; feed version counters are always read from the shared one
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
-}
\ No newline at end of file
+        'BACKEND': 'yatube.cache.TwoTierCache',
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 5,
+            'LOCAL_BYPASS_PREFIXES': ['feedver:'],
+        },
+    },
+    # file cache is a stand-in for memcached or redis in development
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    },
+}
+
+# Follow feeds delivery: "push" writes every post to followers' timelines,
+# "pull" reads followed authors' posts at request time, and "hybrid" pushes
+# posts of authors having up to FEED_FANOUT_THRESHOLD followers and pulls the rest
+FEED_DELIVERY = 'hybrid'
+FEED_FANOUT_THRESHOLD = 10000
+
+# maximum number of SQL queries of views by URL name, see posts/queries.py;
+# measured for logged in users, session and user lookups included. Pages
+# showing images leave room for registering new thumbnails (5 queries), and
+# follow feeds for 5 authors pulled in hybrid delivery, a seek per author
+QUERY_BUDGETS = {
+    'index': 12,
+    'group': 14,
+    'profile': 14,
+    'post': 12,
+    'follow_index': 23,
+    'tag': 13,
+    'search': 12,
+    'new_post': 15,
+    'post_edit': 13,
+    'add_comment': 6,
+    'post_comments': 6,
+    'profile_follow': 12,
+    'profile_unfollow': 10,
+    'export': 3,
+    'api_posts': 4,
+    'api_group_posts': 5,
+    'api_user_posts': 5,
+    'api_follow': 17,
+}
+# a query shape run this many times in a request is reported as an N+1 query
+QUERY_REPEAT_THRESHOLD = 5
+# "raise" makes views over their budget fail, in development and tests,
+# "log" only logs a warning; views missing from QUERY_BUDGETS are only logged
+QUERY_BUDGET_ACTION = 'raise' if DEBUG else 'log'
+
+# requests are profiled on demand, see posts/profiling.py; tokens of the
+# X-Profile header are made by the profile_token command
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILE_SAMPLE_INTERVAL = 0.001
+PROFILE_TOKEN_MAX_AGE = 60 * 60
+
+# Prometheus metrics served at /metrics, see posts/metrics.py; set
+# METRICS_DIR to a directory shared by the processes of a multi-process
+# server to report metrics of all of them. The allow-list is checked against
+# REMOTE_ADDR, which behind a reverse proxy on the same host is the proxy's
+# address for every client: the proxy must then deny /metrics itself
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 10
+
+# slow SQL queries are logged as JSON lines, see posts/slowlog.py; set
+# SLOW_QUERY_LOG to None to turn the log off
+SLOW_QUERY_LOG = os.path.join(BASE_DIR, 'slow_queries.jsonl')
+SLOW_QUERY_THRESHOLD = 0.1
+SLOW_QUERY_SAMPLE_RATE = 1.0
+SLOW_QUERY_QUEUE_SIZE = 1000
+# callers reported as the code path which ran a query
+SLOW_QUERY_FRAMES = ('posts/views.py', 'posts/utils.py', 'posts/api.py')
@@ -1,4 +1,7 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+
+from yatube.cache import TwoTierCache
+
 
 class ErrorPages(TestCase):
     def setUp(self):
@@ -9,3 +12,52 @@ class ErrorPages(TestCase):
         response = self.client.get('/a/page/that/definitely/does/not/exist/')
         self.assertEqual(response.status_code, 404, 
             "if page is not found, server must return status code 404")
+
+
+TWO_TIER_CACHE = {
+    'default': {
+        'BACKEND': 'yatube.cache.TwoTierCache',
+        'OPTIONS': {'SHARED': 'shared', 'LOCAL_BYPASS_PREFIXES': ['feedver:']},
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'yatube-tests',
+    },
+}
+
+
+@override_settings(CACHES=TWO_TIER_CACHE)
+class TestTwoTierCache(TestCase):
+    def setUp(self):
+        # two backends sharing one shared tier stand for two worker processes
+        self.worker = TwoTierCache(None, TWO_TIER_CACHE['default'])
+        self.other_worker = TwoTierCache(None, TWO_TIER_CACHE['default'])
+        self.worker.clear()
+
+    def test_local_hits(self):
+        """ test that hot keys are served from the local tier """
+        self.worker.set('fragment', 'cached', 60)
+        self.assertEqual(self.worker.get('fragment'), 'cached')
+        self.assertEqual(self.other_worker.get('fragment'), 'cached')
+        self.assertEqual(self.other_worker.get('fragment'), 'cached')
+        self.assertEqual(self.worker.get_stats(), {
+            'local_hits': 1, 'local_misses': 0, 'shared_hits': 0, 'shared_misses': 0})
+        self.assertEqual(self.other_worker.get_stats(), {
+            'local_hits': 1, 'local_misses': 1, 'shared_hits': 1, 'shared_misses': 0})
+
+    def test_version_keys_bypass_local_tier(self):
+        """ test that a version bump in one worker is seen by others at once """
+        self.worker.set('feedver:index', 1, None)
+        self.assertEqual(self.other_worker.get('feedver:index'), 1)
+        self.worker.incr('feedver:index')
+        self.assertEqual(self.other_worker.get('feedver:index'), 2)
+        self.assertEqual(self.other_worker.get_stats()['local_misses'], 0)
+
+    def test_local_tier_is_bounded(self):
+        """ test that the local tier evicts least recently used keys """
+        worker = TwoTierCache(None, {'OPTIONS': {'SHARED': 'shared', 'LOCAL_MAX_ENTRIES': 2}})
+        worker.set_many({'a': 1, 'b': 2}, 60)
+        worker.get('a')
+        worker.set('c', 3, 60)
+        self.assertEqual(worker.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(worker.get_stats()['shared_hits'], 1, "'b' must have been evicted")
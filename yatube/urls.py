@@ -20,6 +20,8 @@ from django.conf.urls import handler404, handler500
 from django.conf import settings
 from django.conf.urls.static import static
 
+from posts.metrics import metrics
+
 handler404 = "posts.views.page_not_found" # noqa
 handler500 = "posts.views.server_error" # noqa
  
@@ -41,6 +43,12 @@ urlpatterns = [
     path('about-author/', views.flatpage, {'url': '/about-author/'}, name='author'),
     path('about-spec/', views.flatpage, {'url': '/about-spec/'}, name='spec'),
     
+    # Prometheus metrics
+    path('metrics', metrics, name='metrics'),
+
+    # read-only JSON API over the feeds
+    path('api/v1/', include('posts.api_urls')),
+
     # site home page views are in posts app
     path('', include('posts.urls')),
 ]